@@ -0,0 +1,77 @@
+from threading import Condition
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+# No SSO session, needs a browser login
+LOGGED_OUT = 'logged_out'
+# SSO session is valid but the brokerage session isn't, needs a reauthenticate
+UNAUTHENTICATED = 'unauthenticated'
+# Another session took over the brokerage session, needs a gateway restart
+COMPETING = 'competing'
+AUTHENTICATED = 'authenticated'
+
+AUTH_TRANSITIONS = metrics.Counter(
+	'ib_auth_transitions_total', 'Auth state transitions by new state.', ('port', 'state')
+)
+
+
+class AuthState(object):
+
+	def __init__(self, port, listener=None):
+		# Fed by websocket `sts`/`system` messages, tickle and validate
+		# responses. `listener(old, new)` is called on every state change,
+		# on the thread that reported it
+		self.port = port
+		self.listener = listener
+
+		self.logged_in = False
+		self.authenticated = False
+		self.competing = False
+		self.state = LOGGED_OUT
+		self._cond = Condition()
+
+
+	def update(self, logged_in=None, authenticated=None, competing=None, source=None):
+		with self._cond:
+			if logged_in is not None:
+				self.logged_in = bool(logged_in)
+				if not self.logged_in:
+					self.authenticated = False
+			if authenticated is not None:
+				self.authenticated = bool(authenticated)
+				if self.authenticated:
+					self.logged_in = True
+			if competing is not None:
+				self.competing = bool(competing)
+
+			old = self.state
+			self.state = self._evaluate()
+			if old == self.state:
+				return self.state
+
+			new = self.state
+			self._cond.notify_all()
+
+		logger.info('[AuthState] (%s) %s -> %s (%s)', self.port, old, new, source)
+		AUTH_TRANSITIONS.labels(self.port, new).inc()
+		if self.listener is not None:
+			self.listener(old, new)
+		return new
+
+
+	def wait(self, state, timeout=None):
+		with self._cond:
+			return self._cond.wait_for(lambda: self.state == state, timeout)
+
+
+	def _evaluate(self):
+		if not self.logged_in:
+			return LOGGED_OUT
+		elif self.competing:
+			return COMPETING
+		elif self.authenticated:
+			return AUTHENTICATED
+		else:
+			return UNAUTHENTICATED
@@ -0,0 +1,108 @@
+import time
+from threading import Lock, Event
+from . import metrics
+
+# Seconds each gateway read stays fresh, overridden by `cache_ttl` in config.
+# A TTL of 0 still collapses concurrent identical reads into one request.
+DEFAULT_TTL = {
+	'accounts': 300,
+	'summary': 5,
+	'positions': 2,
+	'orders': 2,
+}
+
+CACHE_HITS = metrics.Counter(
+	'ib_cache_hits_total', 'Gateway reads served from cache.', ('endpoint',)
+)
+CACHE_MISSES = metrics.Counter(
+	'ib_cache_misses_total', 'Gateway reads sent to the gateway.', ('endpoint',)
+)
+CACHE_SHARED = metrics.Counter(
+	'ib_cache_shared_total', 'Gateway reads that waited on an identical in-flight request.', ('endpoint',)
+)
+
+
+class _Flight(object):
+
+	__slots__ = ('event', 'stale', 'result', 'error')
+
+	def __init__(self):
+		self.event = Event()
+		self.stale = False
+		self.result = None
+		self.error = None
+
+
+class ReadCache(object):
+
+	def __init__(self, ttl=None):
+		self.ttl = dict(DEFAULT_TTL, **(ttl or {}))
+
+		self._lock = Lock()
+		self._entries = {}
+		self._flights = {}
+
+
+	def get(self, endpoint, key, fn):
+		# Results are shared between callers and must not be mutated.
+		# Error results are returned but never cached.
+		k = (endpoint, key)
+		with self._lock:
+			entry = self._entries.get(k)
+			if entry is not None and entry[0] > time.monotonic():
+				CACHE_HITS.labels(endpoint).inc()
+				return entry[1]
+
+			flight = self._flights.get(k)
+			leader = flight is None
+			if leader:
+				flight = self._flights[k] = _Flight()
+
+		if not leader:
+			CACHE_SHARED.labels(endpoint).inc()
+			flight.event.wait()
+			if flight.error is not None:
+				raise flight.error
+			return flight.result
+
+		CACHE_MISSES.labels(endpoint).inc()
+		try:
+			flight.result = fn()
+		except Exception as e:
+			flight.error = e
+			raise
+		finally:
+			with self._lock:
+				if self._flights.get(k) is flight:
+					del self._flights[k]
+
+				# A read invalidated while in flight may be stale
+				ttl = self.ttl.get(endpoint, 0)
+				if (flight.error is None and ttl > 0 and not flight.stale and
+						not (isinstance(flight.result, dict) and 'error' in flight.result)):
+					self._entries[k] = (time.monotonic() + ttl, flight.result)
+
+			flight.event.set()
+
+		return flight.result
+
+
+	def invalidate(self, key=None, *endpoints):
+		# Drops cached and in-flight reads for `key` (all keys if None),
+		# optionally limited to `endpoints`. Only the in-flight reads
+		# dropped are kept out of the cache when they complete
+		with self._lock:
+			for d in (self._entries, self._flights):
+				for k in list(d):
+					if (key is None or k[1] == key) and (not endpoints or k[0] in endpoints):
+						if d is self._flights:
+							d[k].stale = True
+						del d[k]
+
+
+	def clear(self):
+		self.invalidate()
+
+
+	def __len__(self):
+		return len(self._entries)
@@ -0,0 +1,98 @@
+import time
+from threading import Thread, Event, local
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+CLOCK_OFFSET = metrics.Gauge(
+	'ib_clock_offset_seconds', 'Measured offset of the reference clock from this host\'s clock.'
+)
+CLOCK_SYNC_ERRORS = metrics.Counter(
+	'ib_clock_sync_errors_total', 'Clock offset measurements that failed.'
+)
+
+
+class ClockSync(object):
+
+	def __init__(self, server='pool.ntp.org', interval=64, timeout=5, measure=None):
+		# This host's clock corrected by its offset from an NTP server,
+		# measured every `interval` seconds, so timestamps from different
+		# hosts compare. `measure` replaces the NTP query with a function
+		# returning the offset in seconds, e.g. a fixed one offline. The
+		# last good offset is kept while measurements fail
+		self.server = server
+		self.interval = interval
+		self.timeout = timeout
+		self.offset = 0.0
+		self.synced = None
+
+		self._measure = measure or self._query
+		self._local = local()
+		self._stop = Event()
+		self._thread = None
+
+
+	def now(self):
+		return time.time() + self.offset
+
+
+	def sync(self):
+		try:
+			self.offset = float(self._measure())
+		except Exception as e:
+			CLOCK_SYNC_ERRORS.inc()
+			logger.warning('[ClockSync] Failed to measure offset from %s: %s', self.server, e)
+			return False
+
+		self.synced = time.time()
+		CLOCK_OFFSET.set(self.offset)
+		logger.debug('[ClockSync] Offset %.6fs', self.offset)
+		return True
+
+
+	def start(self):
+		# The first measurement is made on the thread too, it may block on
+		# the network for `timeout`
+		if self._thread is None:
+			self._thread = Thread(target=self._sync_loop, daemon=True)
+			self._thread.start()
+		return self
+
+
+	def stop(self):
+		self._stop.set()
+
+
+	def begin(self, timing):
+		# Gateway requests made on this thread until `end` are stamped
+		# into `timing`, see `onGatewayResponse`
+		self._local.timing = timing
+
+
+	def end(self):
+		self._local.timing = None
+
+
+	def onGatewayResponse(self, elapsed):
+		# The first request sent and the last response received while
+		# handling the command
+		timing = getattr(self._local, 'timing', None)
+		if timing is None:
+			return
+		ack = self.now()
+		timing.setdefault('gateway_sent', ack - elapsed)
+		timing['gateway_ack'] = ack
+
+
+	def _sync_loop(self):
+		self.sync()
+		while not self._stop.wait(self.interval):
+			self.sync()
+
+
+	def _query(self):
+		import ntplib
+
+		return ntplib.NTPClient().request(self.server, version=3, timeout=self.timeout).offset
+
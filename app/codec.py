@@ -0,0 +1,221 @@
+import json
+import numpy as np
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+
+class Codec(object):
+
+	name = None
+	# Encoding of None, used to splice pre-encoded payloads into envelopes
+	nil = None
+
+	def encode(self, obj):
+		raise NotImplementedError
+
+
+	def decode(self, data):
+		raise NotImplementedError
+
+
+class JsonCodec(Codec):
+
+	name = 'json'
+	nil = b'null'
+
+	def __init__(self):
+		self._encoder = json.JSONEncoder(separators=(',', ':'), default=_default)
+
+
+	def encode(self, obj):
+		return self._encoder.encode(obj).encode('utf-8')
+
+
+	def decode(self, data):
+		return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+
+	name = 'orjson'
+	nil = b'null'
+
+	def __init__(self):
+		if orjson is None:
+			raise Exception('The `orjson` codec requires the orjson package.')
+		self._option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+	def encode(self, obj):
+		return orjson.dumps(obj, default=_default, option=self._option)
+
+
+	def decode(self, data):
+		return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+
+	name = 'msgpack'
+	nil = b'\xc0'
+
+	def __init__(self):
+		if msgpack is None:
+			raise Exception('The `msgpack` codec requires the msgpack package.')
+		self._packer = msgpack.Packer(use_bin_type=True, default=_default)
+
+
+	def encode(self, obj):
+		return self._packer.pack(obj)
+
+
+	def decode(self, data):
+		return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+CODECS = {
+	JsonCodec.name: JsonCodec,
+	OrjsonCodec.name: OrjsonCodec,
+	MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def _default(obj):
+	# numpy scalars/arrays and anything else with a natural python form
+	if hasattr(obj, 'tolist'):
+		return obj.tolist()
+	if isinstance(obj, (set, tuple)):
+		return list(obj)
+	raise TypeError(f'Object of type {type(obj).__name__} is not serializable')
+
+
+def decodeColumns(names, buffers):
+	# Arrays over the received buffers, not copies of them
+	return {
+		name: np.frombuffer(buffer, dtype=np.dtype(dtype))
+		for (name, dtype), buffer in zip(names, buffers)
+	}
+
+
+def getCodec(name='json'):
+	if name not in CODECS:
+		raise Exception(f'Unknown codec `{name}`, expected one of {sorted(CODECS)}.')
+	return CODECS[name]()
+
+
+class Envelope(object):
+
+	def __init__(self, codec, multipart=False):
+		# Multipart messages are sent as [type, msg_id, timing, codec,
+		# payload, *columns] so routing headers are plain bytes and only
+		# the payload is encoded. Every frame up to the payload is always
+		# there, `timing` is empty without one, so readers go by position
+		self.codec = codec
+		self.multipart = multipart
+		self._codec_frame = codec.name.encode()
+		self._codecs = { codec.name: codec }
+		self._heads = {}
+
+
+	def encode(self, msg_type, msg_id, result, timing=None):
+		# `timing` goes beside the result, never into it: in `message`, or
+		# its own frame encoded with the payload's codec
+		if self.multipart:
+			return [
+				msg_type.encode(),
+				str(msg_id).encode(),
+				self._encode_timing(timing),
+				self._codec_frame,
+				self.codec.encode(result)
+			]
+
+		message = { 'msg_id': msg_id }
+		if timing is not None:
+			message['timing'] = timing
+		message['result'] = result
+		return [self.codec.encode({
+			'type': msg_type,
+			'message': message
+		})]
+
+
+	def encodePayload(self, msg_type, msg_id, payload):
+		# `payload` is an already encoded result, shared between messages
+		if self.multipart:
+			return [
+				msg_type.encode(),
+				str(msg_id).encode(),
+				b'',
+				self._codec_frame,
+				payload
+			]
+
+		head = self._heads.get((msg_type, msg_id))
+		if head is None:
+			# `result` is encoded last, so its nil is followed only by the
+			# closing of the two enclosing maps (if the codec has any)
+			encoded = self.encode(msg_type, msg_id, None)[0]
+			cut = encoded.rindex(self.codec.nil)
+			head = (encoded[:cut], encoded[cut + len(self.codec.nil):])
+			if len(self._heads) >= 10000:
+				self._heads.clear()
+			self._heads[(msg_type, msg_id)] = head
+
+		return [head[0] + payload + head[1]]
+
+
+	def encodeColumns(self, msg_type, msg_id, result, columns, timing=None):
+		# Multipart only: `result` is encoded with the names and dtypes of
+		# `columns` and each column follows the payload as a raw buffer
+		# frame, sent without copying and readable without parsing, see
+		# `decodeColumns`
+		columns = [ (name, np.ascontiguousarray(values)) for name, values in columns.items() ]
+		header = dict(result, columns=[ [ name, values.dtype.str ] for name, values in columns ])
+		return self.encode(msg_type, msg_id, header, timing) + [ values for _, values in columns ]
+
+
+	def decode(self, frames):
+		# Commands arrive as one frame, in `encode`'s multipart layout, or
+		# with header frames in front of [codec, payload]
+		if len(frames) >= 5 and frames[3].decode('utf-8', 'replace') in CODECS:
+			return self._get_codec(frames[3]).decode(frames[4])
+
+		if len(frames) > 1 and frames[-2].decode('utf-8', 'replace') in CODECS:
+			return self._get_codec(frames[-2]).decode(frames[-1])
+
+		return self.codec.decode(frames[-1])
+
+
+	def decodeReply(self, frames):
+		# (type, msg_id, result, timing) of a message from `encode`,
+		# `encodePayload` or `encodeColumns`, with column buffers as arrays
+		if len(frames) == 1:
+			item = self.codec.decode(frames[0])
+			message = item.get('message', {})
+			return item.get('type'), message.get('msg_id'), message.get('result'), message.get('timing')
+
+		codec = self._get_codec(frames[3])
+		result = codec.decode(frames[4])
+		timing = codec.decode(frames[2]) if frames[2] else None
+		if len(frames) > 5:
+			result['data'] = decodeColumns(result.pop('columns'), frames[5:])
+		return frames[0].decode(), frames[1].decode(), result, timing
+
+
+	def _encode_timing(self, timing):
+		return self.codec.encode(timing) if timing is not None else b''
+
+
+	def _get_codec(self, frame):
+		name = bytes(frame).decode()
+		if name not in self._codecs:
+			self._codecs[name] = getCodec(name)
+		return self._codecs[name]
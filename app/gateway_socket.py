@@ -0,0 +1,156 @@
+import ssl
+import json
+import websocket
+from threading import Thread, Event, Lock
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+SOCKET_MESSAGES = metrics.Counter(
+	'ib_socket_messages_total', 'Gateway websocket messages received by topic.', ('port', 'topic')
+)
+SOCKET_RECONNECTS = metrics.Counter(
+	'ib_socket_reconnects_total', 'Gateway websocket reconnects.', ('port',)
+)
+
+
+class GatewaySocket(object):
+
+	def __init__(self, broker, url, on_open=None, heartbeat=50, backoff_start=1, backoff_max=60):
+		# Handlers are keyed by topic, or by the first three letters of a
+		# topic with arguments, e.g. `smd` for `smd+265598`
+		self.broker = broker
+		self.url = url
+		self.on_open = on_open
+		self.heartbeat = heartbeat
+		self.backoff_start = backoff_start
+		self.backoff_max = backoff_max
+
+		self.handlers = {}
+		self.connected = False
+		self._opened = False
+		self._ws = None
+		self._lock = Lock()
+		self._stopped = Event()
+		self._subscriptions = {}
+
+
+	def on(self, topic, handler):
+		self.handlers[topic] = handler
+
+
+	def start(self):
+		t = Thread(target=self._run, daemon=True)
+		t.start()
+		t = Thread(target=self._heartbeat, daemon=True)
+		t.start()
+
+
+	def stop(self):
+		self._stopped.set()
+		ws = self._ws
+		if ws is not None:
+			ws.close()
+
+
+	def subscribe(self, key, message):
+		# Subscriptions are resent whenever the socket reconnects
+		with self._lock:
+			self._subscriptions[key] = message
+		self.send(message)
+
+
+	def unsubscribe(self, key, message=None):
+		with self._lock:
+			self._subscriptions.pop(key, None)
+		if message is not None:
+			self.send(message)
+
+
+	def send(self, message):
+		ws = self._ws
+		if not self.connected or ws is None:
+			return False
+
+		try:
+			ws.send(message)
+			return True
+		except Exception:
+			logger.debug('[GatewaySocket] (%s) Send failed: %s', self.broker.port, message)
+			return False
+
+
+	def _run(self):
+		backoff = self.backoff_start
+		while not self._stopped.is_set():
+			self._opened = False
+			cookies = '; '.join(f'{k}={v}' for k, v in self.broker._session.cookies.items())
+			self._ws = websocket.WebSocketApp(
+				self.url,
+				cookie=cookies or None,
+				on_open=self._on_open,
+				on_message=self._on_message,
+				on_error=self._on_error,
+				on_close=self._on_close
+			)
+			self._ws.run_forever(sslopt={ 'cert_reqs': ssl.CERT_NONE })
+			self.connected = False
+
+			if self._stopped.is_set():
+				break
+
+			# A connection that opened resets the backoff
+			if self._opened:
+				backoff = self.backoff_start
+			SOCKET_RECONNECTS.labels(self.broker.port).inc()
+			self._stopped.wait(backoff)
+			backoff = min(backoff * 2, self.backoff_max)
+
+
+	def _heartbeat(self):
+		while not self._stopped.wait(self.heartbeat):
+			self.send('ech+hb')
+
+
+	def _on_open(self, ws):
+		logger.info('[GatewaySocket] (%s) Connected', self.broker.port)
+		self.connected = True
+		self._opened = True
+		if self.on_open is not None:
+			self.on_open()
+
+		with self._lock:
+			messages = list(self._subscriptions.values())
+		for message in messages:
+			self.send(message)
+
+
+	def _on_message(self, ws, message):
+		try:
+			data = json.loads(message)
+		except ValueError:
+			logger.debug('[GatewaySocket] (%s) Unparsed message: %s', self.broker.port, message)
+			return
+
+		if not isinstance(data, dict):
+			return
+
+		topic = data.get('topic', '')
+		handler = self.handlers.get(topic) or self.handlers.get(topic[:3])
+		SOCKET_MESSAGES.labels(self.broker.port, topic[:3]).inc()
+		if handler is not None:
+			try:
+				handler(data)
+			except Exception:
+				logger.exception('[GatewaySocket] (%s) Handler failed for %s', self.broker.port, topic)
+
+
+	def _on_error(self, ws, error):
+		logger.debug('[GatewaySocket] (%s) Error: %s', self.broker.port, error)
+
+
+	def _on_close(self, ws, *args):
+		if self.connected:
+			logger.info('[GatewaySocket] (%s) Disconnected', self.broker.port)
+		self.connected = False
@@ -0,0 +1,431 @@
+import time
+import numpy as np
+import pendulum
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from . import tradelib as tl
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+# /iserver/marketdata/history bar sizes. Periods without one (S5, M10,
+# H12) can't be downloaded
+BARS = {
+	tl.period.ONE_MINUTE: '1min',
+	tl.period.TWO_MINUTES: '2min',
+	tl.period.THREE_MINUTES: '3min',
+	tl.period.FIVE_MINUTES: '5min',
+	tl.period.FIFTEEN_MINUTES: '15min',
+	tl.period.THIRTY_MINUTES: '30min',
+	tl.period.ONE_HOUR: '1h',
+	tl.period.TWO_HOURS: '2h',
+	tl.period.THREE_HOURS: '3h',
+	tl.period.FOUR_HOURS: '4h',
+	tl.period.DAILY: '1d',
+	tl.period.WEEKLY: '1w',
+	tl.period.MONTHLY: '1m',
+}
+
+# Forex history from the gateway is midpoint only, there's no bid or ask
+COLUMNS = [ 'mid_open', 'mid_high', 'mid_low', 'mid_close' ]
+
+WEEK_SECONDS = 60 * 60 * 24 * 7
+# Sunday 17:00 to Friday 17:00 New York
+TRADING_WEEK_SECONDS = 60 * 60 * 24 * 5
+
+HISTORY_CHUNKS = metrics.Counter(
+	'ib_history_chunks_total', 'Historical data chunks by source.', ('port', 'source')
+)
+HISTORY_WEEKS = metrics.Counter(
+	'ib_history_derived_weeks_total', 'Weeks of resampled bars, by whether they were memoized.', ('port', 'source')
+)
+HISTORY_RETRIES = metrics.Counter(
+	'ib_history_retries_total', 'Historical data requests retried after pacing or gateway errors.', ('port',)
+)
+
+
+def toTimestamp(value):
+	if value is None:
+		return None
+	if isinstance(value, (int, float)):
+		return float(value)
+	if isinstance(value, str):
+		value = pendulum.parse(value)
+	return tl.utils.convertTimeToTimestamp(value)
+
+
+def getWeeks(start, end):
+	# (start, end, next start) of the trading weeks, Sunday to Friday 17:00
+	# New York, touching [start, end)
+	weeks = []
+	week_start = tl.utils.getWeekstartDate(tl.utils.convertTimestampToTime(start)) - timedelta(days=7)
+	ws = tl.utils.convertTimeToTimestamp(week_start)
+	while ws < end:
+		next_start = week_start + timedelta(days=7)
+		next_ws = tl.utils.convertTimeToTimestamp(next_start)
+		if next_ws > start:
+			weeks.append((ws, tl.utils.convertTimeToTimestamp(tl.utils.getWeekendDate(week_start)), next_ws))
+		week_start, ws = next_start, next_ws
+
+	return weeks
+
+
+def getChunks(period, start, end, max_bars):
+	# Chunks of at most `max_bars` bars covering [start, end), on a fixed
+	# grid so any range maps to the same chunks and they can be cached.
+	# When a chunk is shorter than a week the grid starts over each trading
+	# week, so no request is spent on a weekend
+	off = tl.period.getPeriodOffsetSeconds(period)
+	span = off * max_bars
+	chunks = []
+	if span >= WEEK_SECONDS:
+		cs = start - start % span
+		while cs < end:
+			chunks.append((cs, cs + span))
+			cs += span
+		return chunks
+
+	for ws, we, _ in getWeeks(start, end):
+		for cs in np.arange(ws, we, span):
+			ce = min(cs + span, we)
+			if ce > start and cs < end:
+				chunks.append((float(cs), float(ce)))
+
+	return chunks
+
+
+def resample(bars, period, origin):
+	# OHLC bars of `period` from finer ones, in buckets counted from
+	# `origin`, their week's start. Bars are sorted by time
+	if not len(bars):
+		return bars
+
+	off = tl.period.getPeriodOffsetSeconds(period)
+	buckets = origin + (bars[:, 0] - origin) // off * off
+	starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+	ends = np.r_[starts[1:], len(bars)] - 1
+
+	res = np.empty((len(starts), 5))
+	res[:, 0] = buckets[starts]
+	res[:, 1] = bars[starts, 1]
+	res[:, 2] = np.maximum.reduceat(bars[:, 2], starts)
+	res[:, 3] = np.minimum.reduceat(bars[:, 3], starts)
+	res[:, 4] = bars[ends, 4]
+	return res
+
+
+class SizedLRU(object):
+
+	def __init__(self, max_bytes):
+		# Arrays, least recently used dropped first once their total
+		# size passes `max_bytes`
+		self.max_bytes = max_bytes
+		self.size = 0
+		self._items = OrderedDict()
+		self._lock = Lock()
+
+
+	def get(self, key):
+		with self._lock:
+			value = self._items.get(key)
+			if value is not None:
+				self._items.move_to_end(key)
+			return value
+
+
+	def put(self, key, value):
+		if value.nbytes > self.max_bytes:
+			return
+
+		with self._lock:
+			old = self._items.pop(key, None)
+			if old is not None:
+				self.size -= old.nbytes
+			self._items[key] = value
+			self.size += value.nbytes
+			while self.size > self.max_bytes:
+				_, old = self._items.popitem(last=False)
+				self.size -= old.nbytes
+
+
+def getPeriodParam(seconds):
+	# Chunk length in the largest unit it's a whole number of
+	for unit, size in (('w', WEEK_SECONDS), ('d', 86400), ('h', 3600)):
+		if seconds % size == 0:
+			return f'{int(seconds // size)}{unit}'
+	return f'{int(seconds // 60)}min'
+
+
+class HistoryDownloader(object):
+
+	def __init__(self, broker, max_bars=1000, concurrency=5, rate=10, retries=3, cache_chunks=500, prefetch=True, base=tl.period.ONE_MINUTE, derived_mb=64):
+		# Ranges are split into chunks of `max_bars`, the most the gateway
+		# returns per request, and fetched `concurrency` at a time and at
+		# most `rate` requests a second, IB's pacing limits. Completed
+		# chunks are kept in an LRU of `cache_chunks`. When a caller pages
+		# through a range, the page after the one asked for is fetched in
+		# the background.
+		# Intraday periods that are multiples of `base` are resampled from
+		# its bars rather than downloaded, and each complete week of them
+		# is kept in an LRU of `derived_mb`
+		self.broker = broker
+		self.max_bars = max_bars
+		self.concurrency = concurrency
+		self.rate = rate
+		self.retries = retries
+		self.cache_chunks = cache_chunks
+		self.prefetch = prefetch
+		self.base = base
+
+		self._executor = None
+		self._chunks = OrderedDict()
+		self._derived = SizedLRU(derived_mb * 1024 * 1024)
+		self._lock = Lock()
+		self._pace_lock = Lock()
+		self._next_request = 0
+		self._last = None
+
+
+	def isDerived(self, period):
+		if self.base is None or period == self.base:
+			return False
+		off = tl.period.getPeriodOffsetSeconds(period)
+		base_off = tl.period.getPeriodOffsetSeconds(self.base)
+		return (
+			off is not None and off < tl.period.getPeriodOffsetSeconds(tl.period.DAILY) and
+			off > base_off and off % base_off == 0
+		)
+
+
+	def download(self, product, period, start=None, end=None, count=None, force_download=False):
+		conid = self.broker._quotes.getConid(product)
+		if conid is None:
+			return { 'error': f'Unknown product {product}.' }
+		derived = self.isDerived(period)
+		if period not in BARS and not derived:
+			return { 'error': f'Period {period} not supported.' }
+		if start is None and end is None and count is None:
+			return { 'error': 'Expected start, end or count.' }
+
+		# Counted from `start` if there's one, otherwise back from `end`
+		from_start = start is not None
+		start, end = self._get_range(period, toTimestamp(start), toTimestamp(end), count)
+		if start is None:
+			return { 'error': 'Expected start or count.' }
+
+		# Every chunk is asked for before any is waited on
+		if derived:
+			parts = self._get_derived(conid, period, start, end, force_download)
+		else:
+			parts = [ (None, None, [
+				self._get_chunk(conid, period, chunk, force_download)
+				for chunk in getChunks(period, start, end, self.max_bars)
+			]) ]
+		self._prefetch(conid, period, start, end)
+
+		try:
+			bars = []
+			for key, origin, part in parts:
+				if isinstance(part, list):
+					part = [ future.result() for future in part ]
+					part = np.concatenate(part) if part else np.empty((0, 5))
+					if derived:
+						part = resample(part, period, origin)
+					if key is not None:
+						self._derived.put(key, part)
+				bars.append(part)
+
+		except Exception as e:
+			logger.exception('[HistoryDownloader] (%s) Failed to download %s %s', self.broker.port, product, period)
+			return { 'error': str(e) }
+
+		bars = np.concatenate(bars) if bars else np.empty((0, 5))
+		bars = bars[(bars[:, 0] >= start) & (bars[:, 0] < end)]
+		if count is not None:
+			bars = bars[:count] if from_start else bars[-count:]
+
+		# Imported on first download, it's most of the client's import time
+		import pandas as pd
+
+		return pd.DataFrame(
+			bars[:, 1:5],
+			index=pd.Index(bars[:, 0].astype(np.int64), name='timestamp'),
+			columns=COLUMNS
+		)
+
+
+	def stop(self):
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+
+
+	def _get_range(self, period, start, end, count):
+		# `getCountDate` counts Friday 17:00 New York as a bar, and falls
+		# short by about one for every weekend crossed. Ranges counted out
+		# are widened by two bars a week, the result is trimmed to `count`
+		off = tl.period.getPeriodOffsetSeconds(period)
+		if count is not None:
+			count += int(count * off // TRADING_WEEK_SECONDS) * 2 + 2
+		if start is None:
+			if end is None:
+				end = time.time()
+			if count is None:
+				return None, end
+			start = tl.utils.convertTimeToTimestamp(
+				tl.utils.getCountDate(period, count, end=tl.utils.convertTimestampToTime(end))
+			)
+		elif end is None:
+			if count is None:
+				end = time.time()
+			else:
+				end = tl.utils.convertTimeToTimestamp(
+					tl.utils.getCountDate(period, count, start=tl.utils.convertTimestampToTime(start))
+				)
+
+		return start, min(end, time.time() + off)
+
+
+	def _get_chunk(self, conid, period, chunk, force_download=False, source='gateway'):
+		key = (conid, period, chunk)
+		with self._lock:
+			future = None if force_download else self._chunks.get(key)
+			if future is not None and not (future.done() and future.exception() is not None):
+				self._chunks.move_to_end(key)
+				HISTORY_CHUNKS.labels(self.broker.port, 'cache').inc()
+				return future
+
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix=f'history-{self.broker.port}')
+			future = self._executor.submit(self._request_chunk, conid, period, chunk)
+			self._chunks[key] = future
+			while len(self._chunks) > self.cache_chunks:
+				self._chunks.popitem(last=False)
+
+		future.add_done_callback(lambda future: self._on_chunk_done(key, future))
+		HISTORY_CHUNKS.labels(self.broker.port, source).inc()
+		return future
+
+
+	def _on_chunk_done(self, key, future):
+		# The current chunk is still filling in, it's only shared by
+		# requests made while it was being fetched
+		if key[2][1] > time.time():
+			with self._lock:
+				if self._chunks.get(key) is future:
+					del self._chunks[key]
+
+
+	def _get_derived(self, conid, period, start, end, force_download=False):
+		# Per week, as buckets never cross the weekend: complete weeks that
+		# have been resampled before, or the base chunks to resample,
+		# widened to whole buckets
+		start, end = self._get_bucket_range(period, start, end)
+		parts = []
+		for ws, we, next_ws in getWeeks(start, end):
+			key = None
+			if start <= ws and end >= we and we <= time.time():
+				key = (conid, period, ws)
+				bars = None if force_download else self._derived.get(key)
+				if bars is not None:
+					HISTORY_WEEKS.labels(self.broker.port, 'memo').inc()
+					parts.append((key, ws, bars))
+					continue
+
+			HISTORY_WEEKS.labels(self.broker.port, 'resampled').inc()
+			parts.append((key, ws, [
+				self._get_chunk(conid, self.base, chunk, force_download)
+				for chunk in getChunks(self.base, max(ws, start), min(next_ws, end), self.max_bars)
+			]))
+
+		return parts
+
+
+	def _get_bucket_range(self, period, start, end):
+		# Out to the buckets holding `start` and `end`
+		off = tl.period.getPeriodOffsetSeconds(period)
+		weeks = getWeeks(start, end)
+		first, last = weeks[0][0], weeks[-1][0]
+		return (
+			first + (start - first) // off * off,
+			last - (last - end) // off * off
+		)
+
+
+	def _prefetch(self, conid, period, start, end):
+		# Pages that carry on from the last one, forwards or backwards,
+		# fetch the next page of the same length
+		with self._lock:
+			last, self._last = self._last, (conid, period, start, end)
+
+		if not self.prefetch or last is None or last[:2] != (conid, period):
+			return
+
+		off = tl.period.getPeriodOffsetSeconds(period)
+		length = end - start
+		if abs(start - last[3]) <= off:
+			start, end = end, min(end + length, time.time())
+		elif abs(end - last[2]) <= off:
+			start, end = start - length, start
+		else:
+			return
+
+		if self.isDerived(period):
+			start, end = self._get_bucket_range(period, start, end)
+			period = self.base
+		for chunk in getChunks(period, start, end, self.max_bars):
+			if chunk[1] <= time.time():
+				self._get_chunk(conid, period, chunk, source='prefetch')
+
+
+	def _request_chunk(self, conid, period, chunk):
+		# Bars run back `period` from `startTime`
+		cs, ce = chunk
+		params = {
+			'conid': conid,
+			'bar': BARS[period],
+			'period': getPeriodParam(ce - cs),
+			'startTime': datetime.utcfromtimestamp(ce).strftime('%Y%m%d-%H:%M:%S'),
+			'outsideRth': 'true'
+		}
+		for attempt in range(self.retries + 1):
+			self._pace()
+			try:
+				res = self.broker._session.get(
+					self.broker._url + '/iserver/marketdata/history', params=params, timeout=30
+				)
+				if res.status_code == 200:
+					data = res.json().get('data') or []
+					bars = np.array(
+						[ (bar['t'] / 1000, bar['o'], bar['h'], bar['l'], bar['c']) for bar in data ],
+						dtype=np.float64
+					).reshape(-1, 5)
+					return bars[(bars[:, 0] >= cs) & (bars[:, 0] < ce)]
+
+				elif res.status_code != 429 and res.status_code < 500:
+					raise Exception(f'History request failed ({res.status_code}).')
+
+			except requests.exceptions.RequestException:
+				if attempt == self.retries:
+					raise
+
+			if attempt < self.retries:
+				HISTORY_RETRIES.labels(self.broker.port).inc()
+				time.sleep(0.5 * 2 ** attempt)
+
+		raise Exception(f'History request failed ({res.status_code}).')
+
+
+	def _pace(self):
+		if not self.rate:
+			return
+
+		with self._pace_lock:
+			now = time.monotonic()
+			wait = self._next_request - now
+			self._next_request = max(now, self._next_request) + 1 / self.rate
+		if wait > 0:
+			time.sleep(wait)
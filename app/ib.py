@@ -1,56 +1,61 @@
-import numpy as np
-import pandas as pd
+import re
 import time
 import os
-import ntplib
+import json
 import shortuuid
 import subprocess
 import requests
-import json
-import traceback
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from . import tradelib as tl
-from threading import Thread
+from .supervisor import GatewaySupervisor, AttachedProcess, getCmdline
+from .streaming import Subscription, SubscriptionRegistry, InstrumentFeed
+from .cache import ReadCache
+from .auth import AuthState, LOGGED_OUT, UNAUTHENTICATED, COMPETING, AUTHENTICATED
+from .gateway_socket import GatewaySocket
+from .planner import SessionPlanner, ReloginScheduler
+from .quotes import QuoteBoard
+from .pnl import PnLEngine
+from .orders import OrderTracker
+from .history import HistoryDownloader
+from .log import getLogger
+from . import metrics
+from threading import Thread, Lock, RLock, Event
 from datetime import datetime
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 GATEWAY_RUN_DIR = os.path.join(ROOT_DIR, 'clientportal.gw/bin/run.sh')
 GATEWAY_CONFIG_DIR = os.path.join(ROOT_DIR, 'clientportal.gw/root/conf.yaml')
+GATEWAY_MAIN = 'ibgroup.web.core.clientportal.gw.GatewayStart'
 CHROME_DRIVER_DIR = os.path.join(ROOT_DIR, 'chromedriver_linux64/chromedriver')
 FIREFOX_BINARY_DIR = os.path.join(ROOT_DIR, '/usr/bin/firefox/firefox')
 FIREFOX_DRIVER_DIR = os.path.join(ROOT_DIR, 'geckodriver-v0.30.0-linux64/geckodriver')
-
-
-class Subscription(object):
-
-	def __init__(self, broker, msg_id):
-		self.broker = broker
-		self.msg_id = msg_id
-
-
-	def onUpdate(self, *args):
-		print(f'ON UPDATE: {args}', flush=True)
-
-		self.broker.container.send_queue.append({
-			"type": "account",
-			"message": {
-				"msg_id": self.msg_id,
-				"result": {
-					"args": args,
-					"kwargs": {}
-				}
-			}
-		})
+GATEWAY_URL = os.environ.get('IB_GATEWAY_URL', 'https://localhost:{port}/v1/api')
+
+logger = getLogger(__name__)
+
+GATEWAY_REQUEST_LATENCY = metrics.Histogram(
+	'ib_gateway_request_seconds', 'Client Portal gateway request latency.', ('port',)
+)
+GATEWAY_RESPONSES = metrics.Counter(
+	'ib_gateway_responses_total', 'Client Portal gateway responses by status code.', ('port', 'status')
+)
+GATEWAY_ERRORS = metrics.Counter(
+	'ib_gateway_errors_total', 'Client Portal gateway requests that failed to connect.', ('port',)
+)
+LOGIN_DURATION = metrics.Histogram(
+	'ib_login_seconds', 'Browser login duration.', ('port',),
+	buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+)
+RECONNECTS = metrics.Counter(
+	'ib_reconnects_total', 'Gateway reconnects by type.', ('port', 'type')
+)
 
 
 class IB(object):
 
-	def __init__(self, port, user_id, strategy_id, broker_id, username, password):
-		print(f'IB INIT: {port}, {user_id}, {username}, {password}', flush=True)
+	def __init__(self, container, port, user_id, strategy_id, broker_id, username, password, gateway_pid=None):
+		logger.info('[IB] Init %s, %s, %s', port, user_id, username)
 
+		self.container = container
 		self.port = port
 
 		self.userId = user_id
@@ -59,101 +64,258 @@ class IB(object):
 		self.username = username
 		self.password = password
 
-		self._url = f'https://localhost:{self.port}/v1/api'
+		self._url = GATEWAY_URL.format(port=self.port)
 		self._session = requests.session()
+		self._session.verify = False
+		self._session.hooks['response'].append(self._on_gateway_response)
 		self.accounts = []
+		self._cache = ReadCache(container.cache_ttl if container is not None else None)
+
+		self._gui_subscriptions = SubscriptionRegistry()
+		self._pnl_subscriptions = SubscriptionRegistry()
+		self._chart_feeds = {}
+		self._chart_feeds_lock = RLock()
+
+		# Set once the gateway is running and while its session is valid
+		self._is_gateway_loaded = Event()
+		self._logged_in = Event()
+		self._auth = AuthState(self.port, self._on_auth_change)
+		self._recover_lock = Lock()
+		self._missing_credentials = False
+		self._session_id = None
+		self._selected_account = None
+		self.driver = None
+
+		self._running = True
+		self._gateway_process = None
+		self._gateway_lock = RLock()
+		self._supervisor = GatewaySupervisor(self)
+		session = (container.session_config if container is not None else None) or {}
+		self._planner = SessionPlanner(
+			self.port,
+			keepalive=session.get('keepalive', 30),
+			margin=session.get('relogin_margin', 300),
+			spread=session.get('relogin_spread', 600),
+			lifetime=session.get('session_lifetime', 3600)
+		)
+		self._relogins = container.relogins if container is not None else ReloginScheduler()
+		self._socket = GatewaySocket(
+			self, re.sub(r'^http', 'ws', self._url) + '/ws', on_open=self._on_socket_open
+		)
+		self._socket.on('sts', self._on_socket_status)
+		self._socket.on('system', self._on_socket_system)
+		self._quotes = QuoteBoard(self, listener=self._on_quote)
+		self._socket.on('smd', self._quotes.onMarketData)
+		self._pnl = PnLEngine(self)
+		self._socket.on('spl', self._pnl.onAccountUpdate)
+		self._socket.subscribe('spl', 'spl+{}')
+		self._orders = OrderTracker(self, listener=self._on_order_events)
+		self._socket.on('sor', self._orders.onOrderUpdate)
+		self._socket.subscribe('sor', 'sor+{}')
+		self._history = HistoryDownloader(
+			self, **((container.history_config if container is not None else None) or {})
+		)
 
-		self._gui_subscriptions = []
+		# A gateway left running by an earlier run is reused, and so is its
+		# session while it's still valid. Starting the gateway and logging
+		# in take seconds, so they carry on in the background and readiness
+		# shows in `_is_gateway_loaded` and `_logged_in`
+		attached = gateway_pid is not None and self._attach_gateway(gateway_pid)
+		t = Thread(target=self._run, args=(attached,))
+		t.start()
 
-		self._is_gateway_loaded = False
-		self._logged_in = False
-		self._iserver_auth = False
-		self._selected_account = None
 
-		self._start_gateway()
-		self._create_webdriver()
-		self.standardReconnect()
+	def _run(self, attached):
+		# The gateway start is retried until it's up. A failed login is
+		# left to `_recover`, which `_periodic_check` starts until the
+		# session authenticates
+		backoff = 1
+		while self._running and not self._is_gateway_loaded.is_set():
+			try:
+				self._start_gateway()
+			except Exception:
+				logger.exception('[_run] (%s) Failed to start gateway, retrying in %ss', self.port, backoff)
+				time.sleep(backoff)
+				backoff = min(backoff * 2, 60)
 
-		# if self.port != '5000':
-		t = Thread(target=self._periodic_check)
-		t.start()
+		try:
+			if self._running and not (attached and self._resume_session()):
+				self.standardReconnect()
+		except Exception:
+			logger.exception('[_run] (%s) Failed to log in, recovering', self.port)
 
+		if self._running:
+			self._socket.start()
+			self._periodic_check()
 
-	def _periodic_check(self):
-		c_time = time.time()
-		relogin_time = time.time()
-		reauth_time = time.time()
-		while True:
-			if time.time() - c_time >= 10:
-				c_time = time.time()
-				if time.time() - relogin_time >= 60*60:
-					relogin_time = time.time()
-					print("[_periodic_check] RELOGGING IN...", flush=True)
-					self.standardReconnect()
-
-				res = requests.get(self._url + "/sso/validate", verify=False)
-				if res.status_code == 200:
-					data = res.json()
-					print(f"[_periodic_check] {time.time()} ({res.status_code}) {data}\n", flush=True)
-
-				res = requests.post(self._url + "/tickle", verify=False)
-				if res.status_code == 200:
-					data = res.json()
-					print(f"[_periodic_check] {time.time()} ({res.status_code}) {data}\n", flush=True)
-					try:
-						if (time.time() - reauth_time >= 60*20 or 
-							not data["iserver"]["authStatus"]["authenticated"] or 
-							data["iserver"]["authStatus"]["competing"]):
-
-							reauth_time = time.time()
-							if data["iserver"]["authStatus"]["competing"]:
-								self.restartReconnect()
-							else:
-								self.standardReconnect()
 
-					except Exception:
-						print(f"[_periodic_check] {traceback.format_exc()}\n", flush=True)
-						
-				elif res.status_code == 401:
-					c_time = time.time() - 31
-					print(f"[_periodic_check] {time.time()} ({res.status_code}) Unauthorized\n", flush=True)
-					self.standardReconnect()
-				else:
-					c_time = time.time() - 31
-					print(f"[_periodic_check] {time.time()} ({res.status_code}) Failed\n", flush=True)
+	def _periodic_check(self):
+		# Tickle keeps the session alive and backs up the websocket's
+		# status messages. Reauths are driven by `_on_auth_change`,
+		# relogins by the session expiry the gateway reports
+		while self._running:
+			time.sleep(1)
+			# Recovery otherwise only starts on a state change, which a
+			# session that never authenticated doesn't make
+			if self._auth.state != AUTHENTICATED:
+				self._start_recovery()
+
+			if self._planner.reloginDue():
+				logger.info('[_periodic_check] (%s) Session expiring, relogging in...', self.port)
+				self.standardReconnect()
+
+			if not self._planner.keepaliveDue():
+				continue
+
+			try:
+				res = self._session.post(self._url + "/tickle", timeout=10)
+			except requests.exceptions.RequestException:
+				GATEWAY_ERRORS.labels(self.port).inc()
+				logger.warning('[_periodic_check] (%s) Gateway unreachable', self.port)
+				self._supervisor.onHealthCheck(False)
+				self._planner.onKeepalive(False)
+				continue
+
+			self._supervisor.onHealthCheck(res.status_code < 500)
+			if res.status_code == 200:
+				data = res.json()
+				logger.debug('[_periodic_check] (%s) Tickle (%s) %s', self.port, res.status_code, data)
+				self._planner.onKeepalive(True)
+				self._planner.onExpiry(data.get('ssoExpires'))
+				self._session_id = data.get('session')
+				self._set_logged_in(True)
+
+				status = data.get('iserver', {}).get('authStatus', {})
+				self._auth.update(
+					authenticated=status.get('authenticated'),
+					competing=status.get('competing'),
+					source='tickle'
+				)
+
+			elif res.status_code == 401:
+				logger.warning('[_periodic_check] (%s) Tickle (%s) Unauthorized', self.port, res.status_code)
+				self._planner.onKeepalive(True)
+				self._set_logged_in(False)
+				self._start_recovery()
+			else:
+				logger.warning('[_periodic_check] (%s) Tickle (%s) Failed', self.port, res.status_code)
+				self._planner.onKeepalive(False)
 
 
 	def standardReconnect(self):
-		print(f"[standardReconnect] {time.time()}", flush=True)
-		self.login()
-		# res = requests.post(self._url + "/iserver/reauthenticate", verify=False)
-		res = requests.get(self._url + "/sso/validate", verify=False)
-		print(f"[standardReconnect] ({res.status_code}) Validate. {res.json()}\n", flush=True)
-		requests.post(self._url + "/iserver/reauthenticate", verify=False)
-		if res.status_code == 200:
-			checks = 0
-			time.sleep(1)
-			res = requests.post(self._url + "/iserver/auth/status", verify=False)
-			while not res.json()["authenticated"]:
-				print(f"[standardReconnect] ({res.status_code}) Reauthenticated. {res.json()}\n", flush=True)
+		if not self._has_credentials():
+			return
+
+		with self._gateway_lock:
+			logger.info('[standardReconnect] (%s) Reconnecting...', self.port)
+			RECONNECTS.labels(self.port, 'standard').inc()
+			self._planner.onLoginAttempt()
+			with self._relogins:
+				with metrics.Timer(LOGIN_DURATION.labels(self.port)):
+					self.login()
+			res = self._session.get(self._url + "/sso/validate")
+			self._set_logged_in(res.status_code == 200)
+			logger.info('[standardReconnect] (%s) Validate (%s)', self.port, res.status_code)
+			if res.status_code == 200:
+				self._planner.onLogin()
+				self._planner.onExpiry(res.json().get('EXPIRES'))
+				self.authIServer(timeout=6)
 
-				if checks >= 5:
-					print(f"[standardReconnect] Not Authenticated!.\n", flush=True)
-					return
 
-				checks += 1
-				time.sleep(1)
-				res = requests.post(self._url + "/iserver/auth/status", verify=False)
-			
-			print(f"[standardReconnect] Authenticated!.\n", flush=True)
+	def setCredentials(self, username, password):
+		# Users restored from the registry have none until the broker adds
+		# them again, which it does once find_user stops finding them
+		self.username = username
+		self.password = password
+		self._missing_credentials = False
+		self._start_recovery()
+
+
+	def _has_credentials(self):
+		# Without them nothing can log in, so recovery waits for
+		# `setCredentials`. Warned about once, not on every check
+		if self.password is not None:
+			return True
+
+		if not self._missing_credentials:
+			self._missing_credentials = True
+			logger.warning('[IB] (%s) No credentials, waiting for add_user', self.port)
+		return False
 
 
 	def restartReconnect(self):
-		print(f"[restartReconnect] {time.time()}", flush=True)
-		res = requests.post(self._url + "/logout", verify=False)
-		self._stop_gateway()
-		self._start_gateway()
-		self.standardReconnect()
+		logger.info('[restartReconnect] (%s) Restarting gateway...', self.port)
+		RECONNECTS.labels(self.port, 'restart').inc()
+		with self._gateway_lock:
+			res = self._session.post(self._url + "/logout")
+			self._stop_gateway()
+			self._cache.clear()
+			self._quotes.clear()
+			self._orders.clear()
+			self._start_gateway()
+			self.standardReconnect()
+			self._resubscribe()
+
+
+	def _resubscribe(self):
+		for sub in self._gui_subscriptions:
+			sub.onUpdate('gateway_restarted')
+
+
+	def getGatewayStats(self):
+		stats = self._supervisor.getStats()
+		stats.update(self._planner.getStats())
+		return stats
+
+
+	def getGatewayRSS(self):
+		if self._gateway_process is not None:
+			return metrics.getRSS(self._gateway_process.pid)
+
+
+	def getBufferedUpdates(self):
+		# Streaming updates waiting to be published, over every subscription
+		with self._chart_feeds_lock:
+			feeds = list(self._chart_feeds.values())
+		return (
+			sum(sub.pending() for sub in self._gui_subscriptions)
+			+ sum(sub.pending() for sub in self._pnl_subscriptions)
+			+ sum(sub.pending() for feed in feeds for sub in feed.subscribers)
+		)
+
+
+	def getChromeRSS(self):
+		try:
+			pid = self.driver.service.process.pid
+		except AttributeError:
+			return None
+
+		return sum(
+			metrics.getRSS(i) or 0
+			for i in [pid] + metrics.getDescendants(pid)
+		)
+
+
+	def stop(self):
+		self._running = False
+		self._supervisor.stop()
+		self._socket.stop()
+		self._history.stop()
+		self._gui_subscriptions.clear()
+		self._pnl_subscriptions.clear()
+		with self._chart_feeds_lock:
+			for feed in self._chart_feeds.values():
+				feed.subscribers.clear()
+			self._chart_feeds.clear()
+		with self._gateway_lock:
+			self._stop_gateway()
+
+		if self.driver is None:
+			return
+		try:
+			self.driver.quit()
+		except Exception:
+			logger.exception('[stop] (%s) Failed to quit webdriver', self.port)
 
 
 
@@ -222,16 +384,63 @@ class IB(object):
 
 
 	def _start_gateway(self):
-		print(f'GATEWAY: {[ GATEWAY_RUN_DIR, GATEWAY_CONFIG_DIR, self.port ]}', flush=True)
+		logger.info('[_start_gateway] (%s) %s %s', self.port, GATEWAY_RUN_DIR, GATEWAY_CONFIG_DIR)
+		# Its own session, so the gateway outlives a client restart
 		self._gateway_process = subprocess.Popen(
-			[ GATEWAY_RUN_DIR, GATEWAY_CONFIG_DIR, str(self.port) ]
+			[ GATEWAY_RUN_DIR, GATEWAY_CONFIG_DIR, str(self.port) ],
+			start_new_session=True
 		)
+		self._supervisor.watch(self._gateway_process)
+		if self.container is not None:
+			self.container.saveRegistry()
 
 		time.sleep(2)
+		self._is_gateway_loaded.set()
 		return { 'complete': True }
 
 
+	def _attach_gateway(self, pid):
+		# run.sh execs java, so the recorded pid is the JVM. Pids get
+		# reused, so it must still be running this port's gateway
+		args = [ GATEWAY_MAIN, '-port', str(self.port) ]
+		cmdline = getCmdline(pid)
+		if cmdline is None or cmdline[-len(args):] != args:
+			logger.info('[_attach_gateway] (%s) Gateway %s is gone', self.port, pid)
+			return False
+
+		logger.info('[_attach_gateway] (%s) Reattached to gateway %s', self.port, pid)
+		self._gateway_process = AttachedProcess(pid)
+		self._supervisor.watch(self._gateway_process)
+		self._is_gateway_loaded.set()
+		return True
+
+
+	def _resume_session(self):
+		try:
+			res = self._session.get(self._url + "/sso/validate", timeout=10)
+		except requests.exceptions.RequestException:
+			GATEWAY_ERRORS.labels(self.port).inc()
+			logger.warning('[_resume_session] (%s) Gateway unreachable', self.port)
+			return False
+
+		logger.info('[_resume_session] (%s) Validate (%s)', self.port, res.status_code)
+		if res.status_code != 200:
+			return False
+
+		RECONNECTS.labels(self.port, 'resume').inc()
+		self._set_logged_in(True)
+		self._planner.onLogin()
+		self._planner.onExpiry(res.json().get('EXPIRES'))
+		self.authIServer(timeout=6)
+		return True
+
+
 	def _stop_gateway(self):
+		if self._gateway_process is None:
+			return
+
+		self._is_gateway_loaded.clear()
+		self._supervisor.expectExit(self._gateway_process)
 		self._gateway_process.terminate()
 
 		try:
@@ -241,7 +450,11 @@ class IB(object):
 
 
 	def _create_webdriver(self):
-		print("[_create_webdriver] Starting webdriver...", flush=True)
+		# Only needed to log in, and slow to import
+		from selenium import webdriver
+		from selenium.webdriver.chrome.options import Options
+
+		logger.info('[_create_webdriver] Starting webdriver...')
 		chrome_options = Options()
 
 		chrome_options.add_argument("--headless")
@@ -255,7 +468,7 @@ class IB(object):
 		# chrome_options.add_argument("--remote-debugging-port=9222")
 
 		self.driver = webdriver.Chrome(options=chrome_options)
-		print(f"[_create_webdriver] DRIVER DONE {self.driver}", flush=True)
+		logger.info('[_create_webdriver] Started %s', self.driver)
 
 		# profile = webdriver.FirefoxProfile()
 		# profile.accept_untrusted_certs = True
@@ -275,8 +488,10 @@ class IB(object):
 
 	def login(self):
 
-		print("[login] Logging in...", flush=True)
-		start_url = f"https://localhost:{self.port}"
+		logger.info('[login] (%s) Logging in...', self.port)
+		if self.driver is None:
+			self._create_webdriver()
+		start_url = self._url.split('/v1/api')[0]
 		self.driver.get(start_url)
 
 		inputElement = self.driver.find_element_by_id("user_name")
@@ -292,13 +507,13 @@ class IB(object):
 			pre_tags = self.driver.find_elements_by_css_selector('pre')
 			if len(pre_tags):
 				if pre_tags[0].get_attribute('innerHTML') == "Client login succeeds":
-					print("[login] LOGGED IN", flush=True)
+					logger.info('[login] (%s) Logged in', self.port)
 					break
 
 			error_msg = self.driver.find_elements_by_id("ERRORMSG")
 			if len(error_msg):
 				if error_msg[0].get_attribute('innerHTML') == "Invalid username password combination":
-					print(f"[login] FAILED TO LOGIN", flush=True)
+					logger.error('[login] (%s) Failed to login', self.port)
 					break
 
 			if checks >= 5:
@@ -309,21 +524,38 @@ class IB(object):
 
 	def isLoggedIn(self):
 		ept = '/sso/validate'
-		print(f'[isLoggedIn] {self._url + ept}', flush=True)
 		res = self._session.get(self._url + ept)
 
-		print(f'[isLoggedIn] (1) {res.status_code} {res.text}', flush=True)
+		logger.debug('[isLoggedIn] (%s) %s', self.port, res.status_code)
 		if res.status_code == 200:
-			data = res.json()
-			print(f'[isLoggedIn] (2) {data}', flush=True)
-			self._logged_in = True
+			self._planner.onExpiry(res.json().get('EXPIRES'))
+			self._set_logged_in(True)
 			return { 'result': True }
 		else:
-			print(f'[isLoggedIn] (3)', flush=True)
-			self._logged_in = False
+			self._set_logged_in(False)
 			return { 'result': False }
 
 
+	def _on_gateway_response(self, res, *args, **kwargs):
+		GATEWAY_REQUEST_LATENCY.labels(self.port).observe(res.elapsed.total_seconds())
+		GATEWAY_RESPONSES.labels(self.port, res.status_code).inc()
+		clock = self.container.clock if self.container is not None else None
+		if clock is not None:
+			clock.onGatewayResponse(res.elapsed.total_seconds())
+
+
+	def _set_logged_in(self, logged_in):
+		if self._logged_in.is_set() != logged_in:
+			if logged_in:
+				self._logged_in.set()
+			else:
+				self._logged_in.clear()
+			if self.container is not None:
+				self.container.onLoginStateChange(self, logged_in)
+
+		self._auth.update(logged_in=logged_in, source='validate')
+
+
 	def _send_response(self, msg_id, res):
 		res = {
 			'msg_id': msg_id,
@@ -337,7 +569,7 @@ class IB(object):
 				namespace='/broker'
 			)
 		except Exception:
-			print(traceback.format_exc(), flush=True)
+			logger.exception('[_send_response] Failed to send %s', msg_id)
 
 
 	def replace(self, user_id, strategy_id, broker_id):
@@ -351,17 +583,24 @@ class IB(object):
 		start=None, end=None, count=None,
 		force_download=False
 	):
-		return
+		return self._history.download(
+			product, period, start=start, end=end, count=count,
+			force_download=force_download
+		)
 
 
 	def _get_all_positions(self, account_id):
+		return self._cache.get('positions', account_id, lambda: self._request_all_positions(account_id))
+
+
+	def _request_all_positions(self, account_id):
 		ept = f'/portfolio/{account_id}/positions/0'
-		print(f'[_get_all_positions] {ept}', flush=True)
+		logger.debug('[_get_all_positions] %s', ept)
 		res = self._session.get(self._url + ept)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[_get_all_positions] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[_get_all_positions] %s', data)
 			
 
 			return {}
@@ -390,13 +629,14 @@ class IB(object):
 		}
 
 		ept = f'/iserver/account/{account_id}/order'
-		print(f'[createPosition] {ept}', flush=True)
+		logger.debug('[createPosition] %s', ept)
 		res = self._session.post(self._url + ept)
-		print(f'[createPosition] ({res.status_code}) {res.text}', flush=True)
+		logger.debug('[createPosition] (%s)', res.status_code)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[createPosition] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[createPosition] %s', data)
+			self._on_account_event(account_id)
 
 			return {}
 		else:
@@ -415,12 +655,13 @@ class IB(object):
 		}
 
 		ept = f'/iserver/account/{account_id}/order/{order_id}'
-		print(f'[modifyPosition] {ept}', flush=True)
+		logger.debug('[modifyPosition] %s', ept)
 		res = self._session.post(self._url + ept)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[modifyPosition] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[modifyPosition] %s', data)
+			self._on_account_event()
 
 			return {}
 		else:
@@ -435,12 +676,13 @@ class IB(object):
 		}
 
 		ept = f'/iserver/account/{account_id}/order/{order_id}'
-		print(f'[deletePosition] {ept}', flush=True)
+		logger.debug('[deletePosition] %s', ept)
 		res = self._session.delete(self._url + ept)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[deletePosition] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[deletePosition] %s', data)
+			self._on_account_event()
 
 			return {}
 		else:
@@ -449,39 +691,172 @@ class IB(object):
 
 
 	def _get_all_orders(self, account_id):
-		return
+		return {
+			'orders': self._orders.getOrders(account_id)
+		}
 
 
 	def authIServer(self, timeout=30):
-		print('Authenticating IServer', flush=True)
+		with self._gateway_lock:
+			if self._auth.state == AUTHENTICATED:
+				return True
+
+			logger.info('[authIServer] (%s) Authenticating IServer...', self.port)
+			self._session.post(self._url + '/iserver/reauthenticate', timeout=5)
+			self._check_auth_status()
+
+			if self._wait_authenticated(timeout):
+				logger.info('[authIServer] (%s) Authenticated IServer', self.port)
+				return True
+			else:
+				logger.warning('[authIServer] (%s) Not authenticated', self.port)
+				return False
+
+
+	def _wait_authenticated(self, timeout):
+		# The websocket's `sts` message wakes this as soon as the brokerage
+		# session comes up. The status endpoint is only checked, with
+		# backoff, in case the socket is down or the message is missed
+		deadline = time.time() + timeout
+		delay = 0.5
+		while True:
+			remaining = deadline - time.time()
+			if self._auth.wait(AUTHENTICATED, min(delay, max(remaining, 0))):
+				return True
+			if remaining <= 0 or not self._running:
+				return False
 
-		ept = '/iserver/reauthenticate?force=True'
-		res = self._session.get(self._url + ept, timeout=5)
+			self._check_auth_status()
+			delay = min(delay * 2, 5)
 
-		ept = '/iserver/auth/status'
-		start_time = time.time()
-		while time.time() - start_time < timeout:
-			res = self._session.get(self._url + ept)
-			if res.status_code == 200:
-				data = res.json()
-				if data.get('authenticated'):
-					self._iserver_auth = True
-					print('Authenticating IServer Complete', flush=True)
-					break
-			time.sleep(1)
+
+	def _check_auth_status(self):
+		try:
+			res = self._session.post(self._url + '/iserver/auth/status', timeout=5)
+		except requests.exceptions.RequestException:
+			return
+
+		if res.status_code == 200:
+			data = res.json()
+			self._auth.update(
+				authenticated=data.get('authenticated'),
+				competing=data.get('competing'),
+				source='auth_status'
+			)
+
+
+	def _on_auth_change(self, old, new):
+		if new == LOGGED_OUT:
+			self._cache.clear()
+
+		if new != AUTHENTICATED:
+			self._start_recovery()
+
+
+	def _start_recovery(self):
+		# A brokerage reauth needs no login, anything else does
+		if self._auth.state != UNAUTHENTICATED and not self._has_credentials():
+			return
+
+		if self._running and not self._recover_lock.locked():
+			t = Thread(target=self._recover, daemon=True)
+			t.start()
+
+
+	def _recover(self):
+		# One recovery at a time per user, retried with backoff until
+		# authenticated. Each step re-checks the state, so recoveries
+		# queued behind a reconnect find nothing left to do
+		if not self._recover_lock.acquire(blocking=False):
+			return
+
+		try:
+			backoff = 1
+			while self._running:
+				try:
+					with self._gateway_lock:
+						state = self._auth.state
+						if state == AUTHENTICATED:
+							return
+
+						if state != UNAUTHENTICATED and not self._has_credentials():
+							return
+
+						logger.info('[_recover] (%s) Recovering from %s', self.port, state)
+						if state == COMPETING:
+							self.restartReconnect()
+						elif state == UNAUTHENTICATED:
+							# Reauth alone is retried with backoff until
+							# there are credentials to log in with
+							if not self.authIServer(timeout=10) and self._has_credentials():
+								self.standardReconnect()
+						else:
+							self.standardReconnect()
+
+				except Exception:
+					logger.exception('[_recover] (%s) Recovery attempt failed, retrying in %ss', self.port, backoff)
+
+				if self._auth.wait(AUTHENTICATED, backoff):
+					return
+				backoff = min(backoff * 2, 60)
+
+		finally:
+			self._recover_lock.release()
+
+
+	def _on_socket_open(self):
+		if self._session_id:
+			self._socket.send(json.dumps({ 'session': self._session_id }))
+
+		# Catch up on anything missed while the socket was down
+		t = Thread(target=self._orders.sync, daemon=True)
+		t.start()
+
+
+	def _on_order_events(self, events):
+		for sub in self._gui_subscriptions:
+			sub.onUpdate(events)
+
+		if len(self._pnl_subscriptions):
+			self._publish_pnl(account_ids=set(event['item'].get('account_id') for event in events.values()))
+
+
+	def _on_socket_status(self, data):
+		args = data.get('args') or {}
+		self._auth.update(
+			authenticated=args.get('authenticated'),
+			competing=args.get('competing'),
+			source='sts'
+		)
+
+
+	def _on_socket_system(self, data):
+		# `success` carries the username once the socket is authorized,
+		# `hb` is a heartbeat every 10 seconds
+		if 'success' in data:
+			self._set_logged_in(True)
+		elif 'hb' in data:
+			self._supervisor.onHealthCheck(True)
 
 
 	def getAllAccounts(self):
-		self.authIServer()
+		# The brokerage session is kept alive by `_periodic_check`, only
+		# authenticate here if it has been lost
+		if self._auth.state != AUTHENTICATED:
+			self.authIServer()
 
+		return self._cache.get('accounts', None, self._request_all_accounts)
+
+
+	def _request_all_accounts(self):
 		ept = '/portfolio/accounts'
-		print(f'[getAllAccounts] {self._url + ept}', flush=True)
+		logger.debug('[getAllAccounts] %s', ept)
 		res = self._session.get(self._url + ept)
-		print(f'[getAllAccounts] {res.status_code}, {res.text}', flush=True)
+		logger.debug('[getAllAccounts] (%s)', res.status_code)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[getAllAccounts] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[getAllAccounts] %s', data)
 			# self.accounts = data['accounts']
 			# self._selected_account = data['selectedAccount']
 			res = { 'accounts': [] }
@@ -495,10 +870,20 @@ class IB(object):
 
 
 	def getAccountInfo(self, account_id):
+		result = self._cache.get('summary', account_id, lambda: self._request_account_info(account_id))
+
+		# Streamed `spl` P&L is fresher than the cached summary
+		pnl = self._pnl.getAccount(account_id)
+		if pnl is not None and 'upl' in pnl and account_id in result:
+			result = { account_id: dict(result[account_id], pl=pnl['upl']) }
+		return result
+
+
+	def _request_account_info(self, account_id):
 		ept = f'/portfolio/{account_id}/summary'
-		print(f'[getAccountInfo] {ept}', flush=True)
+		logger.debug('[getAccountInfo] %s', ept)
 		res = self._session.get(self._url + ept)
-		print(f'[getAccountInfo] {res.status_code} {res.text}', flush=True)
+		logger.debug('[getAccountInfo] (%s)', res.status_code)
 		
 		if res.status_code == 200:
 			data = res.json()
@@ -538,12 +923,13 @@ class IB(object):
 		}
 
 		ept = f'/iserver/account/{account_id}/order'
-		print(f'[createOrder] {ept}', flush=True)
+		logger.debug('[createOrder] %s', ept)
 		res = self._session.post(self._url + ept)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[createOrder] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[createOrder] %s', data)
+			self._on_account_event(account_id)
 			
 
 			return {}
@@ -563,12 +949,13 @@ class IB(object):
 		}
 
 		ept = f'/iserver/account/{account_id}/order/{order_id}'
-		print(f'[modifyOrder] {ept}', flush=True)
+		logger.debug('[modifyOrder] %s', ept)
 		res = self._session.post(self._url + ept)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[modifyOrder] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[modifyOrder] %s', data)
+			self._on_account_event()
 			
 
 			return {}
@@ -584,12 +971,13 @@ class IB(object):
 		}
 
 		ept = f'/iserver/account/{account_id}/order/{order_id}'
-		print(f'[deleteOrder] {ept}', flush=True)
+		logger.debug('[deleteOrder] %s', ept)
 		res = self._session.delete(self._url + ept)
 		
 		if res.status_code == 200:
 			data = res.json()
-			print(f'[deleteOrder] {json.dumps(data, indent=2)}', flush=True)
+			logger.debug('[deleteOrder] %s', data)
+			self._on_account_event()
 			
 
 			return {}
@@ -598,5 +986,106 @@ class IB(object):
 			return res
 
 
+	def _on_account_event(self, account_id=None):
+		# Order changes and account updates make cached reads stale
+		self._cache.invalidate(account_id)
+
+
+	def getBid(self, product):
+		return self._quotes.getBid(product)
+
+
+	def getAsk(self, product):
+		return self._quotes.getAsk(product)
+
+
+	def getQuotes(self, products):
+		return self._quotes.refresh(products)
+
+
+	def getProfit(self, account_id=None, positions=None):
+		# The open positions tracked from `sor`, unless given
+		if positions is None:
+			positions = self._orders.getPositions(account_id)
+		return self._pnl.compute(positions)
+
+
+	def _publish_pnl(self, account_ids=None, product=None):
+		# Subscribed accounts' P&L, for those the change may affect
+		for sub in self._pnl_subscriptions:
+			account_id = sub.instrument
+			if account_ids is not None and account_id not in account_ids:
+				continue
+
+			positions = self._orders.getPositions(account_id)
+			if product is not None and not any(pos['product'] == product for pos in positions):
+				continue
+			try:
+				sub.onUpdate(self.getProfit(positions=positions), key=account_id)
+			except Exception:
+				logger.exception('[_publish_pnl] (%s) Failed to price %s', self.port, account_id)
+
+
+	def _on_quote(self, product, quote):
+		recorder = self.container.recorder if self.container is not None else None
+		if recorder is not None:
+			recorder.record(self._quotes.getConid(product), quote)
+
+		feed = self._chart_feeds.get(product)
+		if feed is not None:
+			feed.onUpdate(quote, key=product)
+
+		if len(self._pnl_subscriptions):
+			self._publish_pnl(product=product)
+
+
 	def _subscribe_gui_updates(self, msg_id):
-		self._gui_subscriptions.append(Subscription(self, msg_id))
+		self._gui_subscriptions.add(Subscription(self, msg_id))
+
+
+	def _subscribe_pnl_updates(self, msg_id, account_id):
+		# Conflated like quotes, only the account's latest P&L matters. Sent
+		# now, then whenever its positions change or one of them is quoted
+		self._pnl_subscriptions.add(Subscription(self, msg_id, account_id, conflate=True))
+		self._publish_pnl(account_ids={ account_id })
+		return {
+			'completed': True
+		}
+
+
+	def _subscribe_chart_updates(self, msg_id, instrument):
+		with self._chart_feeds_lock:
+			feed = self._chart_feeds.get(instrument)
+			if feed is None:
+				feed = self._chart_feeds[instrument] = InstrumentFeed(self, instrument)
+
+			# Quotes only matter latest first, a slow consumer gets the
+			# newest one per product rather than a backlog
+			feed.add(Subscription(self, msg_id, instrument, conflate=True))
+			self._quotes.subscribe(instrument)
+
+
+	def _release_quotes(self, instrument):
+		# The last chart feed for `instrument` is gone. Its quotes keep
+		# streaming while a tracked position still needs them for P&L,
+		# otherwise the gateway stream is closed, and reads snapshot and
+		# stream it again
+		if any(pos['product'] == instrument for pos in self._orders.getPositions()):
+			return
+		self._quotes.unsubscribe(instrument)
+
+
+	def _unsubscribe(self, msg_id):
+		removed = self._gui_subscriptions.remove(msg_id) is not None
+		removed = self._pnl_subscriptions.remove(msg_id) is not None or removed
+		with self._chart_feeds_lock:
+			for instrument, feed in list(self._chart_feeds.items()):
+				if feed.remove(msg_id) is not None:
+					removed = True
+					if not len(feed):
+						del self._chart_feeds[instrument]
+						self._release_quotes(instrument)
+
+		return {
+			'completed': removed
+		}
@@ -0,0 +1,134 @@
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+
+REDACTED = '********'
+SECRET_KEYS = ('password', 'passwd', 'secret', 'token', 'cookie', 'authorization')
+SECRET_PATTERN = re.compile(
+	r'''(["']?(?:%s)["']?\s*[:=]\s*)(["']?)[^"',\s}]+''' % '|'.join(SECRET_KEYS),
+	re.IGNORECASE
+)
+
+_listener = None
+
+
+def getLogger(name):
+	return logging.getLogger(name)
+
+
+def redact(value):
+	if isinstance(value, dict):
+		return {
+			k: (REDACTED if isinstance(k, str) and k.lower() in SECRET_KEYS else redact(v))
+			for k, v in value.items()
+		}
+	elif isinstance(value, (list, tuple)):
+		return type(value)(redact(i) for i in value)
+	elif isinstance(value, str):
+		return SECRET_PATTERN.sub(r'\1\2' + REDACTED, value)
+	return value
+
+
+class RedactingFilter(logging.Filter):
+
+	def filter(self, record):
+		# Runs on the listener thread, after the record has been queued,
+		# so redaction never costs the caller anything
+		record.msg = redact(record.getMessage())
+		record.args = None
+		return True
+
+
+class JsonFormatter(logging.Formatter):
+
+	RESERVED = set(logging.makeLogRecord({}).__dict__) | { 'message', 'asctime' }
+
+	def format(self, record):
+		res = {
+			'time': record.created,
+			'level': record.levelname,
+			'logger': record.name,
+			'thread': record.threadName,
+			'message': record.getMessage()
+		}
+		for k, v in record.__dict__.items():
+			if k not in self.RESERVED:
+				res[k] = v
+
+		if record.exc_text:
+			res['exc_info'] = record.exc_text
+
+		return json.dumps(redact(res), default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+
+	def __init__(self, log_queue):
+		super().__init__(log_queue)
+		self.dropped = 0
+
+
+	def enqueue(self, record):
+		# Drop rather than block the caller when the listener falls behind
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+
+	def prepare(self, record):
+		# Formatted here, as the stdlib handler does: args are often live
+		# dicts and lists that may change before the listener gets to them.
+		# Disabled levels never get this far, and redaction and output
+		# still happen on the listener
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+
+def setup(config=None):
+	global _listener
+
+	if _listener is not None:
+		return
+
+	config = config or {}
+	level = os.environ.get('LOG_LEVEL', config.get('level', 'INFO'))
+	fmt = os.environ.get('LOG_FORMAT', config.get('format', 'text'))
+
+	stream = logging.StreamHandler(sys.stdout)
+	if fmt == 'json':
+		stream.setFormatter(JsonFormatter())
+	else:
+		stream.setFormatter(logging.Formatter(
+			'%(asctime)s %(levelname)s [%(name)s] %(message)s'
+		))
+	stream.addFilter(RedactingFilter())
+
+	log_queue = queue.Queue(config.get('queue_size', 10000))
+	root = logging.getLogger()
+	root.handlers = [LazyQueueHandler(log_queue)]
+	root.setLevel(level)
+
+	for name, module_level in config.get('levels', {}).items():
+		logging.getLogger(name).setLevel(module_level)
+
+	_listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+	_listener.start()
+	atexit.register(shutdown)
+
+
+def shutdown():
+	global _listener
+
+	if _listener is not None:
+		_listener.stop()
+		_listener = None
@@ -0,0 +1,274 @@
+import os
+import time
+import bisect
+from threading import Thread, Lock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .log import getLogger
+
+logger = getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+	0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+	0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=None):
+	pairs = list(zip(labelnames, values))
+	if extra is not None:
+		pairs.append(extra)
+	if not pairs:
+		return ''
+
+	return '{' + ','.join(
+		'%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+		for k, v in pairs
+	) + '}'
+
+
+class _CounterValue(object):
+
+	def __init__(self):
+		self._lock = Lock()
+		self.value = 0
+
+
+	def inc(self, amount=1):
+		with self._lock:
+			self.value += amount
+
+
+class _GaugeValue(_CounterValue):
+
+	def set(self, value):
+		self.value = value
+
+
+	def dec(self, amount=1):
+		self.inc(-amount)
+
+
+class _HistogramValue(object):
+
+	def __init__(self, buckets):
+		self._lock = Lock()
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+
+
+	def observe(self, value):
+		i = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			self.counts[i] += 1
+			self.sum += value
+
+
+class Metric(object):
+
+	kind = None
+
+	def __init__(self, name, documentation, labelnames=(), register=True):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self._children = {}
+		self._lock = Lock()
+
+		if register:
+			_registry.append(self)
+
+
+	def labels(self, *values):
+		child = self._children.get(values)
+		if child is None:
+			with self._lock:
+				child = self._children.setdefault(values, self._new_child())
+		return child
+
+
+	def remove(self, *values):
+		with self._lock:
+			self._children.pop(values, None)
+
+
+	def _new_child(self):
+		raise NotImplementedError
+
+
+	def collect(self):
+		return [
+			(self.name + _format_labels(self.labelnames, k), child.value)
+			for k, child in list(self._children.items())
+		]
+
+
+	def render(self):
+		lines = [
+			f'# HELP {self.name} {self.documentation}',
+			f'# TYPE {self.name} {self.kind}'
+		]
+		for sample, value in self.collect():
+			lines.append(f'{sample} {value}')
+		return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+	kind = 'counter'
+
+	def _new_child(self):
+		return _CounterValue()
+
+
+	def inc(self, amount=1):
+		self.labels().inc(amount)
+
+
+class Gauge(Metric):
+
+	kind = 'gauge'
+
+	def __init__(self, name, documentation, labelnames=(), fn=None, register=True):
+		super().__init__(name, documentation, labelnames, register)
+		# `fn` returns { label_values: value } and is only called on scrape
+		self._fn = fn
+
+
+	def _new_child(self):
+		return _GaugeValue()
+
+
+	def set(self, value):
+		self.labels().set(value)
+
+
+	def collect(self):
+		if self._fn is None:
+			return super().collect()
+
+		try:
+			values = self._fn()
+		except Exception:
+			logger.exception('[Gauge] Failed to collect %s', self.name)
+			return []
+
+		return [
+			(self.name + _format_labels(self.labelnames, k), v)
+			for k, v in values.items() if v is not None
+		]
+
+
+class Histogram(Metric):
+
+	kind = 'histogram'
+
+	def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, register=True):
+		super().__init__(name, documentation, labelnames, register)
+		self.buckets = tuple(sorted(buckets))
+
+
+	def _new_child(self):
+		return _HistogramValue(self.buckets)
+
+
+	def observe(self, value):
+		self.labels().observe(value)
+
+
+	def collect(self):
+		res = []
+		for k, child in list(self._children.items()):
+			with child._lock:
+				counts = list(child.counts)
+				total = child.sum
+
+			cumulative = 0
+			for bound, count in zip(self.buckets + (float('inf'),), counts):
+				cumulative += count
+				le = '+Inf' if bound == float('inf') else repr(bound)
+				res.append((self.name + '_bucket' + _format_labels(self.labelnames, k, ('le', le)), cumulative))
+
+			res.append((self.name + '_sum' + _format_labels(self.labelnames, k), total))
+			res.append((self.name + '_count' + _format_labels(self.labelnames, k), cumulative))
+
+		return res
+
+
+class Timer(object):
+
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+
+	def __exit__(self, *args):
+		self.histogram.observe(time.perf_counter() - self.start)
+
+
+def render():
+	return '\n'.join(metric.render() for metric in list(_registry)) + '\n'
+
+
+def getRSS(pid):
+	try:
+		with open(f'/proc/{pid}/statm', 'r') as f:
+			return int(f.read().split()[1]) * PAGE_SIZE
+	except (OSError, ValueError, IndexError):
+		return None
+
+
+def getDescendants(pid):
+	children = {}
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			with open(f'/proc/{entry}/stat', 'r') as f:
+				ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+		except (OSError, ValueError, IndexError):
+			continue
+		children.setdefault(ppid, []).append(int(entry))
+
+	res = []
+	stack = [pid]
+	while stack:
+		for child in children.get(stack.pop(), []):
+			res.append(child)
+			stack.append(child)
+	return res
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_response(404)
+			self.end_headers()
+			return
+
+		body = render().encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def log_message(self, format, *args):
+		logger.debug('[metrics] ' + format, *args)
+
+
+def startHttpServer(port, host='127.0.0.1'):
+	server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+	server.daemon_threads = True
+	Thread(target=server.serve_forever, daemon=True).start()
+	logger.info('[metrics] Serving on %s:%s', host, port)
+	return server
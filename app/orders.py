@@ -0,0 +1,244 @@
+import time
+import requests
+from threading import RLock
+from . import tradelib as tl
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+ORDER_EVENTS = metrics.Counter(
+	'ib_order_events_total', 'Order events from the `sor` stream by type.', ('port', 'type')
+)
+
+ORDER_TYPES = {
+	'MARKET': tl.MARKET_ORDER,
+	'LIMIT': tl.LIMIT_ORDER,
+	'STOP': tl.STOP_ORDER,
+}
+ENTRY_TYPES = {
+	tl.MARKET_ORDER: tl.MARKET_ENTRY,
+	tl.LIMIT_ORDER: tl.LIMIT_ENTRY,
+	tl.STOP_ORDER: tl.STOP_ENTRY,
+}
+CANCELLED_STATUSES = ( 'Cancelled', 'ApiCancelled', 'Inactive' )
+FILLED_STATUS = 'Filled'
+
+
+class OrderTracker(object):
+
+	def __init__(self, broker, listener=None):
+		# Working orders and open positions, kept from `sor` updates. Each
+		# update only carries changed fields, so raw rows are merged by
+		# orderId before being mapped onto tl.Order / tl.Position.
+		# `listener(events)` gets `{ order_id: event }` for every change,
+		# keyed by the closed position's order_id for closes
+		self.broker = broker
+		self.listener = listener
+
+		self.orders = {}
+		self.positions = {}
+		self._rows = {}
+		self._finished = set()
+		self._lock = RLock()
+
+
+	def getOrders(self, account_id=None):
+		with self._lock:
+			return [
+				dict(order) for order in self.orders.values()
+				if account_id is None or order.account_id == account_id
+			]
+
+
+	def getPositions(self, account_id=None):
+		with self._lock:
+			return [
+				dict(pos) for pos in self.positions.values()
+				if account_id is None or pos.account_id == account_id
+			]
+
+
+	def getOrder(self, order_id):
+		order = self.orders.get(str(order_id))
+		if order is not None:
+			return dict(order)
+
+
+	def onOrderUpdate(self, data, notify=True):
+		rows = data.get('args')
+		if not isinstance(rows, list):
+			return {}
+
+		events = {}
+		with self._lock:
+			for row in rows:
+				if 'orderId' in row:
+					events.update(self._apply(row))
+
+		for order_id, event in events.items():
+			ORDER_EVENTS.labels(self.broker.port, event['type']).inc()
+			if event['type'] != tl.UPDATE:
+				self.broker._on_account_event(event['item'].get('account_id'))
+
+		if events and notify and self.listener is not None:
+			self.listener(events)
+		return events
+
+
+	def sync(self):
+		# Seeds today's orders, e.g. after the socket reconnects, without
+		# notifying anything already seen
+		try:
+			res = self.broker._session.get(self.broker._url + '/iserver/account/orders', timeout=10)
+		except requests.exceptions.RequestException:
+			logger.warning('[OrderTracker] (%s) Order sync failed', self.broker.port)
+			return
+
+		if res.status_code == 200:
+			self.onOrderUpdate({ 'args': res.json().get('orders', []) }, notify=False)
+
+
+	def clear(self):
+		with self._lock:
+			self.orders.clear()
+			self.positions.clear()
+			self._rows.clear()
+			self._finished.clear()
+
+
+	def _apply(self, update):
+		order_id = str(update['orderId'])
+		if order_id in self._finished:
+			return {}
+		previous = self._rows.get(order_id, {})
+		row = self._rows[order_id] = dict(previous, **update)
+
+		status = row.get('status')
+		if status in CANCELLED_STATUSES:
+			order = self.orders.pop(order_id, None)
+			self._rows.pop(order_id, None)
+			self._finished.add(order_id)
+			if order is not None:
+				order.close_time = self._timestamp(row)
+				return { order_id: self._event(tl.ORDER_CANCEL, order) }
+			return {}
+
+		if status == FILLED_STATUS:
+			self._rows.pop(order_id, None)
+			self._finished.add(order_id)
+			return self._fill(order_id, row)
+
+		order = self.orders.get(order_id)
+		if order is None:
+			order = self._create_order(order_id, row)
+			# Market orders only matter once they fill
+			if order.order_type == tl.MARKET_ORDER:
+				return {}
+			self.orders[order_id] = order
+			return { order_id: self._event(order.order_type, order) }
+
+		changed = False
+		for k, v in (('lotsize', self._lotsize(row)), ('entry_price', self._price(row))):
+			if v is not None and order.get(k) != v:
+				order[k] = v
+				changed = True
+
+		if changed:
+			return { order_id: self._event(tl.MODIFY, order) }
+		elif 'filledQuantity' in update:
+			return { order_id: self._event(tl.UPDATE, order) }
+		return {}
+
+
+	def _fill(self, order_id, row):
+		order = self.orders.pop(order_id, None)
+		if order is None:
+			order = self._create_order(order_id, row)
+
+		price = self._float(row.get('avgPrice'))
+		if price is None:
+			price = order.entry_price
+		lotsize = self._float(row.get('filledQuantity')) or order.lotsize
+		timestamp = self._timestamp(row)
+
+		# A fill against open positions in the other direction closes
+		# them, oldest first
+		remaining = lotsize
+		events = {}
+		for pos in list(self.positions.values()):
+			if remaining <= 0:
+				break
+			if (pos.account_id != order.account_id or pos.product != order.product or
+					pos.direction == order.direction):
+				continue
+
+			size = min(pos.lotsize, remaining)
+			remaining -= size
+			if size < pos.lotsize:
+				pos.lotsize -= size
+				pos = tl.Position.fromDict(self.broker, dict(pos, lotsize=size))
+			else:
+				del self.positions[pos.order_id]
+			pos.close_price = price
+			pos.close_time = timestamp
+			events[pos.order_id] = self._event(tl.POSITION_CLOSE, pos)
+
+		if remaining <= 0:
+			return events
+
+		pos = tl.Position(
+			self.broker, order_id, order.account_id, order.product,
+			ENTRY_TYPES.get(order.order_type, tl.MARKET_ENTRY), order.direction,
+			remaining, entry_price=price, open_time=timestamp
+		)
+		self.positions[order_id] = pos
+		events[order_id] = self._event(pos.order_type, pos)
+		return events
+
+
+	def _create_order(self, order_id, row):
+		return tl.Order(
+			self.broker, order_id, row.get('acct'), self._product(row),
+			ORDER_TYPES.get(str(row.get('origOrderType', '')).upper(), tl.MARKET_ORDER),
+			tl.LONG if row.get('side') == 'BUY' else tl.SHORT,
+			self._lotsize(row), entry_price=self._price(row), open_time=self._timestamp(row)
+		)
+
+
+	def _event(self, event_type, item):
+		return {
+			'timestamp': time.time(),
+			'type': event_type,
+			'accepted': True,
+			'item': dict(item)
+		}
+
+
+	def _product(self, row):
+		try:
+			product = self.broker._quotes.products.get(int(row.get('conid')))
+		except (TypeError, ValueError):
+			product = None
+		return product or row.get('ticker')
+
+
+	def _lotsize(self, row):
+		if 'remainingQuantity' in row or 'filledQuantity' in row:
+			return (self._float(row.get('remainingQuantity')) or 0) + (self._float(row.get('filledQuantity')) or 0)
+
+
+	def _price(self, row):
+		return self._float(row.get('price'))
+
+
+	def _timestamp(self, row):
+		ts = row.get('lastExecutionTime_r')
+		return int(ts / 1000) if ts else int(time.time())
+
+
+	def _float(self, value):
+		try:
+			return float(value)
+		except (TypeError, ValueError):
+			return None
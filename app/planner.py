@@ -0,0 +1,121 @@
+import time
+import zlib
+from threading import Lock, BoundedSemaphore
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+RELOGIN_WAIT = metrics.Histogram(
+	'ib_relogin_wait_seconds', 'Time a browser login waited for a relogin slot.',
+	buckets=(0.1, 1, 5, 10, 30, 60, 120, 300)
+)
+
+
+class SessionPlanner(object):
+
+	def __init__(self, port, keepalive=30, margin=300, spread=600, lifetime=3600, retry=60):
+		# Keepalives (tickles) every `keepalive` seconds. Relogins `margin`
+		# seconds ahead of the expiry reported by the gateway, pulled
+		# forward by up to `spread` seconds per port so users whose
+		# sessions expire together don't relogin together. `lifetime` is
+		# assumed when the gateway hasn't reported an expiry
+		self.port = port
+		self.keepalive = keepalive
+		self.margin = margin
+		self.lifetime = lifetime
+		self.retry = retry
+		self.offset = (zlib.crc32(str(port).encode()) % 1000) / 1000 * spread
+
+		self.logged_in_at = None
+		self.expires_at = None
+		self.next_keepalive = 0
+		self._retry_at = 0
+
+
+	def onLogin(self):
+		self.logged_in_at = time.time()
+		self.expires_at = None
+		self.next_keepalive = self.logged_in_at + self.keepalive
+
+
+	def onLoginAttempt(self):
+		self._retry_at = time.time() + self.retry
+
+
+	def onExpiry(self, remaining_ms):
+		# Both `ssoExpires` (tickle) and `EXPIRES` (validate) are
+		# milliseconds left in the session
+		if remaining_ms:
+			self.expires_at = time.time() + remaining_ms / 1000
+
+
+	def onKeepalive(self, ok):
+		# Failed keepalives are retried sooner
+		self.next_keepalive = time.time() + (self.keepalive if ok else min(5, self.keepalive))
+
+
+	def keepaliveDue(self):
+		return time.time() >= self.next_keepalive
+
+
+	def reloginAt(self):
+		# Until a login succeeds, failed attempts are retried `retry`
+		# seconds apart
+		if self.logged_in_at is None:
+			return self._retry_at or None
+
+		if self.expires_at is not None:
+			deadline = self.expires_at
+		else:
+			deadline = self.logged_in_at + self.lifetime
+
+		# Never earlier than halfway through the session
+		return max(
+			deadline - self.margin - self.offset,
+			self.logged_in_at + (deadline - self.logged_in_at) / 2
+		)
+
+
+	def reloginDue(self):
+		at = self.reloginAt()
+		now = time.time()
+		return at is not None and now >= at and now >= self._retry_at
+
+
+	def getStats(self):
+		now = time.time()
+		at = self.reloginAt()
+		return {
+			'expires_in': None if self.expires_at is None else self.expires_at - now,
+			'relogin_in': None if at is None else at - now
+		}
+
+
+class ReloginScheduler(object):
+
+	def __init__(self, concurrency=2, interval=5):
+		# Shared by every user so browser logins are capped at
+		# `concurrency` at once and start at least `interval` seconds apart
+		self.interval = interval
+		self._semaphore = BoundedSemaphore(concurrency)
+		self._lock = Lock()
+		self._next_start = 0
+
+
+	def __enter__(self):
+		start = time.time()
+		self._semaphore.acquire()
+		with self._lock:
+			now = time.time()
+			wait = self._next_start - now
+			self._next_start = max(now, self._next_start) + self.interval
+
+		if wait > 0:
+			time.sleep(wait)
+		RELOGIN_WAIT.observe(time.time() - start)
+		return self
+
+
+	def __exit__(self, *args):
+		self._semaphore.release()
@@ -0,0 +1,93 @@
+import numpy as np
+from . import tradelib as tl
+from .log import getLogger
+
+logger = getLogger(__name__)
+
+
+class PnLEngine(object):
+
+	def __init__(self, broker, currency='USD'):
+		# Unrealized P&L for many positions in one pass. Currency P&L is
+		# converted from each pair's quote currency into `currency`
+		self.broker = broker
+		self.currency = currency
+		self._accounts = {}
+
+
+	def compute(self, positions):
+		if not positions:
+			return { 'positions': {}, 'pips': 0.0, 'profit': 0.0, 'currency': self.currency }
+
+		# Pairs and conversion rates are priced in one batched read
+		products = sorted(set(pos['product'] for pos in positions))
+		needed = set(products)
+		for p in products:
+			needed.update(self._conversion_products(p))
+		quotes = self.broker.getQuotes(sorted(needed))
+
+		index = { p: i for i, p in enumerate(products) }
+		bid = np.array([ quotes.get(p, {}).get('bid', np.nan) for p in products ], dtype=float)
+		ask = np.array([ quotes.get(p, {}).get('ask', np.nan) for p in products ], dtype=float)
+		pip = np.array([ tl.utils.getPipSize(p) for p in products ], dtype=float)
+		rate = np.array([ self._conversion_rate(p, quotes) for p in products ], dtype=float)
+
+		i = np.array([ index[pos['product']] for pos in positions ])
+		sign = np.array([ 1.0 if pos['direction'] == tl.LONG else -1.0 for pos in positions ])
+		lotsize = np.array([ pos['lotsize'] for pos in positions ], dtype=float)
+		entry = np.array([ pos.get('entry_price') for pos in positions ], dtype=float)
+		close = np.array([ pos.get('close_price') for pos in positions ], dtype=float)
+
+		# Longs close on the bid, shorts on the ask
+		exit_price = np.where(np.isnan(close), np.where(sign > 0, bid[i], ask[i]), close)
+		diff = (exit_price - entry) * sign
+		pips = np.round(diff / pip[i], 1)
+		profit = np.round(diff * lotsize * rate[i], 2)
+
+		return {
+			'positions': {
+				pos['order_id']: { 'pips': p, 'profit': v }
+				for pos, p, v in zip(positions, pips.tolist(), profit.tolist())
+			},
+			'pips': round(float(np.nansum(pips)), 1),
+			'profit': round(float(np.nansum(profit)), 2),
+			'currency': self.currency
+		}
+
+
+	def onAccountUpdate(self, data):
+		# `spl` rows are keyed `<account>.Core`, with daily (`dpl`) and
+		# unrealized (`upl`) P&L, net liquidity (`nl`) and market value (`mv`)
+		for key, row in (data.get('args') or {}).items():
+			account_id = key.split('.')[0]
+			self._accounts[account_id] = dict(self._accounts.get(account_id, {}), **row)
+
+
+	def getAccount(self, account_id):
+		return self._accounts.get(account_id)
+
+
+	def _conversion_products(self, product):
+		quote_currency = product.split('_')[-1]
+		if quote_currency == self.currency:
+			return []
+		return [ f'{self.currency}_{quote_currency}', f'{quote_currency}_{self.currency}' ]
+
+
+	def _conversion_rate(self, product, quotes):
+		# Quote currency amount -> `currency`, at the mid price,
+		# e.g. USD_JPY for EUR_JPY or GBP_USD for EUR_GBP
+		quote_currency = product.split('_')[-1]
+		if quote_currency == self.currency:
+			return 1.0
+
+		quote = quotes.get(f'{self.currency}_{quote_currency}')
+		if quote is not None:
+			return 2.0 / (quote['bid'] + quote['ask'])
+
+		quote = quotes.get(f'{quote_currency}_{self.currency}')
+		if quote is not None:
+			return (quote['bid'] + quote['ask']) / 2.0
+
+		logger.warning('[PnLEngine] No conversion rate for %s', product)
+		return np.nan
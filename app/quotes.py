@@ -0,0 +1,235 @@
+import re
+import json
+import time
+import requests
+from threading import Lock
+from . import tradelib as tl
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+# IDEALPRO cash contracts
+CONIDS = {
+	tl.product.EURUSD: 12087792,
+	tl.product.GBPUSD: 12087797,
+	tl.product.USDCHF: 12087820,
+	tl.product.EURJPY: 14321016,
+	tl.product.AUDUSD: 14433401,
+	tl.product.USDJPY: 15016059,
+	tl.product.USDCAD: 15016062,
+	tl.product.NZDUSD: 39453441,
+}
+
+# Market data tick types, see /iserver/marketdata/snapshot
+LAST_FIELD = '31'
+BID_FIELD = '84'
+ASK_FIELD = '86'
+BID_SIZE_FIELD = '88'
+ASK_SIZE_FIELD = '85'
+FIELDS = [ LAST_FIELD, BID_FIELD, ASK_FIELD, BID_SIZE_FIELD, ASK_SIZE_FIELD ]
+SIZE_UNITS = { 'K': 1e3, 'M': 1e6 }
+
+QUOTE_READS = metrics.Counter(
+	'ib_quote_reads_total', 'Quote board reads by source.', ('source',)
+)
+
+
+def parsePrice(value):
+	# Prices are strings, prefixed with `C` (previous close) or `H` (halted)
+	# when there's no live quote
+	if value is None:
+		return None
+	if isinstance(value, (int, float)):
+		return float(value)
+
+	value = re.sub(r'^[A-Za-z]+', '', value).replace(',', '')
+	try:
+		return float(value)
+	except ValueError:
+		return None
+
+
+def parseSize(value):
+	# Sizes may be abbreviated, e.g. `1.5M`
+	if value is None:
+		return None
+	if isinstance(value, (int, float)):
+		return float(value)
+
+	value = value.replace(',', '').strip()
+	unit = SIZE_UNITS.get(value[-1:].upper())
+	try:
+		return float(value[:-1]) * unit if unit else float(value)
+	except ValueError:
+		return None
+
+
+class QuoteBoard(object):
+
+	def __init__(self, broker, max_age=5, listener=None):
+		# Latest bid/ask per conid. Streamed `smd` quotes keep it current
+		# while the websocket is up. Anything else that is missing or older
+		# than `max_age` seconds is fetched, for every stale product in one
+		# snapshot request.
+		# `listener(product, quote)` is called on every streamed quote
+		self.broker = broker
+		self.max_age = max_age
+		self.listener = listener
+
+		self.conids = dict(CONIDS)
+		self.products = { v: k for k, v in self.conids.items() }
+		self._quotes = {}
+		self._streaming = set()
+		self._lock = Lock()
+
+
+	def getConid(self, product):
+		return self.conids.get(product)
+
+
+	def getQuote(self, product):
+		conid = self.conids.get(product)
+		quote = self._quotes.get(conid)
+		if self._is_fresh(conid, quote, time.time()):
+			QUOTE_READS.labels('board').inc()
+			return quote
+
+		return self.refresh([ product ]).get(product)
+
+
+	def getBid(self, product):
+		quote = self.getQuote(product)
+		if quote is not None:
+			return quote['bid']
+
+
+	def getAsk(self, product):
+		quote = self.getQuote(product)
+		if quote is not None:
+			return quote['ask']
+
+
+	def refresh(self, products):
+		# One snapshot for every stale product. Products read once are
+		# streamed from then on, so later reads don't leave memory
+		now = time.time()
+		stale = []
+		result = {}
+		for product in products:
+			conid = self.conids.get(product)
+			if conid is None:
+				continue
+
+			quote = self._quotes.get(conid)
+			if self._is_fresh(conid, quote, now):
+				result[product] = quote
+			else:
+				stale.append(conid)
+			self.subscribe(product)
+
+		if stale:
+			QUOTE_READS.labels('snapshot').inc(len(stale))
+			key = ','.join(map(str, sorted(set(stale))))
+			for data in self.broker._cache.get('snapshot', key, lambda: self._request_snapshot(key)):
+				self.update(data)
+
+			for product in products:
+				if product not in result and self.conids.get(product) in self._quotes:
+					result[product] = self._quotes[self.conids[product]]
+
+		return result
+
+
+	def subscribe(self, product):
+		conid = self.conids.get(product)
+		if conid is None or conid in self._streaming:
+			return
+
+		with self._lock:
+			self._streaming.add(conid)
+		self.broker._socket.subscribe(
+			f'smd+{conid}', f'smd+{conid}+' + json.dumps({ 'fields': FIELDS })
+		)
+
+
+	def unsubscribe(self, product):
+		conid = self.conids.get(product)
+		with self._lock:
+			if conid not in self._streaming:
+				return
+			self._streaming.discard(conid)
+		self.broker._socket.unsubscribe(f'smd+{conid}', f'umd+{conid}+{{}}')
+
+
+	def update(self, data):
+		# Snapshots and `smd` messages share a format. Either may omit
+		# unchanged fields, so missing prices keep their last value
+		try:
+			conid = int(data.get('conid'))
+		except (TypeError, ValueError):
+			return None
+
+		bid = parsePrice(data.get(BID_FIELD))
+		ask = parsePrice(data.get(ASK_FIELD))
+		bid_size = parseSize(data.get(BID_SIZE_FIELD))
+		ask_size = parseSize(data.get(ASK_SIZE_FIELD))
+		previous = self._quotes.get(conid)
+		if previous is not None:
+			bid = previous['bid'] if bid is None else bid
+			ask = previous['ask'] if ask is None else ask
+			bid_size = previous['bid_size'] if bid_size is None else bid_size
+			ask_size = previous['ask_size'] if ask_size is None else ask_size
+		elif bid is None and ask is None:
+			return None
+
+		quote = {
+			'product': self.products.get(conid),
+			'bid': bid,
+			'ask': ask,
+			'bid_size': bid_size,
+			'ask_size': ask_size,
+			'timestamp': time.time()
+		}
+		self._quotes[conid] = quote
+		return quote
+
+
+	def onMarketData(self, data):
+		quote = self.update(data)
+		if quote is not None and self.listener is not None and quote['product'] is not None:
+			self.listener(quote['product'], quote)
+
+
+	def clear(self):
+		with self._lock:
+			self._quotes.clear()
+
+
+	def _is_fresh(self, conid, quote, now):
+		# Streamed quotes only change when the price does
+		if quote is None:
+			return False
+		return (
+			(conid in self._streaming and self.broker._socket.connected) or
+			now - quote['timestamp'] <= self.max_age
+		)
+
+
+	def _request_snapshot(self, conids):
+		ept = '/iserver/marketdata/snapshot'
+		try:
+			res = self.broker._session.get(
+				self.broker._url + ept,
+				params={ 'conids': conids, 'fields': ','.join(FIELDS) },
+				timeout=5
+			)
+		except requests.exceptions.RequestException:
+			logger.warning('[QuoteBoard] (%s) Snapshot failed', self.broker.port)
+			return []
+
+		if res.status_code == 200:
+			return res.json()
+		else:
+			logger.warning('[QuoteBoard] (%s) Snapshot (%s)', self.broker.port, res.status_code)
+			return []
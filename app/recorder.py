@@ -0,0 +1,325 @@
+import os
+import json
+import mmap
+import struct
+import time
+import numpy as np
+from collections import deque
+from datetime import datetime
+from threading import Thread, Lock
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+MAGIC = b'IBTICK01'
+TICK_DTYPE = np.dtype([
+	('timestamp', '<f8'), ('conid', '<i8'),
+	('bid', '<f8'), ('ask', '<f8'),
+	('bid_size', '<f8'), ('ask_size', '<f8')
+])
+# Header: magic, record count, then the first record of each minute of
+# the day, -1 for minutes not reached yet
+MINUTES = 24 * 60
+INDEX_OFFSET = 16
+HEADER_SIZE = 16384
+# Records are written through a window of the file, a whole number of
+# both records and pages, so memory doesn't grow with the file
+WINDOW_SIZE = 12288 * 341
+
+TICKS_RECORDED = metrics.Counter(
+	'ib_ticks_recorded_total', 'Streamed quotes written by the tick recorder.'
+)
+TICKS_DROPPED = metrics.Counter(
+	'ib_ticks_dropped_total', 'Streamed quotes dropped because the tick recorder fell behind.'
+)
+COMMANDS_DROPPED = metrics.Counter(
+	'ib_commands_record_dropped_total', 'Commands not recorded because the command recorder fell behind.'
+)
+
+_record = struct.Struct('<dqdddd')
+
+
+def getDay(ts):
+	return datetime.utcfromtimestamp(ts).strftime('%Y%m%d')
+
+
+class TickRecorder(object):
+
+	def __init__(self, path, max_queue=100000):
+		# Quotes appended to one file of fixed width records per UTC day
+		# under `path`. `record` only queues, a thread does the writing,
+		# and quotes are dropped rather than queued past `max_queue`
+		self.path = path
+		self.max_queue = max_queue
+
+		# A deque, appends don't take a lock on the streaming path
+		self._queue = deque()
+		self._last = {}
+		self._lock = Lock()
+		self._thread = None
+		self._running = False
+		self._day = None
+		self._file = None
+		self._header = None
+		self._window = None
+		self._window_start = None
+		self._count = 0
+		self._minute = -1
+
+
+	def record(self, conid, quote):
+		# Quotes identical to the conid's last one are repeats, from
+		# another user streaming the same instrument
+		if conid is None:
+			return
+		values = (quote['bid'], quote['ask'], quote.get('bid_size'), quote.get('ask_size'))
+		if self._last.get(conid) == values:
+			return
+		self._last[conid] = values
+
+		if self._thread is None:
+			self._start()
+		if len(self._queue) >= self.max_queue:
+			TICKS_DROPPED.inc()
+		else:
+			self._queue.append((quote['timestamp'], conid) + values)
+
+
+	def read(self, start, end):
+		# Records in [start, end) of the day `start` is in, as a read-only
+		# view of its file
+		ticks = self.open(getDay(start))
+		if ticks is None:
+			return np.empty(0, dtype=TICK_DTYPE)
+
+		index, count = self._read_header(getDay(start))
+		day_start = start - start % 86400
+		first = max(0, int((start - day_start) // 60))
+		last = int((min(end, day_start + 86400) - day_start) // 60) + 1
+		# Minutes are indexed as they're reached, so an unset one has no
+		# records from it on
+		lo = index[first] if first < MINUTES and index[first] >= 0 else count
+		hi = index[last] if last < MINUTES and index[last] >= 0 else count
+		ticks = ticks[lo:hi]
+		ts = ticks['timestamp']
+		return ticks[np.searchsorted(ts, start):np.searchsorted(ts, end)]
+
+
+	def open(self, day):
+		# Every record of a day, memory-mapped
+		path = os.path.join(self.path, f'{day}.ticks')
+		if not os.path.exists(path):
+			return None
+		_, count = self._read_header(day)
+		return np.memmap(path, dtype=TICK_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,)) if count else np.empty(0, dtype=TICK_DTYPE)
+
+
+	def pending(self):
+		return len(self._queue)
+
+
+	def stop(self):
+		# Queued quotes are written first
+		self._running = False
+		if self._thread is not None:
+			self._thread.join(5)
+
+
+	def _read_header(self, day):
+		with open(os.path.join(self.path, f'{day}.ticks'), 'rb') as f:
+			header = f.read(INDEX_OFFSET + MINUTES * 8)
+		count = struct.unpack_from('<q', header, 8)[0]
+		return np.frombuffer(header, dtype='<i8', offset=INDEX_OFFSET, count=MINUTES), count
+
+
+	def _start(self):
+		with self._lock:
+			if self._thread is None:
+				os.makedirs(self.path, exist_ok=True)
+				self._running = True
+				self._thread = Thread(target=self._write_loop, daemon=True)
+				self._thread.start()
+
+
+	def _write_loop(self):
+		while True:
+			running = self._running
+			batch = 0
+			try:
+				while self._queue and batch < 10000:
+					self._append(self._queue.popleft())
+					batch += 1
+				if batch:
+					# Readers only see records once the count covers them
+					struct.pack_into('<q', self._header, 8, self._count)
+					TICKS_RECORDED.inc(batch)
+			except Exception:
+				logger.exception('[TickRecorder] Failed to write ticks')
+
+			if not running and not self._queue:
+				self._close()
+				return
+			if not batch:
+				time.sleep(0.01)
+
+
+	def _append(self, item):
+		ts = item[0]
+		day = getDay(ts)
+		if day != self._day:
+			self._open_day(day)
+
+		minute = int(ts % 86400 // 60)
+		if minute > self._minute:
+			for m in range(self._minute + 1, minute + 1):
+				struct.pack_into('<q', self._header, INDEX_OFFSET + m * 8, self._count)
+			self._minute = minute
+
+		offset = self._count * TICK_DTYPE.itemsize
+		if self._window_start is None or not self._window_start <= offset < self._window_start + WINDOW_SIZE:
+			self._map_window(offset - offset % WINDOW_SIZE)
+		_record.pack_into(
+			self._window, offset - self._window_start,
+			ts, item[1], item[2], item[3],
+			np.nan if item[4] is None else item[4], np.nan if item[5] is None else item[5]
+		)
+		self._count += 1
+
+
+	def _open_day(self, day):
+		self._close()
+		path = os.path.join(self.path, f'{day}.ticks')
+		exists = os.path.exists(path)
+		self._file = open(path, 'r+b' if exists else 'w+b')
+		if not exists:
+			self._file.truncate(HEADER_SIZE)
+		self._header = mmap.mmap(self._file.fileno(), HEADER_SIZE)
+		if not exists:
+			self._header[:8] = MAGIC
+			struct.pack_into('<q', self._header, 8, 0)
+			self._header[INDEX_OFFSET:INDEX_OFFSET + MINUTES * 8] = np.full(MINUTES, -1, dtype='<i8').tobytes()
+
+		index = np.frombuffer(self._header, dtype='<i8', offset=INDEX_OFFSET, count=MINUTES)
+		self._count = struct.unpack_from('<q', self._header, 8)[0]
+		self._minute = int(np.flatnonzero(index >= 0)[-1]) if (index >= 0).any() else -1
+		del index
+		self._day = day
+		logger.info('[TickRecorder] Recording to %s from record %s', path, self._count)
+
+
+	def _map_window(self, start):
+		if self._window is not None:
+			self._window.close()
+		if os.fstat(self._file.fileno()).st_size < HEADER_SIZE + start + WINDOW_SIZE:
+			self._file.truncate(HEADER_SIZE + start + WINDOW_SIZE)
+		self._window = mmap.mmap(self._file.fileno(), WINDOW_SIZE, offset=HEADER_SIZE + start)
+		self._window_start = start
+
+
+	def _close(self):
+		if self._file is None:
+			return
+		struct.pack_into('<q', self._header, 8, self._count)
+		if self._window is not None:
+			self._window.close()
+		self._header.close()
+		self._file.close()
+		self._file = self._header = self._window = self._window_start = None
+		self._day = None
+
+
+class CommandRecorder(object):
+
+	def __init__(self, path, max_queue=100000):
+		# Commands as received, a JSON line `{ "ts": ..., "message": ... }`
+		# each, appended to `<path>/<YYYYMMDD>.commands` by a writer thread.
+		# Passwords are left out
+		self.path = path
+		self.max_queue = max_queue
+
+		self._queue = deque()
+		self._lock = Lock()
+		self._thread = None
+		self._running = False
+		self._day = None
+		self._file = None
+
+
+	def record(self, message, ts=None):
+		if self._thread is None:
+			self._start()
+		if len(self._queue) >= self.max_queue:
+			COMMANDS_DROPPED.inc()
+		else:
+			self._queue.append((time.time() if ts is None else ts, message))
+
+
+	def read(self, day):
+		path = os.path.join(self.path, f'{day}.commands')
+		if not os.path.exists(path):
+			return
+		with open(path, 'r') as f:
+			for line in f:
+				item = json.loads(line)
+				yield item['ts'], item['message']
+
+
+	def pending(self):
+		return len(self._queue)
+
+
+	def stop(self):
+		self._running = False
+		if self._thread is not None:
+			self._thread.join(5)
+
+
+	def _start(self):
+		with self._lock:
+			if self._thread is None:
+				os.makedirs(self.path, exist_ok=True)
+				self._running = True
+				self._thread = Thread(target=self._write_loop, daemon=True)
+				self._thread.start()
+
+
+	def _write_loop(self):
+		while True:
+			running = self._running
+			written = False
+			try:
+				while self._queue:
+					ts, message = self._queue.popleft()
+					day = getDay(ts)
+					if day != self._day:
+						if self._file is not None:
+							self._file.close()
+						self._file = open(os.path.join(self.path, f'{day}.commands'), 'a')
+						self._day = day
+					self._file.write(json.dumps({ 'ts': ts, 'message': redact(message) }, default=str) + '\n')
+					written = True
+				if written:
+					self._file.flush()
+			except Exception:
+				logger.exception('[CommandRecorder] Failed to write commands')
+
+			if not running and not self._queue:
+				if self._file is not None:
+					self._file.close()
+				return
+			if not written:
+				time.sleep(0.01)
+
+
+def redact(message):
+	# add_user's password is its fifth argument
+	if message.get('cmd') != 'add_user':
+		return message
+	args = list(message.get('args') or [])
+	if len(args) > 4:
+		args[4] = None
+	kwargs = dict(message.get('kwargs') or {})
+	if 'password' in kwargs:
+		kwargs['password'] = None
+	return dict(message, args=args, kwargs=kwargs)
@@ -0,0 +1,65 @@
+import os
+import json
+import time
+from threading import Lock
+from .log import getLogger
+
+logger = getLogger(__name__)
+
+
+class UserRegistry(object):
+
+	def __init__(self, path):
+		# Users, their gateway pids and session state, kept on disk so a
+		# restarted client can reattach to gateways that outlived it.
+		# Credentials are never written, users that need to log in again
+		# get them from the broker's next add_user
+		self.path = path
+		self._lock = Lock()
+
+
+	def load(self):
+		try:
+			with open(self.path, 'r') as f:
+				records = json.load(f).get('users', [])
+		except FileNotFoundError:
+			return []
+		except (OSError, ValueError):
+			logger.exception('[UserRegistry] Failed to read %s', self.path)
+			return []
+
+		logger.info('[UserRegistry] Loaded %s users from %s', len(records), self.path)
+		return records
+
+
+	def save(self, records):
+		data = json.dumps({ 'saved_at': time.time(), 'users': records }, indent=2)
+
+		# Written to a temporary file first, so a crash mid-write never
+		# leaves a truncated registry behind
+		tmp_path = self.path + '.tmp'
+		with self._lock:
+			try:
+				os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+				fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+				with os.fdopen(fd, 'w') as f:
+					f.write(data)
+				os.replace(tmp_path, self.path)
+			except OSError:
+				logger.exception('[UserRegistry] Failed to write %s', self.path)
+
+
+	@staticmethod
+	def record(user, is_parent=False):
+		process = user._gateway_process
+		return {
+			'broker_id': user.brokerId,
+			'user_id': user.userId,
+			'strategy_id': user.strategyId,
+			'port': str(user.port),
+			'username': user.username,
+			'is_parent': is_parent,
+			'gateway_pid': process.pid if process is not None else None,
+			'logged_in': user._logged_in.is_set(),
+			'session_id': user._session_id
+		}
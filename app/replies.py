@@ -0,0 +1,83 @@
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+STREAM_TYPE = 'broker_reply_stream'
+DEFAULT_ROWS = 5000
+
+STREAM_MESSAGES = metrics.Counter(
+	'ib_reply_stream_messages_total', 'Messages sent for streamed replies, end markers included.'
+)
+
+
+def iterFrame(df, rows=DEFAULT_ROWS):
+	# `rows` at a time of a DataFrame's index and columns, as views
+	columns = { df.index.name or 'index': df.index.to_numpy() }
+	columns.update((name, df[name].to_numpy()) for name in df.columns)
+	for i in range(0, len(df), rows):
+		yield { name: values[i:i + rows] for name, values in columns.items() }
+
+
+class ReplyStream(object):
+
+	def __init__(self, msg_id, chunks, columns=False, timing=None):
+		# One reply sent as a sequence of `STREAM_TYPE` messages under its
+		# msg_id, `{ 'seq': n, 'end': False, 'data': chunk }` for each chunk
+		# `chunks` yields, then `{ 'seq': n, 'end': True, 'rows': total }`,
+		# or with `error` if the chunks fail. Chunks are dicts of equal
+		# length columns and are only taken as they're sent. With `columns`
+		# and multipart replies, chunk data is sent as raw buffers instead,
+		# see `Envelope.encodeColumns`. Each message carries its own copy
+		# of the command's `timing`, with `replied` when it was encoded
+		self.msg_id = msg_id
+		self.chunks = iter(chunks)
+		self.columns = columns
+		self.timing = timing
+		self.seq = 0
+		self.rows = 0
+		self.finished = False
+
+		self._frames = None
+		self._end = False
+
+
+	def next(self, envelope, replied=None):
+		# Kept until `sent`, so a message a full socket refused is tried again
+		if self._frames is None:
+			timing = None
+			if self.timing is not None:
+				timing = dict(self.timing, replied=replied)
+			self._frames = self._encode(envelope, timing)
+		return self._frames
+
+
+	def sent(self):
+		STREAM_MESSAGES.inc()
+		self._frames = None
+		self.seq += 1
+		self.finished = self._end
+
+
+	def _encode(self, envelope, timing):
+		result = { 'seq': self.seq, 'end': False }
+		try:
+			chunk = next(self.chunks)
+
+		except StopIteration:
+			self._end = True
+			result.update(end=True, rows=self.rows)
+			return envelope.encode(STREAM_TYPE, self.msg_id, result, timing)
+
+		except Exception as e:
+			logger.exception('[ReplyStream] %s failed', self.msg_id)
+			self._end = True
+			result.update(end=True, rows=self.rows, error=str(e))
+			return envelope.encode(STREAM_TYPE, self.msg_id, result, timing)
+
+		self.rows += len(next(iter(chunk.values()), ()))
+		if self.columns and envelope.multipart:
+			return envelope.encodeColumns(STREAM_TYPE, self.msg_id, result, chunk, timing)
+
+		result['data'] = chunk
+		return envelope.encode(STREAM_TYPE, self.msg_id, result, timing)
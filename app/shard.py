@@ -0,0 +1,303 @@
+import time
+import zmq
+import hmac
+import queue
+import bisect
+import struct
+import hashlib
+from threading import Thread, Lock
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+SHARD_FORWARDED = metrics.Counter(
+	'ib_shard_forwarded_total', 'Commands forwarded to the shard owning their broker_id.', ('shard',)
+)
+SHARD_MEMBERS = metrics.Gauge(
+	'ib_shard_members', 'Live shards, including this one.'
+)
+SHARD_REJECTED = metrics.Counter(
+	'ib_shard_rejected_total', 'Messages from peers dropped for a missing or bad signature.'
+)
+
+HEARTBEAT_CMD = '_shard_heartbeat'
+HANDOFF_CMD = '_shard_handoff'
+
+
+def getRoutingKey(data):
+	# The broker_id a command is about. User management commands carry
+	# it in their arguments, everything else in `broker_id`
+	cmd = data.get('cmd')
+	args = data.get('args') or []
+	kwargs = data.get('kwargs') or {}
+	for name, i in (
+		('add_user', 2), ('find_user', 2), ('replace_user', 3), ('delete_user', 0)
+	):
+		if cmd == name:
+			key = 'port' if name == 'delete_user' else 'broker_id'
+			return kwargs.get(key, args[i] if len(args) > i else None)
+
+	return data.get('broker_id')
+
+
+class HashRing(object):
+
+	def __init__(self, nodes=(), replicas=64):
+		# Each node gets `replicas` points on the ring so keys spread
+		# evenly, and only ~1/n of them move when a node joins or leaves.
+		# Rings are rebuilt on changes, not changed in place
+		self.replicas = replicas
+		self.nodes = set()
+		self._keys = []
+		self._points = {}
+		for node in nodes:
+			self.add(node)
+
+
+	def add(self, node):
+		if node in self.nodes:
+			return
+		self.nodes.add(node)
+		for i in range(self.replicas):
+			point = self._hash(f'{node}#{i}')
+			self._points[point] = node
+			bisect.insort(self._keys, point)
+
+
+	def get(self, key):
+		if not self._keys:
+			return None
+		i = bisect.bisect(self._keys, self._hash(str(key))) % len(self._keys)
+		return self._points[self._keys[i]]
+
+
+	def _hash(self, key):
+		return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+def getHeartbeatUrl(url):
+	# Heartbeats take the port after the command endpoint's, so they're
+	# never queued behind forwarded commands
+	host, port = url.rsplit(':', 1)
+	return f'{host}:{int(port) + 1}'
+
+
+class ShardRouter(object):
+
+	def __init__(self, context, codec, shard_id, url, peers=(), heartbeat=1, timeout=5, info=None, on_change=None, secret=None):
+		# This client's share of the users, by consistent hashing of
+		# broker_ids over the live shards. Shards find each other from
+		# `peers` and the heartbeats sent to every shard they know of, and
+		# forward commands for users they don't own to the owner's `url`.
+		# `info()` adds to each heartbeat, `on_change()` is called when a
+		# shard joins or leaves. With a `secret`, every message between
+		# shards is signed with it and unsigned ones are dropped
+		self.context = context
+		self.codec = codec
+		self.shard_id = shard_id
+		self.url = url
+		self.heartbeat = heartbeat
+		self.timeout = timeout
+		self.info = info
+		self.on_change = on_change
+		self.secret = secret.encode() if isinstance(secret, str) else secret
+
+		self.ring = HashRing([ shard_id ])
+		self.socket = None
+		self.parent_shard = None
+		self._peer_urls = set(peers) - { url }
+		self._shards = {}
+		self._sockets = {}
+		self._outbox = queue.Queue()
+		self._lock = Lock()
+		self._running = False
+		SHARD_MEMBERS.set(1)
+
+
+	def start(self):
+		self.socket = self.context.socket(zmq.PULL)
+		self.socket.bind(self.url)
+		self._running = True
+		Thread(target=self._heartbeat_loop, daemon=True).start()
+		logger.info('[ShardRouter] (%s) Listening on %s, peers %s', self.shard_id, self.url, sorted(self._peer_urls))
+		if self.secret is None:
+			logger.warning('[ShardRouter] (%s) No `secret`, messages from peers are not authenticated', self.shard_id)
+
+
+	def recv(self):
+		# Frames forwarded or sent by a peer, None if they aren't signed
+		# with this shard's secret
+		return self._verify(self.socket.recv_multipart())
+
+
+	def stop(self):
+		self._running = False
+
+
+	def owner(self, key):
+		# Commands without a broker_id are for the parent user
+		if key is None:
+			return self.parent_shard or self.shard_id
+		return self.ring.get(key)
+
+
+	def forward(self, shard_id, frames):
+		url = self._shards.get(shard_id, (None,))[0]
+		if url is None or not self._send(self._sockets, url, self._sign(frames)):
+			return False
+
+		SHARD_FORWARDED.labels(shard_id).inc()
+		return True
+
+
+	def handoff(self, shard_id, broker_id, port):
+		# Tells the new owner a user is on its way. No credentials go
+		# between shards, the broker adds the user there through add_user.
+		# Sent by `tick`, sockets are only used from the command loop
+		message = { 'cmd': HANDOFF_CMD, 'shard': self.shard_id, 'broker_id': broker_id, 'port': port }
+		self._outbox.put((shard_id, message, time.time() + self.timeout))
+
+
+	def tick(self):
+		# Shards are connected to as soon as they're heard from, so the
+		# connection is up by the time anything is forwarded
+		for url, _ in list(self._shards.values()):
+			if url not in self._sockets:
+				self._sockets[url] = self._connect(url)
+
+		retries = []
+		while not self._outbox.empty():
+			shard_id, message, deadline = self._outbox.get()
+			url = self._shards.get(shard_id, (None,))[0]
+			if url is not None and self._send(self._sockets, url, self._sign([ self.codec.encode(message) ])):
+				continue
+
+			if time.time() < deadline:
+				retries.append((shard_id, message, deadline))
+			else:
+				logger.error('[ShardRouter] (%s) Failed to hand off %s to %s', self.shard_id, message['broker_id'], shard_id)
+		for item in retries:
+			self._outbox.put(item)
+
+
+	def onHeartbeat(self, data):
+		shard_id = data.get('shard')
+		if shard_id is None or shard_id == self.shard_id:
+			return
+
+		with self._lock:
+			joined = shard_id not in self._shards
+			self._shards[shard_id] = (data['url'], time.time())
+
+		if data.get('parent'):
+			self.parent_shard = shard_id
+		elif self.parent_shard == shard_id:
+			self.parent_shard = None
+
+		if joined:
+			logger.info('[ShardRouter] (%s) Shard %s joined', self.shard_id, shard_id)
+			self._changed()
+
+
+	def expire(self):
+		now = time.time()
+		with self._lock:
+			left = [ k for k, (url, seen) in self._shards.items() if now - seen > self.timeout ]
+			for shard_id in left:
+				del self._shards[shard_id]
+
+		for shard_id in left:
+			logger.warning('[ShardRouter] (%s) Shard %s left', self.shard_id, shard_id)
+			if self.parent_shard == shard_id:
+				self.parent_shard = None
+		if left:
+			self._changed()
+
+
+	def _heartbeat_loop(self):
+		# Its own sockets and thread, so a backlog of commands never
+		# delays heartbeats and gets a busy shard declared gone
+		socket = self.context.socket(zmq.PULL)
+		socket.bind(getHeartbeatUrl(self.url))
+		sockets = {}
+		next_heartbeat = 0
+		while self._running:
+			if socket.poll(min(self.heartbeat, 0.1) * 1000):
+				try:
+					frames = self._verify(socket.recv_multipart())
+					if frames is not None:
+						self.onHeartbeat(self.codec.decode(frames[0]))
+				except Exception:
+					logger.exception('[ShardRouter] (%s) Bad heartbeat', self.shard_id)
+
+			now = time.time()
+			if now < next_heartbeat:
+				continue
+			next_heartbeat = now + self.heartbeat
+
+			self.expire()
+			message = { 'cmd': HEARTBEAT_CMD, 'shard': self.shard_id, 'url': self.url }
+			if self.info is not None:
+				message.update(self.info())
+			frames = self._sign([ self.codec.encode(message) ])
+			with self._lock:
+				urls = self._peer_urls | set(url for url, _ in self._shards.values())
+			for url in urls:
+				self._send(sockets, getHeartbeatUrl(url), frames)
+
+
+	def _mac(self, frames):
+		# Frames are length prefixed, so moving bytes between them
+		# changes the signature
+		mac = hmac.new(self.secret, digestmod=hashlib.sha256)
+		for frame in frames:
+			mac.update(struct.pack('>Q', len(frame)))
+			mac.update(frame)
+		return mac.digest()
+
+
+	def _sign(self, frames):
+		if self.secret is None:
+			return frames
+		return list(frames) + [ self._mac(frames) ]
+
+
+	def _verify(self, frames):
+		if self.secret is None:
+			return frames
+
+		if len(frames) < 2 or not hmac.compare_digest(frames[-1], self._mac(frames[:-1])):
+			SHARD_REJECTED.inc()
+			logger.warning('[ShardRouter] (%s) Dropped a message with a bad signature', self.shard_id)
+			return None
+		return frames[:-1]
+
+
+	def _connect(self, url):
+		# Messages for peers that aren't up yet are dropped, not queued
+		socket = self.context.socket(zmq.PUSH)
+		socket.setsockopt(zmq.IMMEDIATE, 1)
+		socket.setsockopt(zmq.LINGER, 0)
+		socket.setsockopt(zmq.SNDHWM, 10000)
+		socket.connect(url)
+		return socket
+
+
+	def _send(self, sockets, url, frames):
+		if url not in sockets:
+			sockets[url] = self._connect(url)
+		try:
+			sockets[url].send_multipart(frames, zmq.NOBLOCK)
+			return True
+		except zmq.Again:
+			return False
+
+
+	def _changed(self):
+		with self._lock:
+			shards = [ self.shard_id ] + list(self._shards)
+		self.ring = HashRing(shards, self.ring.replicas)
+		SHARD_MEMBERS.set(len(shards))
+		if self.on_change is not None:
+			self.on_change()
@@ -0,0 +1,188 @@
+import time
+from collections import deque, OrderedDict
+from threading import Lock
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+STREAM_DROPPED = metrics.Counter(
+	'ib_stream_dropped_total', 'Streaming updates dropped because a subscriber buffer was full.', ('broker_id',)
+)
+STREAM_CONFLATED = metrics.Counter(
+	'ib_stream_conflated_total', 'Streaming updates replaced by a newer value before being sent.', ('broker_id',)
+)
+
+
+class Subscription(object):
+
+	def __init__(self, broker, msg_id, instrument=None, conflate=False, maxlen=1000, msg_type='account'):
+		# Buffered subscriptions keep up to `maxlen` updates, dropping the
+		# oldest on overflow. Conflating subscriptions (quotes, P&L) keep
+		# only the latest update per key.
+		self.broker = broker
+		self.msg_id = msg_id
+		self.instrument = instrument
+		self.conflate = conflate
+		self.maxlen = maxlen
+		self.msg_type = msg_type
+		self.topic = f'{broker.brokerId}/{msg_id}/{instrument or ""}'.encode()
+
+		self.closed = False
+		self._lock = Lock()
+		self._scheduled = False
+		self._buffer = deque()
+		self._latest = OrderedDict()
+
+
+	def onUpdate(self, *args, key=None):
+		logger.debug('[onUpdate] (%s) %s', self.msg_id, args)
+		self.push({
+			"args": args,
+			"kwargs": {}
+		}, key=key)
+
+
+	def push(self, result, key=None):
+		if self.closed:
+			return
+
+		item = (time.perf_counter(), result)
+
+		with self._lock:
+			if self.conflate:
+				if key in self._latest:
+					STREAM_CONFLATED.labels(self.broker.brokerId).inc()
+				self._latest[key] = item
+			else:
+				if len(self._buffer) >= self.maxlen:
+					self._buffer.popleft()
+					STREAM_DROPPED.labels(self.broker.brokerId).inc()
+				self._buffer.append(item)
+
+			if self._scheduled:
+				return
+			self._scheduled = True
+
+		self.broker.container.publish(self)
+
+
+	def drain(self):
+		with self._lock:
+			if self.conflate:
+				items = list(self._latest.values())
+				self._latest.clear()
+			else:
+				items = list(self._buffer)
+				self._buffer.clear()
+			self._scheduled = False
+
+		if self.closed:
+			return []
+		return items
+
+
+	def pending(self):
+		return len(self._latest) if self.conflate else len(self._buffer)
+
+
+	def close(self):
+		self.closed = True
+		with self._lock:
+			self._buffer.clear()
+			self._latest.clear()
+
+
+class SharedPayload(object):
+
+	__slots__ = ('result', '_codec', '_encoded')
+
+	def __init__(self, result):
+		# Fanned out to many subscriptions, encoded by whichever is sent first
+		self.result = result
+		self._codec = None
+		self._encoded = None
+
+
+	def encode(self, codec):
+		if self._codec is not codec:
+			self._encoded = codec.encode(self.result)
+			self._codec = codec
+		return self._encoded
+
+
+class InstrumentFeed(object):
+
+	def __init__(self, broker, instrument):
+		# One upstream subscription per instrument, shared by every msg_id
+		self.broker = broker
+		self.instrument = instrument
+		self.subscribers = SubscriptionRegistry()
+
+
+	def add(self, sub):
+		return self.subscribers.add(sub)
+
+
+	def remove(self, msg_id):
+		return self.subscribers.remove(msg_id)
+
+
+	def onUpdate(self, *args, key=None):
+		payload = SharedPayload({
+			"args": args,
+			"kwargs": {}
+		})
+		for sub in self.subscribers:
+			sub.push(payload, key=key)
+
+
+	def __len__(self):
+		return len(self.subscribers)
+
+
+class SubscriptionRegistry(object):
+
+	def __init__(self):
+		self._subscriptions = {}
+		self._lock = Lock()
+
+
+	def add(self, sub):
+		with self._lock:
+			previous = self._subscriptions.get(sub.msg_id)
+			self._subscriptions[sub.msg_id] = sub
+
+		if previous is not None:
+			previous.close()
+		return sub
+
+
+	def remove(self, msg_id):
+		with self._lock:
+			sub = self._subscriptions.pop(msg_id, None)
+
+		if sub is not None:
+			sub.close()
+		return sub
+
+
+	def get(self, msg_id):
+		return self._subscriptions.get(msg_id)
+
+
+	def clear(self):
+		with self._lock:
+			subs = list(self._subscriptions.values())
+			self._subscriptions.clear()
+
+		for sub in subs:
+			sub.close()
+
+
+	def __iter__(self):
+		return iter(list(self._subscriptions.values()))
+
+
+	def __len__(self):
+		return len(self._subscriptions)
@@ -0,0 +1,193 @@
+import os
+import time
+import signal
+import subprocess
+from threading import Thread, Event, Lock
+from .log import getLogger
+
+logger = getLogger(__name__)
+
+
+def getCmdline(pid):
+	# None once the process is gone, including zombies nobody has reaped
+	try:
+		with open(f'/proc/{pid}/stat', 'r') as f:
+			state = f.read().rsplit(')', 1)[1].split()[0]
+		if state in ('Z', 'X'):
+			return None
+
+		with open(f'/proc/{pid}/cmdline', 'rb') as f:
+			return [ i.decode(errors='replace') for i in f.read().split(b'\0') if i ]
+	except (OSError, IndexError):
+		return None
+
+
+class AttachedProcess(object):
+
+	def __init__(self, pid, interval=1):
+		# Popen-like handle for a gateway started by an earlier run. It
+		# isn't our child, so exits are polled for instead of waited on,
+		# and its exit code is never known
+		self.pid = pid
+		self.interval = interval
+		self.returncode = None
+
+
+	def poll(self):
+		if self.returncode is None and getCmdline(self.pid) is None:
+			self.returncode = -1
+		return self.returncode
+
+
+	def wait(self, timeout=None):
+		start = time.time()
+		while self.poll() is None:
+			if timeout is not None and time.time() - start >= timeout:
+				raise subprocess.TimeoutExpired(str(self.pid), timeout)
+			time.sleep(self.interval if timeout is None else min(self.interval, 0.1))
+		return self.returncode
+
+
+	def terminate(self):
+		self._signal(signal.SIGTERM)
+
+
+	def kill(self):
+		self._signal(signal.SIGKILL)
+
+
+	def _signal(self, sig):
+		try:
+			os.kill(self.pid, sig)
+		except ProcessLookupError:
+			pass
+
+
+class GatewaySupervisor(object):
+
+	def __init__(self, broker, hang_timeout=90, backoff_start=1, backoff_max=60, stable_period=300):
+		self.broker = broker
+		self.hang_timeout = hang_timeout
+		self.backoff_start = backoff_start
+		self.backoff_max = backoff_max
+		self.stable_period = stable_period
+
+		self._lock = Lock()
+		self._stopped = Event()
+		self._process = None
+		self._expected_exits = set()
+
+		self.restarts = 0
+		self.crashes = 0
+		self.hangs = 0
+		self.last_exit_code = None
+		self._consecutive_restarts = 0
+		self._started_at = None
+		self._last_restart = None
+		self._last_healthy = None
+
+
+	def watch(self, process):
+		with self._lock:
+			self._process = process
+			self._started_at = time.time()
+			self._last_healthy = None
+
+		# Each process gets a thread blocked in waitpid, so exits are
+		# picked up as soon as the child is reaped. Reattached gateways
+		# are polled, see `AttachedProcess`
+		t = Thread(target=self._wait, args=(process,), daemon=True)
+		t.start()
+
+
+	def expectExit(self, process):
+		with self._lock:
+			self._expected_exits.add(process.pid)
+
+
+	def stop(self):
+		self._stopped.set()
+		if self._process is not None:
+			self.expectExit(self._process)
+
+
+	def onHealthCheck(self, healthy):
+		if healthy:
+			self._last_healthy = time.time()
+
+		elif self._is_hung():
+			logger.warning('[GatewaySupervisor] (%s) Gateway unresponsive, killing %s', self.broker.port, self._process.pid)
+			self.hangs += 1
+			self._process.kill()
+
+
+	def getStats(self):
+		process = self._process
+		return {
+			'pid': process.pid if process is not None else None,
+			'alive': process is not None and process.poll() is None,
+			'uptime': time.time() - self._started_at if self._started_at else 0,
+			'restarts': self.restarts,
+			'crashes': self.crashes,
+			'hangs': self.hangs,
+			'last_exit_code': self.last_exit_code
+		}
+
+
+	def _is_hung(self):
+		process = self._process
+		if process is None or process.poll() is not None:
+			return False
+
+		last_seen = self._last_healthy or self._started_at
+		return time.time() - last_seen >= self.hang_timeout
+
+
+	def _wait(self, process):
+		code = process.wait()
+
+		with self._lock:
+			expected = process.pid in self._expected_exits
+			self._expected_exits.discard(process.pid)
+			current = process is self._process
+
+		if expected or not current or self._stopped.is_set():
+			return
+
+		logger.error('[GatewaySupervisor] (%s) Gateway %s exited (%s)', self.broker.port, process.pid, code)
+		self.crashes += 1
+		self.last_exit_code = code
+		self._restart()
+
+
+	def _next_backoff(self):
+		if self._last_restart is not None and time.time() - self._last_restart >= self.stable_period:
+			self._consecutive_restarts = 0
+
+		delay = min(self.backoff_start * 2 ** self._consecutive_restarts, self.backoff_max)
+		self._consecutive_restarts += 1
+		return delay
+
+
+	def _restart(self):
+		while not self._stopped.is_set():
+			delay = self._next_backoff()
+			logger.info('[GatewaySupervisor] (%s) Restarting gateway in %ss', self.broker.port, delay)
+			if self._stopped.wait(delay):
+				return
+
+			self._last_restart = time.time()
+			self.restarts += 1
+			try:
+				with self.broker._gateway_lock:
+					self.broker._start_gateway()
+					self.broker.standardReconnect()
+					self.broker._resubscribe()
+				return
+
+			except Exception:
+				logger.exception('[GatewaySupervisor] (%s) Restart failed', self.broker.port)
+				try:
+					self.broker._stop_gateway()
+				except Exception:
+					pass
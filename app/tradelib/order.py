@@ -97,9 +97,9 @@ class Order(dict):
 		# Convert to price
 		if entry_range:
 			if direction == tl.LONG:
-				entry = round(self.entry_price + tl.utils.convertToPrice(entry_range), 5)
+				entry = round(self.entry_price + tl.utils.convertToPrice(entry_range, self.product), 5)
 			else:
-				entry = round(self.entry_price - tl.utils.convertToPrice(entry_range), 5)
+				entry = round(self.entry_price - tl.utils.convertToPrice(entry_range, self.product), 5)
 		elif entry_price:
 			entry = entry_price
 		else:
@@ -107,9 +107,9 @@ class Order(dict):
 
 		if sl_range:
 			if direction == tl.LONG:
-				sl = round(self.entry_price - tl.utils.convertToPrice(sl_range), 5)
+				sl = round(self.entry_price - tl.utils.convertToPrice(sl_range, self.product), 5)
 			else:
-				sl = round(self.entry_price + tl.utils.convertToPrice(sl_range), 5)
+				sl = round(self.entry_price + tl.utils.convertToPrice(sl_range, self.product), 5)
 		elif sl_price:
 			sl = sl_price
 		else:
@@ -117,9 +117,9 @@ class Order(dict):
 
 		if tp_range:
 			if direction == tl.LONG:
-				tp = round(self.entry_price + tl.utils.convertToPrice(tp_range), 5)
+				tp = round(self.entry_price + tl.utils.convertToPrice(tp_range, self.product), 5)
 			else:
-				tp = round(self.entry_price - tl.utils.convertToPrice(tp_range), 5)
+				tp = round(self.entry_price - tl.utils.convertToPrice(tp_range, self.product), 5)
 		elif tp_price:
 			tp = tp_price
 		else:
@@ -112,9 +112,9 @@ class Position(dict):
 		# Convert to price
 		if sl_range is not None:
 			if self.direction == tl.LONG:
-				sl = round(self.entry_price - tl.utils.convertToPrice(sl_range), 5)
+				sl = round(self.entry_price - tl.utils.convertToPrice(sl_range, self.product), 5)
 			else:
-				sl = round(self.entry_price + tl.utils.convertToPrice(sl_range), 5)
+				sl = round(self.entry_price + tl.utils.convertToPrice(sl_range, self.product), 5)
 		elif sl_price is not None:
 			sl = sl_price
 		else:
@@ -122,9 +122,9 @@ class Position(dict):
 
 		if tp_range is not None:
 			if self.direction == tl.LONG:
-				tp = round(self.entry_price + tl.utils.convertToPrice(tp_range), 5)
+				tp = round(self.entry_price + tl.utils.convertToPrice(tp_range, self.product), 5)
 			else:
-				tp = round(self.entry_price - tl.utils.convertToPrice(tp_range), 5)
+				tp = round(self.entry_price - tl.utils.convertToPrice(tp_range, self.product), 5)
 		elif tp_price is not None:
 			tp = tp_price
 		else:
@@ -140,14 +140,14 @@ class Position(dict):
 		ask = self._broker.getAsk(self.product)
 		bid = self._broker.getBid(self.product)
 
-		if direction == tl.LONG:
-			if self.close:
-				return round(tl.utils.convertToPips(self.close - self.entry_price), 2)
+		if self.direction == tl.LONG:
+			if self.close_price:
+				return round(tl.utils.convertToPips(self.close_price - self.entry_price, self.product), 2)
 			else:
-				return round(tl.utils.convertToPips(bid - self.entry_price), 2)
+				return round(tl.utils.convertToPips(bid - self.entry_price, self.product), 2)
 		else:
-			if self.close:
-				return round(tl.utils.convertToPips(self.entry_price - self.close), 2)
+			if self.close_price:
+				return round(tl.utils.convertToPips(self.entry_price - self.close_price, self.product), 2)
 			else:
-				return round(tl.utils.convertToPips(self.entry_price - ask), 2)
+				return round(tl.utils.convertToPips(self.entry_price - ask, self.product), 2)
 
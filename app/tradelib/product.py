@@ -8,4 +8,18 @@ AUDUSD = 'AUD_USD'
 USDCAD = 'USD_CAD'
 NZDUSD = 'NZD_USD'
 USDJPY = 'USD_JPY'
-USDCHF = 'USD_CHF'
\ No newline at end of file
+USDCHF = 'USD_CHF'
+
+'''
+Pip Sizes
+'''
+PIP_SIZES = {
+	GBPUSD: 0.0001,
+	EURUSD: 0.0001,
+	EURJPY: 0.01,
+	AUDUSD: 0.0001,
+	USDCAD: 0.0001,
+	NZDUSD: 0.0001,
+	USDJPY: 0.01,
+	USDCHF: 0.0001
+}
\ No newline at end of file
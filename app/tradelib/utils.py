@@ -9,11 +9,14 @@ Utilities
 
 TS_START_DATE = datetime(year=2000, month=1, day=1)
 
-def convertToPips(x):
-	return round(x * 10000, 1)
+def getPipSize(product):
+	return tl.product.PIP_SIZES.get(product, 0.0001)
 
-def convertToPrice(x):
-	return round(x / 10000, 5)
+def convertToPips(x, product=None):
+	return round(x / getPipSize(product), 1)
+
+def convertToPrice(x, product=None):
+	return round(x * getPipSize(product), 5)
 
 def convertTimezone(dt, tz):
 	return dt.astimezone(pendulum.timezone(tz))
@@ -0,0 +1,146 @@
+import os
+import zmq
+import time
+import shutil
+import tempfile
+import multiprocessing
+from threading import Thread
+from .shard import HashRing, getRoutingKey
+from .registry import UserRegistry
+from .log import getLogger
+from . import metrics
+
+logger = getLogger(__name__)
+
+WORKER_COMMANDS = metrics.Counter(
+	'ib_worker_commands_total', 'Commands routed to each worker process.', ('worker',)
+)
+WORKER_RESTARTS = metrics.Counter(
+	'ib_worker_restarts_total', 'Worker processes started again after exiting.', ('worker',)
+)
+
+
+def getWorkerPath(path, index):
+	root, ext = os.path.splitext(path)
+	return f'{root}.{index}{ext}'
+
+
+def _worker_main(target, index, url, parent_pid):
+	# Workers exit with the process that routes to them, however it dies,
+	# leaving their gateways to be reattached on restart
+	def watch():
+		while os.getppid() == parent_pid:
+			time.sleep(1)
+		os._exit(0)
+
+	Thread(target=watch, daemon=True).start()
+	target(index, url)
+
+
+class WorkerPool(object):
+
+	def __init__(self, context, size, target, restart_delay=5, registry=None):
+		# Users split over `size` processes by consistent hashing of their
+		# broker_id, as with shards. Each process runs `target(index, url)`
+		# and takes its commands from `url`, but replies and publishes to
+		# the broker itself, so commands are only routed here. `registry`
+		# is the path workers keep theirs next to, see `getWorkerPath`
+		self.context = context
+		self.size = size
+		self.target = target
+		self.restart_delay = restart_delay
+		self.registry = registry
+		self.ring = HashRing([ str(i) for i in range(size) ])
+		self.parent_id = None
+
+		self._dir = None
+		self._urls = []
+		self._sockets = []
+		self._processes = []
+		self._started_at = []
+		self._mp = multiprocessing.get_context('spawn')
+
+
+	def start(self):
+		self.parent_id = self._find_parent()
+		self._dir = tempfile.mkdtemp(prefix='ib-workers-')
+		for i in range(self.size):
+			# Connected rather than bound, so commands queue while a worker
+			# is starting or being restarted
+			url = f'ipc://{self._dir}/{i}'
+			socket = self.context.socket(zmq.PUSH)
+			socket.setsockopt(zmq.SNDHWM, 0)
+			socket.connect(url)
+			self._urls.append(url)
+			self._sockets.append(socket)
+			self._processes.append(None)
+			self._started_at.append(0)
+			self._spawn(i)
+
+
+	def stop(self):
+		for process in self._processes:
+			if process is not None:
+				process.terminate()
+		for process in self._processes:
+			if process is not None:
+				process.join(5)
+		if self._dir is not None:
+			shutil.rmtree(self._dir, ignore_errors=True)
+
+
+	def route(self, message):
+		# Commands without a broker_id are for the parent user, on the
+		# worker its own broker_id hashes to
+		key = getRoutingKey(message)
+		if key is None:
+			return int(self.ring.get(self.parent_id)) if self.parent_id is not None else 0
+
+		cmd = message.get('cmd')
+		if cmd == 'add_user' and self._is_parent(message):
+			self.parent_id = key
+		elif cmd == 'delete_user' and key == self.parent_id:
+			self.parent_id = None
+		return int(self.ring.get(key))
+
+
+	def send(self, worker, frames):
+		WORKER_COMMANDS.labels(worker).inc()
+		self._sockets[worker].send_multipart(frames)
+
+
+	def tick(self):
+		now = time.time()
+		for i, process in enumerate(self._processes):
+			if process.is_alive() or now - self._started_at[i] < self.restart_delay:
+				continue
+
+			logger.error('[WorkerPool] Worker %s exited (%s), restarting', i, process.exitcode)
+			WORKER_RESTARTS.labels(i).inc()
+			self._spawn(i)
+
+
+	def _spawn(self, i):
+		process = self._mp.Process(target=_worker_main, args=(self.target, i, self._urls[i], os.getpid()), daemon=True)
+		process.start()
+		self._processes[i] = process
+		self._started_at[i] = time.time()
+		logger.info('[WorkerPool] Started worker %s (%s)', i, process.pid)
+
+
+	def _find_parent(self):
+		# Workers restore the parent from their registries, so it's known
+		# before the broker adds it again, if it ever does
+		if self.registry is None:
+			return None
+
+		for i in range(self.size):
+			for record in UserRegistry(getWorkerPath(self.registry, i)).load():
+				if record.get('is_parent'):
+					logger.info('[WorkerPool] Parent %s restored on worker %s', record['broker_id'], i)
+					return record['broker_id']
+
+
+	def _is_parent(self, message):
+		args = message.get('args') or []
+		return bool((message.get('kwargs') or {}).get('is_parent', args[5] if len(args) > 5 else False))
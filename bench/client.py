@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import time
+import tempfile
+from threading import Thread
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def writeConfig(push_url, router_url, extra=None):
+	config = {
+		'zmq_pull_url': push_url,
+		'zmq_send_url': router_url,
+		'logging': { 'level': 'WARNING' },
+		'registry': None
+	}
+	config.update(extra or {})
+
+	fd, path = tempfile.mkstemp(prefix='ib-bench-', suffix='.json')
+	with os.fdopen(fd, 'w') as f:
+		json.dump(config, f)
+	return path
+
+
+def tick_loop(users, rate):
+	from app.streaming import Subscription
+
+	subs = [ Subscription(user, f'bench-ticks-{user.brokerId}', 'EUR_USD') for user in users ]
+	interval = 1.0 / rate
+	next_time = time.time()
+	price = 1.10000
+	while True:
+		next_time += interval
+		price += 0.00001
+		for sub in subs:
+			sub.onUpdate({
+				'bench_ts': time.time(),
+				'product': 'EUR_USD',
+				'bid': round(price, 5),
+				'ask': round(price + 0.00002, 5)
+			})
+
+		delay = next_time - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+
+def patchIB(run):
+	from app.ib import IB
+
+	class BenchIB(IB):
+
+		def _start_gateway(self):
+			self._is_gateway_loaded.set()
+			return { 'complete': True }
+
+
+		def _stop_gateway(self):
+			pass
+
+
+		def _create_webdriver(self):
+			self.driver = None
+
+
+		def login(self):
+			self._session.post(self._url.split('/v1/api')[0] + '/bench/login')
+
+	run.IB = BenchIB
+
+
+def worker_main(index, url):
+	# Spawned by the pool with the parent's environment, see `client_main`
+	sys.path.insert(0, ROOT_DIR)
+	import run
+	patchIB(run)
+	run.worker_main(index, url)
+
+
+def client_main(config_path, gateway_ports, tick_rate=0, gateway_url='http://127.0.0.1:{port}/v1/api'):
+	# Runs in its own process so its CPU and memory can be measured alone
+	os.environ['IB_CONFIG'] = config_path
+	os.environ['IB_GATEWAY_URL'] = gateway_url
+	sys.path.insert(0, ROOT_DIR)
+
+	import run
+	patchIB(run)
+	if run.worker_pool is not None:
+		run.worker_pool.target = worker_main
+		run.worker_pool.start()
+		run.run()
+		return
+
+	users = [
+		run.user_container.addUser(
+			str(port), f'user{i}', 'bench', f'broker{i}', 'bench', 'bench', i == 0
+		)
+		for i, port in enumerate(gateway_ports)
+	]
+
+	Thread(target=run.send_loop, daemon=True).start()
+	Thread(target=run.publish_loop, daemon=True).start()
+	if tick_rate:
+		Thread(target=tick_loop, args=(users, tick_rate), daemon=True).start()
+
+	run.run()
@@ -0,0 +1,86 @@
+'''
+Encode/decode cost and size of each wire codec on realistic payloads.
+
+	python -m bench.codec_bench --iterations 20000
+'''
+import os
+import sys
+import time
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import codec
+
+
+def payloads():
+	account = {
+		'DU0000001': {
+			'currency': 'USD', 'balance': 100000.0, 'pl': 0,
+			'margin': 1523.42, 'available': 98476.58
+		}
+	}
+	order = {
+		'order_id': '1837252351', 'account_id': 'DU0000001', 'product': 'EUR_USD',
+		'order_type': 'limitorder', 'direction': 'long', 'lotsize': 100000,
+		'entry_price': 1.10245, 'close_price': None, 'sl': 1.09745, 'tp': 1.11245,
+		'open_time': 1634567890, 'close_time': None
+	}
+	tick = {
+		'args': [ { 'product': 'EUR_USD', 'bid': 1.10243, 'ask': 1.10245, 'timestamp': 1634567890.123 } ],
+		'kwargs': {}
+	}
+	positions = { 'positions': [ dict(order, order_id=str(1837252351 + i)) for i in range(50) ] }
+	bars = {
+		'ohlc': [
+			[ 1634567890 + i * 60, 1.1 + i * 1e-5, 1.1002 + i * 1e-5, 1.0998 + i * 1e-5, 1.1001 + i * 1e-5 ]
+			for i in range(1000)
+		]
+	}
+	return {
+		'account': ('broker_reply', account),
+		'order': ('broker_reply', order),
+		'tick': ('account', tick),
+		'positions': ('broker_reply', positions),
+		'bars_1000': ('broker_reply', bars),
+	}
+
+
+def bench(envelope, msg_type, result, iterations):
+	start = time.perf_counter()
+	for _ in range(iterations):
+		frames = envelope.encode(msg_type, 'MSG_ID_0123456789', result)
+	encode = (time.perf_counter() - start) / iterations
+
+	start = time.perf_counter()
+	for _ in range(iterations):
+		envelope.decode(frames)
+	decode = (time.perf_counter() - start) / iterations
+
+	return encode, decode, sum(len(f) for f in frames)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--iterations', type=int, default=10000)
+	args = parser.parse_args(argv)
+
+	print(f'{"payload":<12} {"codec":<18} {"encode us":>10} {"decode us":>10} {"bytes":>8}')
+	for name, (msg_type, result) in payloads().items():
+		iterations = max(1, args.iterations // (100 if name == 'bars_1000' else 1))
+		for codec_name in codec.CODECS:
+			for multipart in (False, True):
+				try:
+					envelope = codec.Envelope(codec.getCodec(codec_name), multipart=multipart)
+				except Exception as e:
+					print(f'{name:<12} {codec_name:<18} {str(e)}')
+					break
+
+				encode, decode, size = bench(envelope, msg_type, result, iterations)
+				label = codec_name + (' multipart' if multipart else '')
+				print(f'{name:<12} {label:<18} {encode * 1e6:>10.2f} {decode * 1e6:>10.2f} {size:>8}')
+
+
+if __name__ == '__main__':
+	main()
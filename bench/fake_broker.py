@@ -0,0 +1,162 @@
+import time
+import zmq
+import shortuuid
+from threading import Thread, Lock
+from app import codec
+from app.replies import STREAM_TYPE
+
+
+class FakeBroker(object):
+
+	def __init__(self, push_url='tcp://127.0.0.1:25564', router_url='tcp://127.0.0.1:25557', codec_name='json', sub_url=None):
+		# Binds the sockets run.py connects to: commands are PUSHed to the
+		# client, replies come back on the ROUTER and, with `sub_url`,
+		# streaming updates arrive on a SUB socket
+		self.push_url = push_url
+		self.router_url = router_url
+		self.sub_url = sub_url
+		self.codec = codec.getCodec(codec_name)
+		self.envelope = codec.Envelope(self.codec)
+
+		self._context = zmq.Context()
+		self._push = self._context.socket(zmq.PUSH)
+		self._push.bind(push_url)
+		self._router = self._context.socket(zmq.ROUTER)
+		self._router.bind(router_url)
+		self._sub = None
+		if sub_url:
+			self._sub = self._context.socket(zmq.SUB)
+			self._sub.setsockopt(zmq.SUBSCRIBE, b'')
+			self._sub.bind(sub_url)
+
+		self._lock = Lock()
+		self._running = False
+		self._pending = {}
+		self.reply_latencies = []
+		self.stream_latencies = []
+		self.quote_latencies = []
+		self.command_latencies = {}
+		self.timings = []
+		self.replies = 0
+		self.updates = 0
+		self.errors = 0
+		self.results = {}
+		self._streams = {}
+
+
+	def start(self):
+		self._running = True
+		Thread(target=self._recv_loop, daemon=True).start()
+
+
+	def stop(self):
+		self._running = False
+
+
+	def send(self, cmd, broker_id=None, args=None, kwargs=None, keep_result=False, stream=None):
+		msg_id = shortuuid.uuid()
+		message = {
+			'cmd': cmd,
+			'broker': 'ib',
+			'broker_id': broker_id,
+			'msg_id': msg_id,
+			'args': args or [],
+			'kwargs': kwargs or {},
+			'ts': time.time()
+		}
+		if stream:
+			message['stream'] = stream
+
+		with self._lock:
+			self._pending[msg_id] = (time.perf_counter(), keep_result, cmd)
+		self._push.send(self.codec.encode(message))
+		return msg_id
+
+
+	def request(self, cmd, broker_id=None, args=None, kwargs=None, timeout=10, stream=None):
+		msg_id = self.send(cmd, broker_id, args, kwargs, keep_result=True, stream=stream)
+		start = time.time()
+		while time.time() - start < timeout:
+			with self._lock:
+				if msg_id in self.results:
+					return self.results.pop(msg_id)
+			time.sleep(0.001)
+
+		raise TimeoutError(f'No reply to {cmd} ({msg_id})')
+
+
+	def outstanding(self):
+		with self._lock:
+			return len(self._pending)
+
+
+	def reset(self):
+		with self._lock:
+			self.reply_latencies = []
+			self.stream_latencies = []
+			self.quote_latencies = []
+			self.command_latencies = {}
+			self.timings = []
+			self.replies = 0
+			self.updates = 0
+			self.errors = 0
+
+
+	def _recv_loop(self):
+		poller = zmq.Poller()
+		poller.register(self._router, zmq.POLLIN)
+		if self._sub is not None:
+			poller.register(self._sub, zmq.POLLIN)
+
+		while self._running:
+			socks = dict(poller.poll(100))
+			# Both carry a leading frame: ROUTER identity or PUB topic
+			for sock in socks:
+				frames = sock.recv_multipart()
+				self._on_message(frames, time.perf_counter())
+
+
+	def _decode(self, frames):
+		# Frames after the ROUTER identity or PUB topic, see `Envelope`
+		return self.envelope.decodeReply(frames[1:])
+
+
+	def _on_message(self, frames, now):
+		msg_type, msg_id, result, timing = self._decode(frames)
+		with self._lock:
+			if msg_type == STREAM_TYPE:
+				# Chunks are kept until the end marker, which completes the
+				# reply as { rows, chunks }
+				chunks = self._streams.setdefault(msg_id, [])
+				if not result.get('end'):
+					chunks.append(result.get('data'))
+					return
+
+				del self._streams[msg_id]
+				msg_type = 'broker_reply'
+				result = dict(result, chunks=chunks)
+
+			if msg_type == 'broker_reply':
+				pending = self._pending.pop(msg_id, None)
+				self.replies += 1
+				if isinstance(result, dict) and 'error' in result:
+					self.errors += 1
+				if pending is not None:
+					sent, keep_result, cmd = pending
+					self.reply_latencies.append(now - sent)
+					self.command_latencies.setdefault(cmd, []).append(now - sent)
+					# Stage timestamps of clients with a `clock`, and when
+					# the reply got here
+					if timing is not None:
+						self.timings.append(dict(timing, cmd=cmd, acked=time.time()))
+					if keep_result:
+						self.results[msg_id] = result
+			else:
+				self.updates += 1
+				# Bench ticks carry their send time as the first argument
+				args = (result or {}).get('args') or []
+				if args and isinstance(args[0], dict) and 'bench_ts' in args[0]:
+					self.stream_latencies.append(time.time() - args[0]['bench_ts'])
+				# Streamed quotes, from the time the quote board took them
+				elif args and isinstance(args[0], dict) and 'bid' in args[0] and 'timestamp' in args[0]:
+					self.quote_latencies.append(time.time() - args[0]['timestamp'])
@@ -0,0 +1,455 @@
+import re
+import ssl
+import json
+import time
+import base64
+import struct
+import random
+import hashlib
+import math
+from datetime import datetime, timezone
+from threading import Thread, Lock, Timer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+API = '/v1/api'
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class FakeGateway(object):
+
+	def __init__(self, latency=0.0, jitter=0.0, latencies=None, accounts=None, seed=0, certfile=None, auth_delay=0.0, fill_delay=0.0, positions=1, history_cap=1000):
+		# `latencies` overrides `latency` per route name, e.g. { 'summary': 0.05 }.
+		# `auth_delay` is how long the brokerage session takes to come up
+		# after a login or reauthenticate, announced on the websocket.
+		# Market orders fill `fill_delay` seconds after being placed, on `sor`.
+		# `positions` is the number of rows in each positions page.
+		# History requests return at most `history_cap` bars
+		self.latency = latency
+		self.jitter = jitter
+		self.latencies = latencies or {}
+		self.accounts = accounts or [ 'DU0000001' ]
+		self.certfile = certfile
+		self.auth_delay = auth_delay
+		self.fill_delay = fill_delay
+		self.positions = positions
+		self.history_cap = history_cap
+
+		self._random = random.Random(seed)
+		self._lock = Lock()
+		self._server = None
+		self._next_order_id = 1000
+		self.logged_in = False
+		self.authenticated = False
+		self.orders = {}
+		self.requests = 0
+		self.counts = {}
+		self.sockets = {}
+		self.socket_messages = []
+		self.quotes = {}
+		self.market_data = set()
+
+		self.routes = [
+			('GET', r'/sso/validate$', 'validate', self._validate),
+			('POST', r'/tickle$', 'tickle', self._tickle),
+			('GET|POST', r'/iserver/auth/status$', 'auth_status', self._auth_status),
+			('GET|POST', r'/iserver/reauthenticate$', 'reauthenticate', self._reauthenticate),
+			('POST', r'/logout$', 'logout', self._logout),
+			('GET', r'/portfolio/accounts$', 'accounts', self._portfolio_accounts),
+			('GET', r'/portfolio/(?P<account_id>[^/]+)/summary$', 'summary', self._portfolio_summary),
+			('GET', r'/portfolio/(?P<account_id>[^/]+)/positions/(?P<page>\d+)$', 'positions', self._portfolio_positions),
+			('GET', r'/iserver/marketdata/snapshot$', 'snapshot', self._marketdata_snapshot),
+			('GET', r'/iserver/marketdata/history$', 'history', self._marketdata_history),
+			('GET', r'/iserver/account/orders$', 'orders', self._account_orders),
+			('POST', r'/iserver/account/(?P<account_id>[^/]+)/orders?$', 'order', self._place_order),
+			('POST', r'/iserver/account/(?P<account_id>[^/]+)/order/(?P<order_id>[^/]+)$', 'modify_order', self._modify_order),
+			('DELETE', r'/iserver/account/(?P<account_id>[^/]+)/order/(?P<order_id>[^/]+)$', 'cancel_order', self._cancel_order),
+		]
+
+
+	@property
+	def port(self):
+		return self._server.server_address[1]
+
+
+	def start(self, port=0, host='127.0.0.1'):
+		gateway = self
+
+		class Handler(BaseHTTPRequestHandler):
+
+			protocol_version = 'HTTP/1.1'
+			disable_nagle_algorithm = True
+
+			def do_GET(self):
+				if self.path == API + '/ws' and self.headers.get('Upgrade', '').lower() == 'websocket':
+					gateway._websocket(self)
+				else:
+					gateway._handle(self, 'GET')
+
+			def do_POST(self):
+				gateway._handle(self, 'POST')
+
+			def do_DELETE(self):
+				gateway._handle(self, 'DELETE')
+
+			def log_message(self, format, *args):
+				pass
+
+		self._server = ThreadingHTTPServer((host, port), Handler)
+		self._server.daemon_threads = True
+		if self.certfile:
+			context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+			context.load_cert_chain(self.certfile)
+			self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+
+		Thread(target=self._server.serve_forever, daemon=True).start()
+		return self.port
+
+
+	def stop(self):
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+
+
+	def _delay(self, name):
+		latency = self.latencies.get(name, self.latency)
+		if self.jitter:
+			with self._lock:
+				latency += self._random.uniform(0, self.jitter)
+		if latency > 0:
+			time.sleep(latency)
+
+
+	def _handle(self, handler, method):
+		url = urlparse(handler.path)
+		length = int(handler.headers.get('Content-Length') or 0)
+		body = handler.rfile.read(length) if length else b''
+		try:
+			payload = json.loads(body) if body else {}
+		except ValueError:
+			payload = {}
+
+		self.requests += 1
+		status, result = 404, { 'error': 'not found' }
+		if url.path == '/bench/login':
+			# Stands in for the browser login form
+			self.logged_in = True
+			self._authenticate()
+			status, result = 200, 'Client login succeeds'
+
+		elif url.path.startswith(API):
+			path = url.path[len(API):]
+			for methods, pattern, name, fn in self.routes:
+				match = re.match(pattern, path)
+				if match and method in methods.split('|'):
+					self.counts[name] = self.counts.get(name, 0) + 1
+					self._delay(name)
+					status, result = fn(payload=payload, query=parse_qs(url.query), **match.groupdict())
+					break
+
+		data = json.dumps(result).encode()
+		handler.send_response(status)
+		handler.send_header('Content-Type', 'application/json')
+		handler.send_header('Content-Length', str(len(data)))
+		handler.end_headers()
+		handler.wfile.write(data)
+
+
+	def _auth(self):
+		return {
+			'authenticated': self.authenticated,
+			'competing': False,
+			'connected': self.logged_in,
+			'message': ''
+		}
+
+
+	def _validate(self, **kwargs):
+		if not self.logged_in:
+			return 401, { 'error': 'not logged in' }
+
+		return 200, {
+			'USER_ID': 1,
+			'USER_NAME': 'bench',
+			'RESULT': True,
+			'AUTH_TIME': int(time.time() * 1000),
+			'EXPIRES': 60 * 60 * 1000
+		}
+
+
+	def _tickle(self, **kwargs):
+		if not self.logged_in:
+			return 401, { 'error': 'not logged in' }
+
+		return 200, {
+			'session': 'bench',
+			'ssoExpires': 60 * 60 * 1000,
+			'collission': False,
+			'userId': 1,
+			'iserver': { 'authStatus': self._auth() }
+		}
+
+
+	def _auth_status(self, **kwargs):
+		return 200, self._auth()
+
+
+	def _reauthenticate(self, **kwargs):
+		if self.logged_in and not self.authenticated:
+			self._authenticate()
+		return 200, { 'message': 'triggered' }
+
+
+	def _authenticate(self):
+		def authenticate():
+			self.authenticated = self.logged_in
+			self.broadcast({ 'topic': 'sts', 'args': { 'authenticated': self.authenticated } })
+
+		if self.auth_delay > 0:
+			Timer(self.auth_delay, authenticate).start()
+		else:
+			authenticate()
+
+
+	def setCompeting(self, competing=True):
+		self.broadcast({ 'topic': 'sts', 'args': { 'competing': competing } })
+
+
+	def broadcast(self, data):
+		message = json.dumps(data).encode()
+		for sock in list(self.sockets):
+			self._ws_send(sock, message)
+
+
+	def _websocket(self, handler):
+		# Just enough of RFC 6455 for text frames, pings and close
+		key = handler.headers['Sec-WebSocket-Key'].encode()
+		accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest()).decode()
+		handler.send_response(101)
+		handler.send_header('Upgrade', 'websocket')
+		handler.send_header('Connection', 'Upgrade')
+		handler.send_header('Sec-WebSocket-Accept', accept)
+		handler.end_headers()
+		handler.wfile.flush()
+		handler.close_connection = True
+
+		sock = handler.connection
+		self.sockets[sock] = Lock()
+		if self.logged_in:
+			self._ws_send(sock, json.dumps({ 'topic': 'system', 'success': 'bench' }).encode())
+		self._ws_send(sock, json.dumps({ 'topic': 'sts', 'args': { 'authenticated': self.authenticated } }).encode())
+
+		try:
+			while True:
+				opcode, payload = self._ws_recv(handler.rfile)
+				if opcode is None or opcode == 0x8:
+					break
+				elif opcode == 0x9:
+					self._ws_send(sock, payload, 0xA)
+				elif opcode == 0x1:
+					message = payload.decode()
+					self.socket_messages.append(message)
+					match = re.match(r'([su])md\+(\d+)', message)
+					if match:
+						conid = int(match.group(2))
+						if match.group(1) == 's':
+							self.market_data.add(conid)
+						else:
+							self.market_data.discard(conid)
+		finally:
+			self.sockets.pop(sock, None)
+
+
+	def _ws_recv(self, rfile):
+		head = rfile.read(2)
+		if len(head) < 2:
+			return None, None
+
+		opcode = head[0] & 0x0F
+		length = head[1] & 0x7F
+		if length == 126:
+			length = struct.unpack('>H', rfile.read(2))[0]
+		elif length == 127:
+			length = struct.unpack('>Q', rfile.read(8))[0]
+		mask = rfile.read(4) if head[1] & 0x80 else b'\0\0\0\0'
+		payload = rfile.read(length)
+		return opcode, bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+	def _ws_send(self, sock, payload, opcode=0x1):
+		length = len(payload)
+		if length < 126:
+			head = struct.pack('>BB', 0x80 | opcode, length)
+		elif length < 65536:
+			head = struct.pack('>BBH', 0x80 | opcode, 126, length)
+		else:
+			head = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+
+		try:
+			with self.sockets.get(sock) or Lock():
+				sock.sendall(head + payload)
+		except OSError:
+			pass
+
+
+	def _logout(self, **kwargs):
+		self.logged_in = False
+		self.authenticated = False
+		return 200, { 'confirmed': True }
+
+
+	def _portfolio_accounts(self, **kwargs):
+		return 200, [
+			{ 'id': i, 'accountId': i, 'currency': 'USD', 'type': 'DEMO' }
+			for i in self.accounts
+		]
+
+
+	def _portfolio_summary(self, account_id, **kwargs):
+		def value(amount):
+			return { 'amount': amount, 'currency': 'USD', 'isNull': False, 'timestamp': int(time.time() * 1000) }
+
+		return 200, {
+			'availablefunds': value(100000.0),
+			'fullavailablefunds': value(100000.0),
+			'initmarginreq': value(0.0),
+			'netliquidation': value(100000.0)
+		}
+
+
+	def _portfolio_positions(self, account_id, page, **kwargs):
+		return 200, [
+			{
+				'acctId': account_id, 'conid': 12087792 + i, 'contractDesc': 'EUR.USD',
+				'position': 100000.0, 'mktPrice': 1.1, 'avgCost': 1.09,
+				'unrealizedPnl': 1000.0, 'currency': 'USD'
+			}
+			for i in range(self.positions)
+		]
+
+
+	def setQuote(self, conid, bid, ask):
+		# Streams to subscribed sockets, as `smd+conid` would
+		self.quotes[conid] = (bid, ask)
+		if conid in self.market_data:
+			self.broadcast(self._quote(conid, topic=f'smd+{conid}'))
+
+
+	def _quote(self, conid, **kwargs):
+		bid, ask = self.quotes.get(conid, (1.1, 1.1002))
+		return dict(
+			kwargs, conid=conid, _updated=int(time.time() * 1000),
+			**{ '31': str(bid), '84': str(bid), '86': str(ask), '88': '1,000K', '85': '1.5M' }
+		)
+
+
+	def _marketdata_snapshot(self, query, **kwargs):
+		conids = query.get('conids', [ '' ])[0].split(',')
+		return 200, [ self._quote(int(i)) for i in conids if i ]
+
+
+	def _marketdata_history(self, query, **kwargs):
+		# Bars back `period` from `startTime`, weekends (roughly, in UTC)
+		# left out and only the latest `history_cap` returned. Prices are
+		# a function of time, so every chunk of a range agrees
+		units = { 'min': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'm': 2592000, 'y': 31536000 }
+		def seconds(value):
+			n, unit = re.match(r'(\d+)([a-z]+)', value).groups()
+			return int(n) * units[unit]
+
+		end = int(datetime.strptime(query['startTime'][0], '%Y%m%d-%H:%M:%S').replace(tzinfo=timezone.utc).timestamp())
+		bar = seconds(query['bar'][0])
+		start = end - seconds(query['period'][0])
+		data = []
+		for t in range(start - start % bar, end, bar):
+			dt = datetime.utcfromtimestamp(t)
+			if (dt.weekday() == 4 and dt.hour >= 22) or dt.weekday() == 5 or (dt.weekday() == 6 and dt.hour < 22):
+				continue
+			o = round(1.1 + 0.01 * math.sin(t / 86400), 5)
+			c = round(1.1 + 0.01 * math.sin((t + bar) / 86400), 5)
+			data.append({ 't': t * 1000, 'o': o, 'h': max(o, c) + 0.0001, 'l': min(o, c) - 0.0001, 'c': c, 'v': 100 })
+
+		data = data[-self.history_cap:]
+		return 200, { 'symbol': query.get('conid', [ '' ])[0], 'data': data, 'points': len(data), 'barLength': bar }
+
+
+	def _account_orders(self, **kwargs):
+		with self._lock:
+			return 200, { 'orders': list(self.orders.values()), 'snapshot': True }
+
+
+	def _place_order(self, account_id, payload, **kwargs):
+		payload = (payload.get('orders') or [ payload ])[0]
+		with self._lock:
+			self._next_order_id += 1
+			order_id = self._next_order_id
+			quantity = float(payload.get('quantity', 0))
+			self.orders[str(order_id)] = {
+				'acct': account_id, 'orderId': order_id, 'conid': payload.get('conid'),
+				'ticker': payload.get('ticker'), 'side': payload.get('side', 'BUY'),
+				'origOrderType': { 'MKT': 'MARKET', 'LMT': 'LIMIT', 'STP': 'STOP' }.get(payload.get('orderType'), 'MARKET'),
+				'price': payload.get('price'), 'remainingQuantity': quantity, 'filledQuantity': 0.0,
+				'status': 'Submitted'
+			}
+			order = dict(self.orders[str(order_id)])
+
+		self._order_update(order)
+		if order['origOrderType'] == 'MARKET':
+			if self.fill_delay > 0:
+				Timer(self.fill_delay, self.fill, args=(order_id,)).start()
+			else:
+				self.fill(order_id)
+
+		return 200, [ { 'order_id': str(order_id), 'order_status': 'Submitted', 'encrypt_message': '1' } ]
+
+
+	def fill(self, order_id, price=None):
+		with self._lock:
+			order = self.orders.get(str(order_id))
+			if order is None:
+				return
+			quantity = order['remainingQuantity'] + order['filledQuantity']
+			bid, ask = self.quotes.get(order['conid'], (1.1, 1.1002))
+			order.update(
+				status='Filled', remainingQuantity=0.0, filledQuantity=quantity,
+				avgPrice=str(price or (ask if order['side'] == 'BUY' else bid)),
+				lastExecutionTime_r=int(time.time() * 1000)
+			)
+			update = {
+				k: order[k] for k in
+				('acct', 'orderId', 'status', 'remainingQuantity', 'filledQuantity', 'avgPrice', 'lastExecutionTime_r')
+			}
+
+		self._order_update(update)
+
+
+	def _order_update(self, row):
+		self.broadcast({ 'topic': 'sor', 'args': [ row ] })
+
+
+	def _modify_order(self, account_id, order_id, payload, **kwargs):
+		with self._lock:
+			if order_id not in self.orders:
+				return 404, { 'error': 'order not found' }
+			order = self.orders[order_id]
+			if 'price' in payload:
+				order['price'] = payload['price']
+			if 'quantity' in payload:
+				order['remainingQuantity'] = float(payload['quantity']) - order['filledQuantity']
+			update = { k: order[k] for k in ('acct', 'orderId', 'price', 'remainingQuantity', 'filledQuantity') }
+
+		self._order_update(update)
+		return 200, [ { 'order_id': order_id, 'order_status': 'Submitted' } ]
+
+
+	def _cancel_order(self, account_id, order_id, **kwargs):
+		with self._lock:
+			order = self.orders.get(order_id)
+			if order is not None:
+				order['status'] = 'Cancelled'
+
+		if order is None:
+			return 404, { 'error': 'order not found' }
+		self._order_update({ 'acct': account_id, 'orderId': order['orderId'], 'status': 'Cancelled' })
+		return 200, { 'order_id': order_id, 'msg': 'Request was submitted', 'conid': -1, 'account': account_id }
@@ -0,0 +1,91 @@
+'''
+CPU per tick against subscriber count: one InstrumentFeed fanning a shared,
+encode-once payload out to N subscriptions, against N independent
+subscriptions each encoding the same tick.
+
+	python -m bench.fanout_bench --ticks 2000 --codec json
+'''
+import os
+import sys
+import time
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import codec
+from app.streaming import Subscription, InstrumentFeed, SharedPayload
+
+
+class Broker(object):
+
+	def __init__(self):
+		self.brokerId = 'bench'
+		self.container = self
+		self.scheduled = []
+
+
+	def publish(self, sub):
+		self.scheduled.append(sub)
+
+
+def flush(broker, envelope):
+	# Mirrors run.publish_loop, minus the socket
+	sent = 0
+	for sub in broker.scheduled:
+		for queued_time, result in sub.drain():
+			if isinstance(result, SharedPayload):
+				frames = envelope.encodePayload(sub.msg_type, sub.msg_id, result.encode(envelope.codec))
+			else:
+				frames = envelope.encode(sub.msg_type, sub.msg_id, result)
+			sent += len(frames)
+	broker.scheduled = []
+	return sent
+
+
+def tick(i):
+	return {
+		'product': 'EUR_USD', 'period': 'M1', 'timestamp': 1634567890 + i * 60,
+		'bar': { 'bid': [ 1.1, 1.1002, 1.0998, 1.1001 ], 'ask': [ 1.1002, 1.1004, 1.1, 1.1003 ] },
+		'bid': 1.1001, 'ask': 1.1003
+	}
+
+
+def run(subscribers, ticks, envelope, shared):
+	broker = Broker()
+	if shared:
+		feed = InstrumentFeed(broker, 'EUR_USD')
+		for i in range(subscribers):
+			feed.add(Subscription(broker, f'msg{i}', 'EUR_USD'))
+		publish = feed.onUpdate
+	else:
+		subs = [ Subscription(broker, f'msg{i}', 'EUR_USD') for i in range(subscribers) ]
+		def publish(*args):
+			for sub in subs:
+				sub.onUpdate(*args)
+
+	start = time.process_time()
+	for i in range(ticks):
+		publish(tick(i))
+		flush(broker, envelope)
+	return (time.process_time() - start) / ticks
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--ticks', type=int, default=2000)
+	parser.add_argument('--codec', default='json')
+	parser.add_argument('--multipart', action='store_true')
+	parser.add_argument('--subscribers', default='1,2,4,8,16,32,64')
+	args = parser.parse_args(argv)
+
+	envelope = codec.Envelope(codec.getCodec(args.codec), multipart=args.multipart)
+	print(f'{"subscribers":>11} {"per-sub us/tick":>16} {"shared us/tick":>15} {"speedup":>8}')
+	for n in map(int, args.subscribers.split(',')):
+		separate = run(n, args.ticks, envelope, False)
+		shared = run(n, args.ticks, envelope, True)
+		print(f'{n:>11} {separate * 1e6:>16.1f} {shared * 1e6:>15.1f} {separate / shared:>7.2f}x')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,110 @@
+'''
+Time to download a long M1 range from a fake gateway that caps bars per
+request: one chunk at a time, chunks fetched concurrently, and a caller
+paging through the range with and without prefetching the next page.
+Then the same range in several periods, each downloaded on its own and
+resampled from cached M1 bars.
+
+	python -m bench.history_bench --years 1 --latency 50 --concurrency 5 --page-days 30 --work 0.5 --periods M1,M5,M15,H1,H4
+'''
+import os
+import sys
+import time
+import argparse
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import quotes, history
+from bench.fake_gateway import FakeGateway
+
+START = 1546300800 # 2019-01-01
+DAY = 86400
+
+
+class Broker(object):
+
+	def __init__(self, port):
+		self.port = port
+		self._url = f'http://127.0.0.1:{port}/v1/api'
+		self._session = requests.session()
+		self._quotes = quotes.QuoteBoard(self)
+
+
+def whole(broker, args, concurrency):
+	downloader = history.HistoryDownloader(broker, concurrency=concurrency, rate=args.rate, prefetch=False)
+	try:
+		start = time.perf_counter()
+		df = downloader.download('EUR_USD', 'M1', start=START, end=START + args.years * 365 * DAY)
+		return time.perf_counter() - start, len(df)
+	finally:
+		downloader.stop()
+
+
+def paged(broker, args, prefetch):
+	# `work` seconds spent on each page before asking for the next
+	downloader = history.HistoryDownloader(broker, concurrency=args.concurrency, rate=args.rate, prefetch=prefetch)
+	try:
+		start = time.perf_counter()
+		bars = 0
+		waited = 0
+		for page in range(int(args.years * 365 / args.page_days)):
+			page_start = START + page * args.page_days * DAY
+			t = time.perf_counter()
+			bars += len(downloader.download('EUR_USD', 'M1', start=page_start, end=page_start + args.page_days * DAY))
+			waited += time.perf_counter() - t
+			time.sleep(args.work)
+		return time.perf_counter() - start, bars, waited
+	finally:
+		downloader.stop()
+
+
+def periods(broker, args, base):
+	downloader = history.HistoryDownloader(broker, concurrency=args.concurrency, rate=args.rate, prefetch=False, base=base)
+	try:
+		start = time.perf_counter()
+		bars = 0
+		for period in args.periods.split(','):
+			bars += len(downloader.download('EUR_USD', period, start=START, end=START + args.years * 365 * DAY))
+		return time.perf_counter() - start, bars
+	finally:
+		downloader.stop()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--years', type=float, default=1)
+	parser.add_argument('--latency', type=float, default=50.0, help='gateway latency in ms')
+	parser.add_argument('--concurrency', type=int, default=5)
+	parser.add_argument('--rate', type=float, default=50, help='history requests per second')
+	parser.add_argument('--page-days', type=int, default=30)
+	parser.add_argument('--work', type=float, default=0.5, help='seconds spent on each page')
+	parser.add_argument('--periods', default='M1,M5,M15,H1,H4')
+	args = parser.parse_args(argv)
+
+	gateway = FakeGateway(latency=args.latency / 1000)
+	broker = Broker(gateway.start())
+	try:
+		print(f'{"mode":<18} {"seconds":>8} {"waiting":>8} {"bars":>8} {"requests":>9}')
+		for name, concurrency in (('sequential', 1), (f'parallel x{args.concurrency}', args.concurrency)):
+			gateway.counts.clear()
+			seconds, bars = whole(broker, args, concurrency)
+			print(f'{name:<18} {seconds:>8.2f} {seconds:>8.2f} {bars:>8} {gateway.counts.get("history", 0):>9}')
+
+		for name, prefetch in (('paged', False), ('paged, prefetch', True)):
+			gateway.counts.clear()
+			seconds, bars, waited = paged(broker, args, prefetch)
+			print(f'{name:<18} {seconds:>8.2f} {waited:>8.2f} {bars:>8} {gateway.counts.get("history", 0):>9}')
+
+		for name, base in (('periods', None), ('periods, resampled', 'M1')):
+			gateway.counts.clear()
+			seconds, bars = periods(broker, args, base)
+			print(f'{name:<18} {seconds:>8.2f} {seconds:>8.2f} {bars:>8} {gateway.counts.get("history", 0):>9}')
+
+	finally:
+		gateway.stop()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,123 @@
+'''
+Fill notification latency: the `sor` stream into an OrderTracker against
+polling /iserver/account/orders.
+
+	python -m bench.order_bench --orders 50 --poll 1
+'''
+import os
+import sys
+import time
+import argparse
+import requests
+from threading import Thread
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import quotes
+from app import tradelib as tl
+from app.orders import OrderTracker
+from app.gateway_socket import GatewaySocket
+from bench.fake_gateway import FakeGateway
+from bench.run_bench import percentile
+
+ACCOUNT_ID = 'DU0000001'
+
+
+class Broker(object):
+
+	def __init__(self, port):
+		self.port = port
+		self._url = f'http://127.0.0.1:{port}/v1/api'
+		self._session = requests.session()
+		self._socket = GatewaySocket(self, f'ws://127.0.0.1:{port}/v1/api/ws')
+		self._quotes = quotes.QuoteBoard(self)
+
+
+	def _on_account_event(self, account_id=None):
+		pass
+
+
+def placeOrders(broker, count, interval):
+	for i in range(count):
+		broker._session.post(
+			f'{broker._url}/iserver/account/{ACCOUNT_ID}/orders',
+			json={ 'orders': [ {
+				'conid': quotes.CONIDS[tl.product.EURUSD], 'orderType': 'MKT',
+				'side': 'BUY' if i % 2 else 'SELL', 'quantity': 10000
+			} ] }
+		)
+		time.sleep(interval)
+
+
+def streamed(broker, gateway, count, interval):
+	latencies = []
+
+	def onEvents(events):
+		# Closes are keyed by the closed position, so match on the latest
+		# fill; orders are far enough apart for that to be unambiguous
+		now = time.time()
+		fills = [ row['lastExecutionTime_r'] / 1000 for row in list(gateway.orders.values()) if 'lastExecutionTime_r' in row ]
+		for event in events.values():
+			if event['type'] in (tl.MARKET_ENTRY, tl.POSITION_CLOSE):
+				latencies.append(now - max(fills))
+
+	tracker = OrderTracker(broker, listener=onEvents)
+	broker._socket.on('sor', tracker.onOrderUpdate)
+	broker._socket.subscribe('sor', 'sor+{}')
+	placeOrders(broker, count, interval)
+	time.sleep(gateway.fill_delay + 0.5)
+	broker._socket.unsubscribe('sor', 'uor+{}')
+	broker._socket.handlers.pop('sor')
+	return latencies
+
+
+def polled(broker, gateway, count, interval, poll):
+	latencies = []
+	seen = set()
+	start = time.time()
+	placed = gateway._next_order_id
+	Thread(target=placeOrders, args=(broker, count, interval), daemon=True).start()
+	while len(seen) < count and time.time() - start < count * interval + poll * 4 + 5:
+		res = broker._session.get(broker._url + '/iserver/account/orders').json()
+		now = time.time()
+		for row in res['orders']:
+			if row['orderId'] > placed and row['status'] == 'Filled' and row['orderId'] not in seen:
+				seen.add(row['orderId'])
+				latencies.append(now - row['lastExecutionTime_r'] / 1000)
+		time.sleep(poll)
+	return latencies
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--orders', type=int, default=50)
+	parser.add_argument('--interval', type=float, default=0.05, help='seconds between orders')
+	parser.add_argument('--fill-delay', type=float, default=0.02)
+	parser.add_argument('--poll', type=float, default=1.0, help='polling interval in seconds')
+	args = parser.parse_args(argv)
+
+	gateway = FakeGateway(fill_delay=args.fill_delay)
+	broker = Broker(gateway.start())
+	broker._socket.start()
+	while not broker._socket.connected:
+		time.sleep(0.01)
+
+	try:
+		print(f'{"mode":<12} {"fills":>6} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+		for name, latencies in (
+			('streamed', streamed(broker, gateway, args.orders, args.interval)),
+			(f'poll {args.poll:g}s', polled(broker, gateway, args.orders, args.interval, args.poll)),
+		):
+			print(
+				f'{name:<12} {len(latencies):>6} {percentile(latencies, 50) * 1000:>9.2f} '
+				f'{percentile(latencies, 99) * 1000:>9.2f} {max(latencies or [ float("nan") ]) * 1000:>9.2f}'
+			)
+
+	finally:
+		broker._socket.stop()
+		gateway.stop()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,94 @@
+'''
+Unrealized P&L for N open positions: Position.getProfit one at a time
+against one PnLEngine pass. Quotes come from memory so only compute is timed.
+
+	python -m bench.pnl_bench --positions 100,1000,10000
+'''
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import tradelib as tl
+from app.pnl import PnLEngine
+
+PRICES = {
+	tl.product.EURUSD: 1.1, tl.product.GBPUSD: 1.3, tl.product.AUDUSD: 0.7,
+	tl.product.NZDUSD: 0.65, tl.product.USDCAD: 1.25, tl.product.USDCHF: 0.92,
+	tl.product.USDJPY: 110.0, tl.product.EURJPY: 128.0,
+}
+
+
+class Broker(object):
+
+	def __init__(self):
+		self.quotes = {
+			p: { 'product': p, 'bid': v, 'ask': v * 1.0001, 'timestamp': time.time() }
+			for p, v in PRICES.items()
+		}
+
+
+	def getQuotes(self, products):
+		return { p: self.quotes[p] for p in products if p in self.quotes }
+
+
+	def getBid(self, product):
+		return self.quotes[product]['bid']
+
+
+	def getAsk(self, product):
+		return self.quotes[product]['ask']
+
+
+def positions(broker, n, seed=0):
+	rand = random.Random(seed)
+	products = list(PRICES)
+	res = []
+	for i in range(n):
+		product = rand.choice(products)
+		res.append(tl.Position(
+			broker, str(i), 'DU0000001', product, tl.MARKET_ENTRY,
+			rand.choice([ tl.LONG, tl.SHORT ]), rand.choice([ 1000, 10000, 100000 ]),
+			entry_price=round(PRICES[product] * rand.uniform(0.99, 1.01), 5), open_time=1
+		))
+	return res
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--positions', default='10,100,1000,10000')
+	parser.add_argument('--repeat', type=int, default=20)
+	args = parser.parse_args(argv)
+
+	broker = Broker()
+	engine = PnLEngine(broker)
+	print(f'{"positions":>9} {"getProfit ms":>13} {"engine ms":>10} {"speedup":>8}')
+	for n in map(int, args.positions.split(',')):
+		pos = positions(broker, n)
+
+		start = time.perf_counter()
+		for _ in range(args.repeat):
+			single = [ p.getProfit() for p in pos ]
+		single_time = (time.perf_counter() - start) / args.repeat
+
+		start = time.perf_counter()
+		for _ in range(args.repeat):
+			res = engine.compute(pos)
+		engine_time = (time.perf_counter() - start) / args.repeat
+
+		mismatched = sum(
+			abs(res['positions'][p.order_id]['pips'] - s) > 0.11
+			for p, s in zip(pos, single)
+		)
+		if mismatched:
+			print(f'{mismatched} positions differ from getProfit')
+
+		print(f'{n:>9} {single_time * 1000:>13.3f} {engine_time * 1000:>10.3f} {single_time / engine_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,92 @@
+'''
+The same workload against one client process and against a pool of worker
+processes: large positions pages, account summaries and order traffic,
+with reads uncached so every command decodes a gateway response.
+
+	python -m bench.pool_bench --workers 4 --users 8 --positions 500 --rate 400
+'''
+import os
+import sys
+import argparse
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from bench.fake_broker import FakeBroker
+from bench.fake_gateway import FakeGateway
+from bench.client import client_main, writeConfig
+from bench.run_bench import ACCOUNT_ID, SCENARIOS, runScenario, waitReady
+from bench.shard_bench import addUsers
+
+PORT_BASE = 5000
+PORTS_PER_WORKER = 1000
+COMMANDS = [
+	('_get_all_positions', [ None, ACCOUNT_ID ], {}),
+	('getAccountInfo', [ None, ACCOUNT_ID ], {}),
+	SCENARIOS['orders'][0],
+	('_get_all_orders', [ None, ACCOUNT_ID ], {}),
+]
+
+
+def runMode(workers, args, base_port):
+	push_url = f'tcp://127.0.0.1:{base_port}'
+	router_url = f'tcp://127.0.0.1:{base_port + 1}'
+	broker = FakeBroker(push_url, router_url)
+	broker.start()
+
+	config_path = writeConfig(push_url, router_url, {
+		'session': { 'relogin_interval': 0, 'relogin_concurrency': args.users },
+		'cache_ttl': { 'accounts': 0, 'summary': 0, 'positions': 0, 'orders': 0 },
+		'workers': workers
+	})
+	# Not a daemon, daemons can't start the pool's workers
+	process = multiprocessing.get_context('fork').Process(
+		target=client_main, args=(config_path, [])
+	)
+	process.start()
+	try:
+		addUsers(broker, args.users)
+		waitReady(broker, args.users)
+		return runScenario(broker, process.pid, COMMANDS, args.users, args.rate, args.duration)
+
+	finally:
+		# Workers exit once the client is gone
+		process.terminate()
+		process.join(10)
+		broker.stop()
+		os.remove(config_path)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--workers', type=int, default=4)
+	parser.add_argument('--users', type=int, default=8)
+	parser.add_argument('--positions', type=int, default=500, help='rows per positions page')
+	parser.add_argument('--rate', type=float, default=400, help='commands per second, across all users')
+	parser.add_argument('--duration', type=float, default=10)
+	parser.add_argument('--latency', type=float, default=5.0, help='gateway latency in ms')
+	args = parser.parse_args(argv)
+
+	# Every worker's range of gateway ports, the first is also used
+	# by the single process
+	gateways = []
+	for k in range(max(args.workers, 1)):
+		for port in range(PORT_BASE + k * PORTS_PER_WORKER, PORT_BASE + k * PORTS_PER_WORKER + args.users):
+			gateway = FakeGateway(latency=args.latency / 1000, positions=args.positions, seed=port)
+			gateway.start(port=port)
+			gateways.append(gateway)
+
+	try:
+		print(f'{"mode":<10} {"replies/s":>10} {"p50 ms":>8} {"p99 ms":>9} {"errors":>7} {"lost":>6}')
+		for i, (name, workers) in enumerate((('single', 0), (f'pool x{args.workers}', args.workers))):
+			res = runMode(workers, args, 26500 + i * 10)
+			print(f'{name:<10} {res["throughput_per_s"]:>10.0f} {res["reply_p50_ms"]:>8.2f} {res["reply_p99_ms"]:>9.2f} {res["errors"]:>7} {res["lost"]:>6}')
+
+	finally:
+		for gateway in gateways:
+			gateway.stop()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,104 @@
+'''
+Cost of pricing N open positions: one snapshot request per position,
+one batched snapshot for all of them, and reads from a streamed quote board.
+
+	python -m bench.quote_bench --positions 50 --latency 5
+'''
+import os
+import sys
+import time
+import argparse
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import quotes
+from app.cache import ReadCache
+from app.gateway_socket import GatewaySocket
+from bench.fake_gateway import FakeGateway
+
+
+class Broker(object):
+
+	def __init__(self, port):
+		self.port = port
+		self._url = f'http://127.0.0.1:{port}/v1/api'
+		self._session = requests.session()
+		self._cache = ReadCache()
+		self._socket = GatewaySocket(self, f'ws://127.0.0.1:{port}/v1/api/ws')
+
+
+def perPosition(broker, products):
+	prices = []
+	for product in products:
+		res = broker._session.get(
+			broker._url + '/iserver/marketdata/snapshot',
+			params={ 'conids': quotes.CONIDS[product], 'fields': ','.join(quotes.FIELDS) }
+		)
+		data = res.json()[0]
+		prices.append((quotes.parsePrice(data[quotes.BID_FIELD]), quotes.parsePrice(data[quotes.ASK_FIELD])))
+	return prices
+
+
+def batched(board, products):
+	board.clear()
+	board.refresh(products)
+	return [ (board.getBid(p), board.getAsk(p)) for p in products ]
+
+
+def streamed(board, products):
+	return [ (board.getBid(p), board.getAsk(p)) for p in products ]
+
+
+def timeit(fn, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		fn()
+	return (time.perf_counter() - start) / repeat
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--positions', type=int, default=50)
+	parser.add_argument('--latency', type=float, default=5.0, help='gateway latency in ms')
+	parser.add_argument('--repeat', type=int, default=20)
+	args = parser.parse_args(argv)
+
+	gateway = FakeGateway(latency=args.latency / 1000)
+	port = gateway.start()
+	broker = Broker(port)
+	board = quotes.QuoteBoard(broker)
+	broker._socket.on('smd', board.onMarketData)
+	broker._socket.start()
+
+	products = [ p for _, p in zip(range(args.positions), list(quotes.CONIDS) * args.positions) ]
+	try:
+		print(f'{"mode":<14} {"ms per pass":>12} {"requests":>9}')
+		for name, fn in (
+			('per-position', lambda: perPosition(broker, products)),
+			('batched', lambda: batched(board, products))
+		):
+			gateway.requests = 0
+			elapsed = timeit(fn, args.repeat)
+			print(f'{name:<14} {elapsed * 1000:>12.3f} {gateway.requests // args.repeat:>9}')
+
+		# Streamed: subscribe, then let the gateway push a quote per conid
+		while not broker._socket.connected:
+			time.sleep(0.01)
+		board.refresh(products)
+		for conid in quotes.CONIDS.values():
+			gateway.setQuote(conid, 1.1, 1.1002)
+		time.sleep(0.2)
+
+		gateway.requests = 0
+		elapsed = timeit(lambda: streamed(board, products), args.repeat * 100)
+		print(f'{"streamed":<14} {elapsed * 1000:>12.3f} {gateway.requests // (args.repeat * 100):>9}')
+
+	finally:
+		broker._socket.stop()
+		gateway.stop()
+
+
+if __name__ == '__main__':
+	main()
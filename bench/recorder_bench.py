@@ -0,0 +1,110 @@
+'''
+Tick recorder costs: time added to each streamed quote, write throughput
+and the process's memory while a day of ticks is recorded, and reading a
+time range through the minute index against scanning the whole day.
+
+	python -m bench.recorder_bench --ticks 2000000 --seek-minutes 5
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import metrics, quotes
+from app.recorder import TickRecorder
+
+DAY_START = 1700006400 # 2023-11-15 00:00 UTC
+CONIDS = list(quotes.CONIDS.values())
+
+
+class Broker(object):
+
+	port = 0
+
+
+def streamed(board, messages):
+	start = time.perf_counter()
+	for data in messages:
+		board.onMarketData(data)
+	return (time.perf_counter() - start) / len(messages)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--ticks', type=int, default=2000000, help='ticks spread over one day')
+	parser.add_argument('--seek-minutes', type=float, default=5, help='length of the range read back')
+	args = parser.parse_args(argv)
+
+	path = tempfile.mkdtemp(prefix='ib-bench-ticks-')
+	recorder = TickRecorder(path, max_queue=args.ticks)
+	try:
+		# Streaming path, with and without recording
+		messages = [
+			{ 'conid': CONIDS[i % len(CONIDS)], '84': str(1.1 + i * 1e-6), '86': str(1.1002 + i * 1e-6), '88': '1,000K' }
+			for i in range(100000)
+		]
+		print(f'{"quote path":<14} {"us per quote":>13}')
+		for name, listener in (
+			('no recorder', None),
+			('recorder', lambda product, quote: recorder.record(quotes.CONIDS[product], quote))
+		):
+			board = quotes.QuoteBoard(Broker(), listener=listener)
+			print(f'{name:<14} {streamed(board, messages) * 1e6:>13.2f}')
+		recorder.stop()
+		shutil.rmtree(path)
+
+		# A day of ticks, queued as fast as they're written
+		recorder = TickRecorder(path, max_queue=100000)
+		step = 86400 / args.ticks
+		rss = []
+		start = time.perf_counter()
+		for i in range(args.ticks):
+			recorder.record(CONIDS[i % len(CONIDS)], {
+				'timestamp': DAY_START + i * step, 'bid': 1.1 + i * 1e-7, 'ask': 1.1002 + i * 1e-7,
+				'bid_size': 1e6, 'ask_size': 1.5e6
+			})
+			while recorder.pending() > 50000:
+				time.sleep(0.001)
+			if i % (args.ticks // 4) == 0:
+				rss.append(metrics.getRSS(os.getpid()) / (1024 * 1024))
+		while recorder.pending():
+			time.sleep(0.01)
+		elapsed = time.perf_counter() - start
+		recorder.stop()
+		rss.append(metrics.getRSS(os.getpid()) / (1024 * 1024))
+		size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+		print()
+		print(f'{"ticks":>9} {"ticks/s":>9} {"file MB":>8}  rss MB at 0, 1/4, 1/2, 3/4, end')
+		print(f'{args.ticks:>9} {args.ticks / elapsed:>9.0f} {size / 1e6:>8.1f}  {", ".join(f"{x:.1f}" for x in rss)}')
+
+		# A range from the middle of the day
+		lo = DAY_START + 43200
+		hi = lo + args.seek_minutes * 60
+		repeat = 100
+		t = time.perf_counter()
+		for _ in range(repeat):
+			ticks = recorder.read(lo, hi)
+		indexed = (time.perf_counter() - t) / repeat
+		t = time.perf_counter()
+		for _ in range(repeat):
+			day = recorder.open('20231115')
+			scanned = day[(day['timestamp'] >= lo) & (day['timestamp'] < hi)]
+		scan = (time.perf_counter() - t) / repeat
+		assert len(ticks) == len(scanned)
+		print()
+		print(f'{"read":<8} {"ms":>8} {"ticks":>8}')
+		for name, seconds, res in (('indexed', indexed, ticks), ('scan', scan, scanned)):
+			print(f'{name:<8} {seconds * 1000:>8.3f} {len(res):>8}')
+
+	finally:
+		recorder.stop()
+		shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,249 @@
+'''
+Replays a day of recorded traffic, the ticks and commands written by the
+`recorder` config, through a client against fake gateways: commands go in
+through the fake broker to `onCommand`, ticks through the gateways'
+websockets to the quote board and chart subscriptions. Reports throughput
+and reply and quote latency distributions.
+
+Events are replayed in recorded order, ticks before commands at equal
+times, against gateways with fixed seeds, so runs over the same recording
+send the same input in the same order; the input digest shows it. Each
+recorded broker_id is replayed as one bench user, and user management
+commands are skipped.
+
+	python -m bench.replay --path instance/ticks --day 20231115 --speed 10
+	python -m bench.replay --synthesize --speed 0 --duration 60
+
+`--speed 1` is real time, `--speed 10` ten times faster and `--speed 0` as
+fast as the client keeps up, with at most `--window` commands outstanding.
+'''
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import metrics, quotes
+from app.recorder import TickRecorder, CommandRecorder
+from bench.fake_broker import FakeBroker
+from bench.fake_gateway import FakeGateway
+from bench.client import client_main, writeConfig
+from bench.run_bench import ACCOUNT_ID, percentile, getCPUTime, waitReady
+
+DAY_START = 1700006400 # 2023-11-15 00:00 UTC
+USER_COMMANDS = ('add_user', 'delete_user', 'replace_user')
+
+
+def synthesize(path, seed, duration, tick_rate, command_rate):
+	# A deterministic recording: random walks for every product and a mix
+	# of reads and orders from three users
+	rng = random.Random(seed)
+	ticks = TickRecorder(path)
+	commands = CommandRecorder(path)
+	prices = { conid: 1.1 for conid in quotes.CONIDS.values() }
+	for i in range(int(duration * tick_rate)):
+		conid = rng.choice(sorted(prices))
+		prices[conid] = round(prices[conid] + rng.choice((-1, 1)) * 1e-5, 5)
+		ticks.record(conid, {
+			'timestamp': DAY_START + i / tick_rate,
+			'bid': prices[conid], 'ask': round(prices[conid] + 2e-5, 5),
+			'bid_size': 1e6, 'ask_size': 1e6
+		})
+
+	mix = [
+		('getAccountInfo', [ None, ACCOUNT_ID ]),
+		('_get_all_positions', [ None, ACCOUNT_ID ]),
+		('_get_all_orders', [ None, ACCOUNT_ID ]),
+		('createOrder', [ None, 'EUR_USD', 1, 'long', ACCOUNT_ID, 'marketorder', None, None, None, None, None, None ]),
+		('isLoggedIn', []),
+	]
+	for i in range(int(duration * command_rate)):
+		cmd, args = mix[rng.randrange(len(mix))]
+		commands.record({
+			'cmd': cmd, 'broker': 'ib', 'broker_id': f'live{rng.randrange(3)}',
+			'msg_id': f'msg{i}', 'args': args, 'kwargs': {}
+		}, ts=DAY_START + i / command_rate + rng.random() / command_rate)
+
+	ticks.stop()
+	commands.stop()
+	return time.strftime('%Y%m%d', time.gmtime(DAY_START))
+
+
+def loadRecording(path, day, duration=None):
+	ticks = TickRecorder(path).open(day)
+	if ticks is None:
+		ticks = TickRecorder(path).read(0, 0)
+	commands = [ (ts, message) for ts, message in CommandRecorder(path).read(day) if message.get('cmd') not in USER_COMMANDS ]
+	commands.sort(key=lambda item: item[0])
+
+	if duration is not None:
+		start = min(([ ticks['timestamp'][0] ] if len(ticks) else []) + ([ commands[0][0] ] if commands else []) or [ 0 ])
+		ticks = ticks[:ticks['timestamp'].searchsorted(start + duration)]
+		commands = [ item for item in commands if item[0] < start + duration ]
+
+	# Recorded users in order of first appearance
+	users = {}
+	for _, message in commands:
+		if message.get('broker_id') is not None:
+			users.setdefault(message['broker_id'], len(users))
+
+	digest = hashlib.sha1(ticks.tobytes())
+	for ts, message in commands:
+		digest.update(json.dumps([ ts, message ], sort_keys=True).encode())
+	return ticks, commands, users, digest.hexdigest()[:12]
+
+
+def remap(message, users):
+	message = dict(message)
+	if message.get('broker_id') is not None:
+		message['broker_id'] = f'broker{users[message["broker_id"]]}'
+	if message.get('cmd') == 'find_user':
+		args = list(message['args'])
+		args[2] = f'broker{users.get(args[2], 0)}'
+		message['args'] = args
+	return message
+
+
+def replay(broker, gateways, ticks, commands, users, speed, window):
+	# Ticks and commands merged by time, each sent when its recorded time
+	# comes around at `speed`, or straight away at 0
+	products = { v: k for k, v in quotes.CONIDS.items() }
+	timestamps = ticks['timestamp']
+	start = min(timestamps[0] if len(timestamps) else float('inf'), commands[0][0] if commands else float('inf'))
+	i = j = 0
+	sent = 0
+	clock = time.perf_counter()
+	while i < len(ticks) or j < len(commands):
+		is_tick = j >= len(commands) or (i < len(ticks) and timestamps[i] <= commands[j][0])
+		ts = timestamps[i] if is_tick else commands[j][0]
+		if speed:
+			delay = clock + (ts - start) / speed - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+
+		if is_tick:
+			tick = ticks[i]
+			if int(tick['conid']) in products:
+				for gateway in gateways:
+					gateway.setQuote(int(tick['conid']), float(tick['bid']), float(tick['ask']))
+			i += 1
+		else:
+			if not speed:
+				while broker.outstanding() >= window:
+					time.sleep(0.0005)
+			message = remap(commands[j][1], users)
+			broker.send(message['cmd'], message.get('broker_id'), message.get('args'), message.get('kwargs'))
+			sent += 1
+			j += 1
+
+	return sent
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--path', default=None, help='recorder path')
+	parser.add_argument('--day', default=None, help='YYYYMMDD')
+	parser.add_argument('--synthesize', action='store_true', help='replay a generated recording instead')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--duration', type=float, default=None, help='seconds of the recording to replay')
+	parser.add_argument('--tick-rate', type=float, default=200, help='synthesized ticks per second')
+	parser.add_argument('--command-rate', type=float, default=50, help='synthesized commands per second')
+	parser.add_argument('--speed', type=float, default=1, help='1 real time, 0 as fast as possible')
+	parser.add_argument('--window', type=int, default=100, help='outstanding commands as fast as possible')
+	parser.add_argument('--latency', type=float, default=5.0, help='gateway latency in ms')
+	parser.add_argument('--push-url', default='tcp://127.0.0.1:25664')
+	parser.add_argument('--router-url', default='tcp://127.0.0.1:25657')
+	parser.add_argument('--json', action='store_true', help='print results as JSON')
+	args = parser.parse_args(argv)
+
+	path, day = args.path, args.day
+	if args.synthesize:
+		path = tempfile.mkdtemp(prefix='ib-replay-')
+		day = synthesize(path, args.seed, args.duration or 60, args.tick_rate, args.command_rate)
+	ticks, commands, users, digest = loadRecording(path, day, args.duration)
+
+	broker = FakeBroker(args.push_url, args.router_url)
+	broker.start()
+	gateways = [ FakeGateway(latency=args.latency / 1000, seed=args.seed + i) for i in range(max(len(users), 1)) ]
+	ports = [ gateway.start() for gateway in gateways ]
+	config_path = writeConfig(args.push_url, args.router_url)
+	process = multiprocessing.get_context('fork').Process(target=client_main, args=(config_path, ports), daemon=True)
+	process.start()
+
+	try:
+		waitReady(broker, len(gateways))
+		# Recorded instruments are streamed to a chart subscription
+		conids = sorted(set(int(c) for c in ticks['conid']) & set(quotes.CONIDS.values()))
+		products = { v: k for k, v in quotes.CONIDS.items() }
+		for conid in conids:
+			broker.request('_subscribe_chart_updates', 'broker0', [ None, f'replay-{conid}', products[conid] ])
+		deadline = time.time() + 10
+		while time.time() < deadline and not all(c in gateways[0].market_data for c in conids):
+			time.sleep(0.05)
+
+		broker.reset()
+		cpu_start = getCPUTime(process.pid)
+		start = time.time()
+		sent = replay(broker, gateways, ticks, commands, users, args.speed, args.window)
+		deadline = time.time() + 30
+		while broker.outstanding() and time.time() < deadline:
+			time.sleep(0.01)
+		time.sleep(0.2)
+		elapsed = time.time() - start
+		cpu = getCPUTime(process.pid) - cpu_start
+
+		res = {
+			'input': digest,
+			'speed': args.speed,
+			'ticks': len(ticks),
+			'commands': sent,
+			'users': len(users),
+			'elapsed_s': elapsed,
+			'replies': broker.replies,
+			'errors': broker.errors,
+			'lost': broker.outstanding(),
+			'replies_per_s': broker.replies / elapsed,
+			'quotes': len(broker.quote_latencies),
+			'quotes_per_s': len(broker.quote_latencies) / elapsed,
+			'client_cpu_pct': cpu / elapsed * 100,
+			'client_rss_mb': (metrics.getRSS(process.pid) or 0) / (1024 * 1024),
+			'latency_ms': {},
+		}
+		for name, latencies in sorted(broker.command_latencies.items()) + [ ('all', broker.reply_latencies), ('quotes', broker.quote_latencies) ]:
+			res['latency_ms'][name] = {
+				'count': len(latencies),
+				**{ f'p{p}': percentile(latencies, p) * 1000 for p in (50, 90, 99) },
+				'max': (max(latencies) if latencies else float('nan')) * 1000
+			}
+
+	finally:
+		process.terminate()
+		process.join(5)
+		broker.stop()
+		for gateway in gateways:
+			gateway.stop()
+		os.remove(config_path)
+
+	if args.json:
+		print(json.dumps(res, indent=2))
+	else:
+		for k, v in res.items():
+			if k != 'latency_ms':
+				print(f'{k:>16}: {v:.3f}' if isinstance(v, float) else f'{k:>16}: {v}')
+		print()
+		print(f'{"latency ms":<20} {"count":>7} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}')
+		for name, v in res['latency_ms'].items():
+			print(f'{name:<20} {v["count"]:>7} {v["p50"]:>8.2f} {v["p90"]:>8.2f} {v["p99"]:>8.2f} {v["max"]:>8.2f}')
+
+	return res
+
+
+if __name__ == '__main__':
+	main()
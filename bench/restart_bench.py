@@ -0,0 +1,159 @@
+'''
+Time for a client restart to bring N users back: a cold start adding each
+user again, against restoring them from the registry with `--dead` of the
+gateways killed. Users left logged out are added again, as the broker does
+once find_user stops finding them. Gateways are idle processes named like
+the real JVM, fronted by fake gateways; the browser and login are modeled
+with sleeps.
+
+	python -m bench.restart_bench --users 4 --dead 1 --login 3 --chrome 1
+'''
+import os
+import sys
+import time
+import signal
+import tempfile
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import ib
+from app.registry import UserRegistry
+from app.supervisor import AttachedProcess
+from bench.fake_gateway import FakeGateway
+from bench.client import writeConfig
+
+GATEWAY_SCRIPT = f'''#!/bin/sh
+exec {sys.executable} -c "import time; time.sleep(1e9)" {ib.GATEWAY_MAIN} -port "$2"
+'''
+
+
+class Driver(object):
+
+	def quit(self):
+		pass
+
+
+def benchIB(chrome_time, login_time):
+
+	class BenchIB(ib.IB):
+
+		def _create_webdriver(self):
+			time.sleep(chrome_time)
+			self.driver = Driver()
+
+
+		def login(self):
+			if self.driver is None:
+				self._create_webdriver()
+			time.sleep(login_time)
+			self._session.post(self._url.split('/v1/api')[0] + '/bench/login')
+
+	return BenchIB
+
+
+def addUsers(container, ports):
+	# One at a time, as `onAddUser` does
+	for i, port in enumerate(ports):
+		container.addUser(str(port), f'user{i}', 'bench', f'broker{i}', 'bench', 'bench', i == 0)
+
+
+def readdUsers(container, interval=1, timeout=120):
+	# The registry keeps no credentials: as the broker does, users
+	# find_user doesn't find are added again with them
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		time.sleep(interval)
+		missing = [
+			user for user in container.users.values()
+			if container.findUser(user.userId, user.strategyId, user.brokerId) == -1
+		]
+		if not missing:
+			return
+		for user in missing:
+			if user.password is None:
+				user.setCredentials('bench', 'bench')
+
+
+def waitLoggedIn(container, timeout=120):
+	# Users start in the background, the restart is over once all are in
+	deadline = time.time() + timeout
+	for user in container.users.values():
+		user._logged_in.wait(max(deadline - time.time(), 0))
+
+
+def detach(container):
+	# The client dies, its gateways don't
+	for user in container.users.values():
+		user._running = False
+		user._supervisor.stop()
+		user._socket.stop()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--users', type=int, default=4)
+	parser.add_argument('--dead', type=int, default=1, help='gateways killed along with the client')
+	parser.add_argument('--login', type=float, default=3.0, help='seconds per browser login')
+	parser.add_argument('--chrome', type=float, default=1.0, help='seconds to start the browser')
+	args = parser.parse_args(argv)
+
+	fd, script = tempfile.mkstemp(prefix='ib-bench-gateway-', suffix='.sh')
+	with os.fdopen(fd, 'w') as f:
+		f.write(GATEWAY_SCRIPT)
+	os.chmod(script, 0o700)
+	ib.GATEWAY_RUN_DIR = script
+
+	registry_path = tempfile.mktemp(prefix='ib-bench-registry-', suffix='.json')
+	config_path = writeConfig('tcp://127.0.0.1:25564', 'tcp://127.0.0.1:25557', { 'registry': registry_path })
+	os.environ['IB_CONFIG'] = config_path
+	ib.GATEWAY_URL = 'http://127.0.0.1:{port}/v1/api'
+
+	import run
+	run.IB = benchIB(args.chrome, args.login)
+
+	gateways = [ FakeGateway() for _ in range(args.users) ]
+	ports = [ gateway.start() for gateway in gateways ]
+	containers = []
+	try:
+		cold = run.UserContainer(registry=UserRegistry(registry_path))
+		containers.append(cold)
+		start = time.time()
+		addUsers(cold, ports)
+		waitLoggedIn(cold)
+		cold_time = time.time() - start
+		detach(cold)
+
+		for user, gateway in list(zip(cold.users.values(), gateways))[:args.dead]:
+			os.kill(user._gateway_process.pid, signal.SIGKILL)
+			gateway.logged_in = gateway.authenticated = False
+
+		warm = run.UserContainer(registry=UserRegistry(registry_path))
+		containers.append(warm)
+		start = time.time()
+		warm.restore()
+		readdUsers(warm)
+		waitLoggedIn(warm)
+		warm_time = time.time() - start
+
+		attached = sum(isinstance(user._gateway_process, AttachedProcess) for user in warm.users.values())
+		logged_in = sum(user._logged_in.is_set() for user in warm.users.values())
+		print(f'{"start":<10} {"seconds":>8} {"users":>6} {"attached":>9} {"logged in":>10}')
+		print(f'{"cold":<10} {cold_time:>8.2f} {len(cold.users):>6} {0:>9} {args.users:>10}')
+		print(f'{"restore":<10} {warm_time:>8.2f} {len(warm.users):>6} {attached:>9} {logged_in:>10}')
+
+	finally:
+		# Restored users first, they own the gateways now
+		for container in reversed(containers):
+			for user in container.users.values():
+				user.stop()
+		for gateway in gateways:
+			gateway.stop()
+		for path in (script, config_path, registry_path):
+			if os.path.exists(path):
+				os.remove(path)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,192 @@
+'''
+End-to-end benchmark: a fake ZMQ broker and fake Client Portal gateways
+drive run.py in a child process, entirely offline.
+
+	python -m bench.run_bench --scenario mixed --users 4 --rate 200 --duration 10
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import metrics
+from bench.fake_broker import FakeBroker
+from bench.fake_gateway import FakeGateway
+from bench.client import client_main, writeConfig
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+ACCOUNT_ID = 'DU0000001'
+
+SCENARIOS = {
+	'accounts': [
+		('getAccountInfo', [ None, ACCOUNT_ID ], {}),
+	],
+	'orders': [
+		('createOrder', [ None, 'EUR_USD', 1, 'long', ACCOUNT_ID, 'marketorder', None, None, None, None, None, None ], {}),
+		('_get_all_positions', [ None, ACCOUNT_ID ], {}),
+	],
+	'mixed': [
+		('getAccountInfo', [ None, ACCOUNT_ID ], {}),
+		('_get_all_positions', [ None, ACCOUNT_ID ], {}),
+		('isLoggedIn', [], {}),
+		('find_user', [ 'user0', 'bench', 'broker0' ], {}),
+	],
+	'lookups': [
+		('find_user', [ 'user0', 'bench', 'broker0' ], {}),
+		('findUnusedPort', [ [] ], {}),
+	],
+}
+
+
+def percentile(values, p):
+	if not values:
+		return float('nan')
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def getCPUTime(pid):
+	with open(f'/proc/{pid}/stat', 'r') as f:
+		fields = f.read().rsplit(')', 1)[1].split()
+	return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def summarize(name, latencies):
+	return {
+		f'{name}_count': len(latencies),
+		f'{name}_p50_ms': percentile(latencies, 50) * 1000,
+		f'{name}_p99_ms': percentile(latencies, 99) * 1000,
+		f'{name}_max_ms': (max(latencies) if latencies else float('nan')) * 1000,
+	}
+
+
+def waitReady(broker, users, timeout=60):
+	start = time.time()
+	for i in range(users):
+		while True:
+			try:
+				if broker.request('isLoggedIn', f'broker{i}', timeout=2).get('result'):
+					break
+			except TimeoutError:
+				pass
+			if time.time() - start > timeout:
+				raise TimeoutError('Client did not become ready.')
+			time.sleep(0.1)
+
+
+def runScenario(broker, client_pid, commands, users, rate, duration, drain_timeout=30):
+	broker.reset()
+	cpu_start = getCPUTime(client_pid)
+	rss_peak = 0
+
+	interval = 1.0 / rate
+	start = time.time()
+	next_time = start
+	sent = 0
+	while time.time() - start < duration:
+		cmd, args, kwargs = commands[sent % len(commands)]
+		broker.send(cmd, f'broker{sent % users}', args, kwargs)
+		sent += 1
+
+		if sent % 100 == 0:
+			rss_peak = max(rss_peak, metrics.getRSS(client_pid) or 0)
+
+		next_time += interval
+		delay = next_time - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+	drain_start = time.time()
+	while broker.outstanding() and time.time() - drain_start < drain_timeout:
+		time.sleep(0.01)
+
+	elapsed = time.time() - start
+	cpu = getCPUTime(client_pid) - cpu_start
+	rss_peak = max(rss_peak, metrics.getRSS(client_pid) or 0)
+
+	res = {
+		'sent': sent,
+		'replies': broker.replies,
+		'errors': broker.errors,
+		'lost': broker.outstanding(),
+		'updates': broker.updates,
+		'elapsed_s': elapsed,
+		'throughput_per_s': broker.replies / elapsed,
+		'client_cpu_pct': cpu / elapsed * 100,
+		'client_rss_mb': rss_peak / (1024 * 1024),
+	}
+	res.update(summarize('reply', broker.reply_latencies))
+	res.update(summarize('stream', broker.stream_latencies))
+	return res
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+	parser.add_argument('--users', type=int, default=2)
+	parser.add_argument('--rate', type=float, default=100, help='commands per second, across all users')
+	parser.add_argument('--duration', type=float, default=10)
+	parser.add_argument('--ticks', type=float, default=0, help='streamed ticks per second, per user')
+	parser.add_argument('--latency', type=float, default=0.0, help='gateway latency in ms')
+	parser.add_argument('--jitter', type=float, default=0.0, help='gateway latency jitter in ms')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--push-url', default='tcp://127.0.0.1:25564')
+	parser.add_argument('--router-url', default='tcp://127.0.0.1:25557')
+	parser.add_argument('--codec', default='json', help='wire codec: json, orjson or msgpack')
+	parser.add_argument('--multipart', action='store_true', help='send replies as multipart frames')
+	parser.add_argument('--pub-url', default=None, help='publish streaming updates on a separate PUB socket, e.g. tcp://127.0.0.1:25558')
+	parser.add_argument('--json', action='store_true', help='print results as JSON')
+	args = parser.parse_args(argv)
+
+	broker = FakeBroker(args.push_url, args.router_url, args.codec, args.pub_url)
+	broker.start()
+
+	gateways = [
+		FakeGateway(latency=args.latency / 1000, jitter=args.jitter / 1000, seed=args.seed + i)
+		for i in range(args.users)
+	]
+	ports = [ gateway.start() for gateway in gateways ]
+
+	config_path = writeConfig(args.push_url, args.router_url, {
+		'codec': args.codec,
+		'multipart': args.multipart,
+		'zmq_pub_url': args.pub_url
+	})
+	process = multiprocessing.get_context('fork').Process(
+		target=client_main, args=(config_path, ports, args.ticks), daemon=True
+	)
+	process.start()
+
+	try:
+		waitReady(broker, args.users)
+		res = runScenario(broker, process.pid, SCENARIOS[args.scenario], args.users, args.rate, args.duration)
+		res.update({
+			'scenario': args.scenario, 'users': args.users, 'rate': args.rate,
+			'ticks': args.ticks, 'latency_ms': args.latency,
+			'codec': args.codec, 'multipart': args.multipart, 'pub': bool(args.pub_url)
+		})
+
+	finally:
+		process.terminate()
+		process.join(5)
+		broker.stop()
+		for gateway in gateways:
+			gateway.stop()
+		os.remove(config_path)
+
+	if args.json:
+		print(json.dumps(res, indent=2))
+	else:
+		for k, v in res.items():
+			print(f'{k:>20}: {v:.3f}' if isinstance(v, float) else f'{k:>20}: {v}')
+
+	return res
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,106 @@
+'''
+Throughput as users are sharded over more client processes: for each
+shard count, users are added through `add_user`, land on the shard owning
+their broker_id, and a fixed command rate is sent through the fake broker,
+which spreads it across shards like the real PUSH socket does. Reads
+aren't cached, so each shard is bound by its command loop waiting on
+gateway latency.
+
+	python -m bench.shard_bench --shards 1,2,4 --users 8 --rate 1000 --latency 5
+'''
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from bench.fake_broker import FakeBroker
+from bench.fake_gateway import FakeGateway
+from bench.client import client_main, writeConfig
+from bench.run_bench import SCENARIOS, runScenario, waitReady
+
+
+def addUsers(broker, users, timeout=30):
+	# Retried until the shards have found each other and taken commands
+	start = time.time()
+	for i in range(users):
+		while True:
+			try:
+				broker.request('add_user', None, [ f'user{i}', 'bench', f'broker{i}', 'bench', 'bench', i == 0 ], timeout=5)
+				break
+			except TimeoutError:
+				if time.time() - start > timeout:
+					raise
+
+
+def runShards(shards, args, base_port):
+	push_url = f'tcp://127.0.0.1:{base_port}'
+	router_url = f'tcp://127.0.0.1:{base_port + 1}'
+	broker = FakeBroker(push_url, router_url)
+	broker.start()
+
+	shard_urls = [ f'tcp://127.0.0.1:{base_port + 10 + 2 * k}' for k in range(shards) ]
+	gateways = []
+	processes = []
+	configs = []
+	try:
+		for k, url in enumerate(shard_urls):
+			port_base = base_port + 1000 * (k + 1)
+			# Enough gateways for every user to land on this shard
+			for port in range(port_base, port_base + args.users):
+				gateway = FakeGateway(latency=args.latency / 1000, seed=port)
+				gateway.start(port=port)
+				gateways.append(gateway)
+
+			configs.append(writeConfig(push_url, router_url, {
+				'session': { 'relogin_interval': 0, 'relogin_concurrency': args.users },
+				'cache_ttl': { 'accounts': 0, 'summary': 0, 'positions': 0, 'orders': 0 },
+				'shard': {
+					'id': f'shard{k}', 'url': url, 'peers': shard_urls,
+					'port_base': port_base, 'heartbeat': 0.5, 'timeout': 3, 'secret': 'bench'
+				}
+			}))
+			process = multiprocessing.get_context('fork').Process(
+				target=client_main, args=(configs[-1], []), daemon=True
+			)
+			process.start()
+			processes.append(process)
+
+		addUsers(broker, args.users)
+		waitReady(broker, args.users)
+		res = runScenario(broker, processes[0].pid, SCENARIOS[args.scenario], args.users, args.rate, args.duration)
+
+	finally:
+		for process in processes:
+			process.terminate()
+			process.join(5)
+		broker.stop()
+		for gateway in gateways:
+			gateway.stop()
+		for path in configs:
+			os.remove(path)
+
+	return res
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--shards', default='1,2,4')
+	parser.add_argument('--users', type=int, default=8)
+	parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+	parser.add_argument('--rate', type=float, default=1000, help='commands per second, across all users')
+	parser.add_argument('--duration', type=float, default=10)
+	parser.add_argument('--latency', type=float, default=5.0, help='gateway latency in ms')
+	args = parser.parse_args(argv)
+
+	print(f'{"shards":>6} {"replies/s":>10} {"p50 ms":>8} {"p99 ms":>9} {"lost":>6}')
+	for i, shards in enumerate(map(int, args.shards.split(','))):
+		res = runShards(shards, args, 26000 + i * 100)
+		print(f'{shards:>6} {res["throughput_per_s"]:>10.0f} {res["reply_p50_ms"]:>8.2f} {res["reply_p99_ms"]:>9.2f} {res["lost"]:>6}')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,124 @@
+'''
+Client startup: the import time of `app.ib` and `run` in a fresh
+interpreter, broken down by top-level package from `python -X importtime`,
+then how long adding a user blocks against when its gateway is running and
+logged in. The gateway start, browser and login are modeled with sleeps.
+
+	python -m bench.startup_bench --repeat 5 --top 8 --gateway 2 --chrome 1 --login 3
+'''
+import os
+import sys
+import time
+import argparse
+import subprocess
+from collections import defaultdict
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from bench.fake_gateway import FakeGateway
+from bench.client import writeConfig
+
+
+def profileImport(module, config_path):
+	# Self time by top-level package, and the module's own cumulative time
+	env = dict(os.environ, IB_CONFIG=config_path)
+	proc = subprocess.run(
+		[ sys.executable, '-X', 'importtime', '-c', f'import {module}' ],
+		cwd=ROOT_DIR, env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+		universal_newlines=True, check=True
+	)
+	packages = defaultdict(int)
+	total = 0
+	for line in proc.stderr.splitlines():
+		if not line.startswith('import time:') or 'self [us]' in line:
+			continue
+		self_us, cumulative, name = line[len('import time:'):].split('|')
+		packages[name.strip().split('.')[0]] += int(self_us)
+		if name.strip() == module:
+			total = int(cumulative)
+	return total / 1000, { k: v / 1000 for k, v in packages.items() }
+
+
+def benchIB(gateway_time, chrome_time, login_time):
+	from app import ib
+
+	class Driver(object):
+
+		def quit(self):
+			pass
+
+	class BenchIB(ib.IB):
+
+		def _start_gateway(self):
+			time.sleep(gateway_time)
+			self._is_gateway_loaded.set()
+			return { 'complete': True }
+
+
+		def _stop_gateway(self):
+			self._is_gateway_loaded.clear()
+
+
+		def _create_webdriver(self):
+			time.sleep(chrome_time)
+			self.driver = Driver()
+
+
+		def login(self):
+			if self.driver is None:
+				self._create_webdriver()
+			time.sleep(login_time)
+			self._session.post(self._url.split('/v1/api')[0] + '/bench/login')
+
+	return BenchIB
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per module')
+	parser.add_argument('--top', type=int, default=8, help='packages listed per module')
+	parser.add_argument('--gateway', type=float, default=2.0, help='seconds to start the gateway')
+	parser.add_argument('--chrome', type=float, default=1.0, help='seconds to start the browser')
+	parser.add_argument('--login', type=float, default=3.0, help='seconds per browser login')
+	args = parser.parse_args(argv)
+
+	config_path = writeConfig('tcp://127.0.0.1:25764', 'tcp://127.0.0.1:25757')
+	try:
+		for module in ('app.ib', 'run'):
+			runs = sorted((profileImport(module, config_path) for _ in range(args.repeat)), key=lambda r: r[0])
+			total, packages = runs[len(runs) // 2]
+			print(f'import {module}: {total:.1f} ms (median of {args.repeat})')
+			for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+				print(f'  {name:<24} {ms:>8.1f} ms')
+			print()
+	finally:
+		os.remove(config_path)
+
+	from app import ib
+	ib.GATEWAY_URL = 'http://127.0.0.1:{port}/v1/api'
+	gateway = FakeGateway()
+	port = gateway.start()
+	user = None
+	try:
+		start = time.perf_counter()
+		user = benchIB(args.gateway, args.chrome, args.login)(None, str(port), 'user0', 'bench', 'broker0', 'bench', 'bench')
+		returned = time.perf_counter() - start
+		user._is_gateway_loaded.wait(60)
+		loaded = time.perf_counter() - start
+		user._logged_in.wait(60)
+		logged_in = time.perf_counter() - start
+
+		print(f'{"add user":<18} {"seconds":>8}')
+		print(f'{"returned":<18} {returned:>8.3f}')
+		print(f'{"gateway loaded":<18} {loaded:>8.3f}')
+		print(f'{"logged in":<18} {logged_in:>8.3f}')
+
+	finally:
+		if user is not None:
+			user.stop()
+		gateway.stop()
+
+
+if __name__ == '__main__':
+	main()
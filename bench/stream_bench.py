@@ -0,0 +1,113 @@
+'''
+Cost of replying with a long history download: one JSON reply, a
+streamed reply of JSON chunks, and a streamed reply of raw column buffers.
+Each mode runs in a fresh client with the range already downloaded once,
+or with `--cold` downloaded from the gateway at `--latency`, while small
+commands keep arriving, and reports the time to the end of the reply, the
+latency of the commands sent meanwhile, and the client's memory growth.
+
+	python -m bench.stream_bench --days 120 --rows 5000 --rate 100
+	python -m bench.stream_bench --days 365 --cold --latency 50
+'''
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from threading import Thread
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from app import metrics
+from bench.fake_broker import FakeBroker
+from bench.fake_gateway import FakeGateway
+from bench.client import client_main, writeConfig
+from bench.run_bench import percentile, waitReady
+
+START = 1546300800 # 2019-01-01
+MODES = [
+	('reply', None, False),
+	('stream json', {}, False),
+	('stream columns', { 'columns': True }, True),
+]
+
+
+def runMode(gateway_port, stream, multipart, args, base_port):
+	push_url = f'tcp://127.0.0.1:{base_port}'
+	router_url = f'tcp://127.0.0.1:{base_port + 1}'
+	broker = FakeBroker(push_url, router_url)
+	broker.start()
+
+	config_path = writeConfig(push_url, router_url, {
+		'multipart': multipart,
+		'history': { 'cache_chunks': 10000 }
+	})
+	process = multiprocessing.get_context('fork').Process(
+		target=client_main, args=(config_path, [ gateway_port ]), daemon=True
+	)
+	process.start()
+	history_args = [ None, 'EUR_USD', 'M1' ]
+	history_kwargs = { 'start': START, 'end': START + args.days * 86400 }
+	try:
+		waitReady(broker, 1)
+		# Downloaded once, so only the reply is measured
+		if not args.cold:
+			broker.request('_download_historical_data_broker', 'broker0', history_args, history_kwargs, timeout=600, stream={ 'columns': True })
+		rss_start = metrics.getRSS(process.pid) or 0
+		rss_peak = [ rss_start ]
+		done = []
+
+		def sample():
+			while not done:
+				rss_peak[0] = max(rss_peak[0], metrics.getRSS(process.pid) or 0)
+				if broker.outstanding() < 100:
+					broker.send('isLoggedIn', 'broker0')
+				time.sleep(1 / args.rate)
+
+		broker.reset()
+		t = Thread(target=sample, daemon=True)
+		t.start()
+		start = time.perf_counter()
+		if stream is not None:
+			stream = dict(stream, rows=args.rows)
+		res = broker.request('_download_historical_data_broker', 'broker0', history_args, history_kwargs, timeout=600, stream=stream)
+		elapsed = time.perf_counter() - start
+		done.append(True)
+		t.join()
+
+		rows = res['rows'] if stream is not None else len(res['timestamp'])
+		# The history reply is the slowest one
+		latencies = sorted(broker.reply_latencies)[:-1]
+		return elapsed, rows, latencies, (rss_peak[0] - rss_start) / (1024 * 1024)
+
+	finally:
+		process.terminate()
+		process.join(5)
+		broker.stop()
+		os.remove(config_path)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--days', type=int, default=120)
+	parser.add_argument('--rows', type=int, default=5000, help='rows per streamed chunk')
+	parser.add_argument('--rate', type=float, default=100, help='small commands per second during the reply')
+	parser.add_argument('--cold', action='store_true', help='download from the gateway in each mode')
+	parser.add_argument('--latency', type=float, default=0.0, help='gateway latency in ms')
+	args = parser.parse_args(argv)
+
+	gateway = FakeGateway(latency=args.latency / 1000)
+	port = gateway.start()
+	try:
+		print(f'{"mode":<16} {"seconds":>8} {"rows":>8} {"cmd p50 ms":>11} {"cmd p99 ms":>11} {"rss +MB":>8}')
+		for i, (name, stream, multipart) in enumerate(MODES):
+			elapsed, rows, latencies, rss = runMode(port, stream, multipart, args, 27000 + i * 10)
+			print(f'{name:<16} {elapsed:>8.2f} {rows:>8} {percentile(latencies, 50) * 1000:>11.1f} {percentile(latencies, 99) * 1000:>11.1f} {rss:>8.1f}')
+
+	finally:
+		gateway.stop()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,121 @@
+'''
+Where a command's time goes, from the stage timestamps replies carry with
+the `clock` config: the broker sending it, the client receiving and
+dispatching it, the gateway request and response, and the reply going out
+and arriving. Runs the same load without `clock` first for its overhead.
+The client uses a fixed `--offset` rather than querying an NTP server.
+
+	python -m bench.timing_bench --users 2 --rate 200 --duration 10 --latency 5
+'''
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from bench.fake_broker import FakeBroker
+from bench.fake_gateway import FakeGateway
+from bench.client import client_main, writeConfig
+from bench.run_bench import SCENARIOS, percentile, runScenario, waitReady
+
+# (stage, from, to), in the order a command goes through them
+STAGES = [
+	('broker -> client', 'sent', 'received'),
+	('dispatch', 'received', 'dispatched'),
+	('to gateway', 'dispatched', 'gateway_sent'),
+	('gateway', 'gateway_sent', 'gateway_ack'),
+	('to send loop', 'gateway_ack', 'replied'),
+	('client -> broker', 'replied', 'acked'),
+	('total', 'sent', 'acked'),
+]
+
+
+def runMode(ports, clock, args, base_port):
+	push_url = f'tcp://127.0.0.1:{base_port}'
+	router_url = f'tcp://127.0.0.1:{base_port + 1}'
+	broker = FakeBroker(push_url, router_url)
+	broker.start()
+	config_path = writeConfig(push_url, router_url, { 'clock': clock })
+	process = multiprocessing.get_context('fork').Process(target=client_main, args=(config_path, ports), daemon=True)
+	process.start()
+	try:
+		waitReady(broker, len(ports))
+		res = runScenario(broker, process.pid, SCENARIOS[args.scenario], len(ports), args.rate, args.duration)
+		return res, broker.timings
+
+	finally:
+		process.terminate()
+		process.join(5)
+		broker.stop()
+		os.remove(config_path)
+
+
+def getStages(timings):
+	# Milliseconds per stage, over the commands that went through it
+	res = {}
+	for name, start, end in STAGES:
+		values = [ t[end] - t[start] for t in timings if t.get(start) is not None and t.get(end) is not None ]
+		res[name] = {
+			'count': len(values),
+			**{ f'p{p}': percentile(values, p) * 1000 for p in (50, 90, 99) }
+		}
+	return res
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+	parser.add_argument('--users', type=int, default=2)
+	parser.add_argument('--rate', type=float, default=200, help='commands per second, across all users')
+	parser.add_argument('--duration', type=float, default=10)
+	parser.add_argument('--latency', type=float, default=5.0, help='gateway latency in ms')
+	parser.add_argument('--offset', type=float, default=0.0, help='fixed clock offset in seconds')
+	parser.add_argument('--json', action='store_true', help='print results as JSON')
+	args = parser.parse_args(argv)
+
+	gateways = [ FakeGateway(latency=args.latency / 1000, seed=i) for i in range(args.users) ]
+	ports = [ gateway.start() for gateway in gateways ]
+	try:
+		plain, _ = runMode(ports, None, args, 25800)
+		timed, timings = runMode(ports, { 'offset': args.offset }, args, 25810)
+
+	finally:
+		for gateway in gateways:
+			gateway.stop()
+
+	res = {
+		'modes': {
+			name: { k: mode[k] for k in ('replies', 'lost', 'throughput_per_s', 'client_cpu_pct', 'reply_p50_ms', 'reply_p99_ms') }
+			for name, mode in (('no clock', plain), ('clock', timed))
+		},
+		'stages': getStages(timings),
+		'commands': {
+			cmd: getStages([ t for t in timings if t['cmd'] == cmd ])
+			for cmd in sorted(set(t['cmd'] for t in timings))
+		}
+	}
+
+	if args.json:
+		print(json.dumps(res, indent=2))
+		return res
+
+	print(f'{"mode":<10} {"replies":>8} {"lost":>5} {"per s":>8} {"cpu %":>7} {"p50 ms":>8} {"p99 ms":>8}')
+	for name, mode in res['modes'].items():
+		print(f'{name:<10} {mode["replies"]:>8} {mode["lost"]:>5} {mode["throughput_per_s"]:>8.1f} {mode["client_cpu_pct"]:>7.1f} {mode["reply_p50_ms"]:>8.2f} {mode["reply_p99_ms"]:>8.2f}')
+	print()
+	print(f'{"stage ms":<18} {"count":>7} {"p50":>8} {"p90":>8} {"p99":>8}')
+	for name, stage in res['stages'].items():
+		print(f'{name:<18} {stage["count"]:>7} {stage["p50"]:>8.2f} {stage["p90"]:>8.2f} {stage["p99"]:>8.2f}')
+	print()
+	print(f'{"p50 ms":<20}' + ''.join(f' {name[:10]:>10}' for name, _, _ in STAGES))
+	for cmd, stages in res['commands'].items():
+		print(f'{cmd:<20}' + ''.join(f' {stages[name]["p50"]:>10.2f}' for name, _, _ in STAGES))
+
+	return res
+
+
+if __name__ == '__main__':
+	main()
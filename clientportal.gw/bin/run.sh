@@ -20,7 +20,7 @@ echo "running $verticle "
 echo " runtime path : $RUNTIME_PATH"
 echo " config file  : $config_file"
 
-java \
+exec java \
 -server \
 -Dvertx.disableDnsResolver=true \
 -Djava.net.preferIPv4Stack=true \
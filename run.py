@@ -3,10 +3,22 @@ import os
 import json
 import time
 import zmq
-import traceback
+import queue
 import shortuuid
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from app.ib import IB
+from app import log, metrics, codec
+from app.streaming import SharedPayload
+from app.replies import ReplyStream, iterFrame, STREAM_TYPE, DEFAULT_ROWS
+from app.planner import ReloginScheduler
+from app.registry import UserRegistry
+from app.recorder import TickRecorder, CommandRecorder
+from app.clock import ClockSync
+from app.shard import ShardRouter, getRoutingKey, HANDOFF_CMD
+from app.workers import WorkerPool, getWorkerPath
+
+logger = log.getLogger('run')
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -15,13 +27,40 @@ Utilities
 '''
 class UserContainer(object):
 
-	def __init__(self):
+	def __init__(self, cache_ttl=None, session_config=None, registry=None, port_base=5000, history_config=None, recorder=None, command_recorder=None, clock=None, downloads=4):
 		self.parent = None
 		self.users = {}
+		self.user_index = {}
+		self.port_index = {}
+		self.logged_out_ports = set()
+		self.port_base = port_base
+		self.max_port = port_base
+		self.index_lock = Lock()
 		self.add_user_queue = []
-		self.send_queue = []
+		self.send_queue = queue.Queue()
+		self.stream_queue = queue.Queue()
 		self.zmq_context = zmq.Context()
-		self.next_port = 5000
+		self.next_port = port_base
+		self.cache_ttl = cache_ttl
+		self.session_config = session_config or {}
+		self.relogins = ReloginScheduler(
+			concurrency=self.session_config.get('relogin_concurrency', 2),
+			interval=self.session_config.get('relogin_interval', 5)
+		)
+		self.history_config = history_config
+		# History downloads run here, off the command loop, see `onDownload`
+		self.downloads = ThreadPoolExecutor(downloads, thread_name_prefix='download')
+		self.recorder = recorder
+		self.command_recorder = command_recorder
+		self.clock = clock
+		self.registry = registry
+		self._restoring = False
+
+	def setPortBase(self, port_base):
+		self.port_base = port_base
+		self.max_port = max(self.max_port, port_base)
+		self.next_port = max(self.next_port, port_base)
+
 
 	def setParent(self, parent):
 		self.parent = parent
@@ -31,11 +70,13 @@ class UserContainer(object):
 		return self.parent
 
 
-	def addUser(self, port, user_id, strategy_id, broker_id, username, password, is_parent):
+	def addUser(self, port, user_id, strategy_id, broker_id, username, password, is_parent, gateway_pid=None):
 		if broker_id not in self.users:
-			self.users[broker_id] = IB(port, user_id, strategy_id, broker_id, username, password)
+			self.users[broker_id] = IB(self, port, user_id, strategy_id, broker_id, username, password, gateway_pid=gateway_pid)
+			self.indexUser(self.users[broker_id])
 			if is_parent:
 				self.parent = self.users[broker_id]
+			self.saveRegistry()
 
 		return self.users[broker_id]
 
@@ -43,7 +84,11 @@ class UserContainer(object):
 	def deleteUser(self, broker_id):
 		if broker_id in self.users:
 			self.users[broker_id].stop()
+			self.unindexUser(self.users[broker_id])
+			if self.parent is self.users[broker_id]:
+				self.parent = None
 			del self.users[broker_id]
+			self.saveRegistry()
 
 
 	def getUser(self, broker_id):
@@ -53,21 +98,119 @@ class UserContainer(object):
 	def replaceUser(self, port, user_id, strategy_id, broker_id):
 		user = self.getUser(broker_id)
 		if user is not None:
+			self.unindexUser(user)
 			user.replace(user_id, strategy_id, broker_id)
+			self.indexUser(user)
+			self.saveRegistry()
+
+
+	def indexUser(self, user):
+		with self.index_lock:
+			self.user_index[(user.userId, user.strategyId, user.brokerId)] = user.brokerId
+			self.port_index[str(user.port)] = user.brokerId
+			self.max_port = max(self.max_port, int(user.port))
+
+			if user._logged_in.is_set():
+				self.logged_out_ports.discard(str(user.port))
+			else:
+				self.logged_out_ports.add(str(user.port))
+
+
+	def unindexUser(self, user):
+		with self.index_lock:
+			key = (user.userId, user.strategyId, user.brokerId)
+			if self.user_index.get(key) == user.brokerId:
+				del self.user_index[key]
+			if self.port_index.get(str(user.port)) == user.brokerId:
+				del self.port_index[str(user.port)]
+			self.logged_out_ports.discard(str(user.port))
+
+
+	def onLoginStateChange(self, user, logged_in):
+		# Called by each user's health check so lookups never hit the gateway
+		with self.index_lock:
+			if self.port_index.get(str(user.port)) != user.brokerId:
+				return
+
+			if logged_in:
+				self.logged_out_ports.discard(str(user.port))
+			else:
+				self.logged_out_ports.add(str(user.port))
+
+		self.saveRegistry()
+
+
+	def saveRegistry(self):
+		# Skipped mid-restore, so users not yet restored aren't dropped
+		if self.registry is None or self._restoring:
+			return
+
+		self.registry.save([
+			UserRegistry.record(user, user is self.parent)
+			for user in list(self.users.values())
+		])
+
+
+	def restore(self):
+		# Users from the last run, all at once. Live gateways are reattached
+		# and their sessions reused, dead ones are started again. Users that
+		# need to log in wait for credentials from the broker's add_user,
+		# see `IB.setCredentials`
+		if self.registry is None:
+			return
+
+		records = self.registry.load()
+		start = time.time()
+		self._restoring = True
+		try:
+			threads = [ Thread(target=self._restore_user, args=(record,)) for record in records ]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+		finally:
+			self._restoring = False
+		self.saveRegistry()
+
+		logger.info('[restore] Restored %s of %s users in %.1fs', len(self.users), len(records), time.time() - start)
+
+
+	def _restore_user(self, record):
+		port = record['port']
+		try:
+			self.addUser(
+				port, record['user_id'], record['strategy_id'], record['broker_id'],
+				record['username'], None, record.get('is_parent', False),
+				gateway_pid=record.get('gateway_pid')
+			)
+		except Exception:
+			logger.exception('[restore] Failed to restore user %s', record.get('broker_id'))
+			return
+
+		with self.index_lock:
+			self.next_port = max(self.next_port, int(port) + 1)
+
 
 	def findUser(self, user_id, strategy_id, broker_id):
-		for broker_id in self.users:
-			user = self.users[broker_id]
-			if (
-				user.userId == user_id and
-				user.strategyId == strategy_id and
-				user.brokerId == broker_id and
-				user._logged_in
-			):
+		broker_id = self.user_index.get((user_id, strategy_id, broker_id))
+		if broker_id is not None:
+			user = self.users.get(broker_id)
+			if user is not None and user._logged_in.is_set():
 				return broker_id
 
 		return -1
 
+
+	def findUnusedPort(self, used_ports):
+		used_ports = set(map(str, used_ports))
+		with self.index_lock:
+			for port in sorted(self.logged_out_ports - used_ports, key=int):
+				if port != str(self.port_base):
+					return port
+
+			return self.max_port + 1
+
+
 	def addToUserQueue(self):
 		_id = shortuuid.uuid()
 		self.add_user_queue.append(_id)
@@ -79,8 +222,67 @@ class UserContainer(object):
 		del self.add_user_queue[0]
 
 
+	def send(self, msg_type, msg_id, result, timing=None):
+		# Encoding happens on the send loop, see `send_loop`
+		self.send_queue.put((time.perf_counter(), msg_type, msg_id, result, timing))
+
+
+	def sendStream(self, stream):
+		# Streamed replies go through the send loop a message at a time
+		self.send_queue.put((time.perf_counter(), STREAM_TYPE, stream.msg_id, stream, stream.timing))
+
+
+	def publish(self, sub):
+		# Streaming updates take their own queue and socket so bursts
+		# never delay command replies. Each subscription is queued at most
+		# once and buffers its own updates, see `publish_loop`
+		self.stream_queue.put(sub)
+
+
+def getRegistry():
+	path = config.get('registry', os.path.join(ROOT_DIR, 'instance/registry.json'))
+	if path:
+		return UserRegistry(path)
+
+
+def getRecorder():
+	# Streamed quotes are recorded under `recorder.path` if it's set
+	recorder_config = config.get('recorder') or {}
+	if recorder_config.get('path'):
+		return TickRecorder(
+			os.path.join(ROOT_DIR, recorder_config['path']),
+			max_queue=recorder_config.get('max_queue', 100000)
+		)
+
+
+def getCommandRecorder():
+	# Commands are recorded alongside, with `recorder.commands`
+	recorder_config = config.get('recorder') or {}
+	if recorder_config.get('path') and recorder_config.get('commands'):
+		return CommandRecorder(
+			os.path.join(ROOT_DIR, recorder_config['path']),
+			max_queue=recorder_config.get('max_queue', 100000)
+		)
+
+
+def getClock():
+	# Replies carry clock corrected timestamps with `clock`, either
+	# { "server": "pool.ntp.org", "interval": 64 } or a fixed { "offset": 0 }
+	clock_config = config.get('clock')
+	if clock_config is None:
+		return None
+	if 'offset' in clock_config:
+		offset = clock_config['offset']
+		return ClockSync(server='fixed', interval=clock_config.get('interval', 64), measure=lambda: offset).start()
+	return ClockSync(
+		server=clock_config.get('server', 'pool.ntp.org'),
+		interval=clock_config.get('interval', 64),
+		timeout=clock_config.get('timeout', 5)
+	).start()
+
+
 def getConfig():
-	path = os.path.join(ROOT_DIR, 'instance/config.json')
+	path = os.environ.get('IB_CONFIG', os.path.join(ROOT_DIR, 'instance/config.json'))
 	if os.path.exists(path):
 		with open(path, 'r') as f:
 			return json.load(f)
@@ -93,22 +295,98 @@ Initialize
 '''
 
 config = getConfig()
-user_container = UserContainer()
+log.setup(config.get('logging'))
+shard_config = config.get('shard') or {}
+user_container = UserContainer(
+	config.get('cache_ttl'), config.get('session'), getRegistry(),
+	port_base=shard_config.get('port_base', 5000),
+	history_config=config.get('history'),
+	downloads=config.get('downloads', 4),
+	recorder=getRecorder(),
+	command_recorder=getCommandRecorder(),
+	clock=getClock()
+)
+envelope = codec.Envelope(
+	codec.getCodec(config.get('codec', 'json')),
+	multipart=config.get('multipart', False)
+)
+shard_router = None
 
 '''
-Socket IO functions
+Metrics
 '''
 
-def sendResponse(msg_id, res):
-	res = {
-		"type": "broker_reply",
-		"message": {
-			'msg_id': msg_id,
-			'result': res
-		}
+COMMAND_LATENCY = metrics.Histogram(
+	'ib_command_seconds', 'Command handling latency, including the reply being queued.', ('cmd',)
+)
+COMMAND_ERRORS = metrics.Counter(
+	'ib_command_errors_total', 'Commands that raised an exception.', ('cmd',)
+)
+SEND_LATENCY = metrics.Histogram(
+	'ib_send_seconds', 'Time from a reply being queued to it being sent.'
+)
+SEND_QUEUE_DEPTH = metrics.Gauge(
+	'ib_send_queue_depth', 'Replies waiting in the send queue.',
+	fn=lambda: { (): user_container.send_queue.qsize() }
+)
+PUBLISH_LATENCY = metrics.Histogram(
+	'ib_publish_seconds', 'Time from a streaming update being queued to it being published.'
+)
+STREAM_QUEUE_DEPTH = metrics.Gauge(
+	'ib_stream_queue_depth', 'Subscriptions with updates waiting to be published.',
+	fn=lambda: { (): user_container.stream_queue.qsize() }
+)
+STREAM_BUFFERED = metrics.Gauge(
+	'ib_stream_buffered', 'Streaming updates buffered per user.', ('broker_id',),
+	fn=lambda: {
+		(broker_id,): user.getBufferedUpdates()
+		for broker_id, user in list(user_container.users.items())
 	}
+)
+SOCKET_DROPPED = metrics.Counter(
+	'ib_stream_socket_dropped_total', 'Streaming updates dropped because the socket was at its high-water mark.'
+)
+PROCESS_RSS = metrics.Gauge(
+	'ib_process_rss_bytes', 'Resident memory of this process.',
+	fn=lambda: { (): metrics.getRSS(os.getpid()) }
+)
+GATEWAY_RSS = metrics.Gauge(
+	'ib_gateway_rss_bytes', 'Resident memory of each gateway JVM.', ('broker_id',),
+	fn=lambda: {
+		(broker_id,): user.getGatewayRSS()
+		for broker_id, user in list(user_container.users.items())
+	}
+)
+CHROME_RSS = metrics.Gauge(
+	'ib_chrome_rss_bytes', 'Resident memory of each webdriver and its browser processes.', ('broker_id',),
+	fn=lambda: {
+		(broker_id,): user.getChromeRSS()
+		for broker_id, user in list(user_container.users.items())
+	}
+)
+GATEWAY_RESTARTS = metrics.Gauge(
+	'ib_gateway_restarts', 'Gateway restarts performed by the supervisor.', ('broker_id',),
+	fn=lambda: {
+		(broker_id,): user.getGatewayStats()['restarts']
+		for broker_id, user in list(user_container.users.items())
+	}
+)
+
+'''
+Socket IO functions
+'''
+
+def sendResponse(msg_id, res, timing=None):
+	user_container.send("broker_reply", msg_id, res, timing)
 
-	user_container.send_queue.append(res)
+
+def sendStreamResponse(msg_id, df, options, timing=None):
+	# `options` is the command's `stream`, `true` or { "rows": n, "columns": bool }
+	options = options if isinstance(options, dict) else {}
+	user_container.sendStream(ReplyStream(
+		msg_id, iterFrame(df, options.get('rows', DEFAULT_ROWS)),
+		columns=options.get('columns', False), timing=timing
+	))
 
 
 def onAddUser(user_id, strategy_id, broker_id, username, password, is_parent):
@@ -119,14 +397,16 @@ def onAddUser(user_id, strategy_id, broker_id, username, password, is_parent):
 			user_container.next_port += 1
 		else:
 			user = user_container.getUser(broker_id)
+			if user.password is None:
+				user.setCredentials(username, password)
 	
 	except Exception:
-		print(traceback.format_exc())
+		logger.exception('[onAddUser] Failed to add user %s', broker_id)
 	finally:
 		user_container.popUserQueue()
 
 	return {
-		'_gateway_loaded': user._is_gateway_loaded
+		'_gateway_loaded': user._is_gateway_loaded.is_set()
 	}
 
 
@@ -154,6 +434,13 @@ def onFindUser(user_id, strategy_id, broker_id):
 	}
 
 
+def getGatewayStats():
+	return {
+		broker_id: user.getGatewayStats()
+		for broker_id, user in list(user_container.users.items())
+	}
+
+
 def getExistingUsers():
 	for port in user_container.users:
 		pass
@@ -167,22 +454,47 @@ def getParent():
 	return user_container.getParent()
 
 
-def findUnusedPort(used_ports):
-	print(f'[findUnusedPort] {used_ports}', flush=True)
+def rebalanceUsers():
+	# Users owned by another shard since it joined are handed over. They're
+	# stopped here first, a username can only hold one session at a time
+	with rebalance_lock:
+		for broker_id, user in list(user_container.users.items()):
+			owner = shard_router.owner(broker_id)
+			if owner == shard_router.shard_id:
+				continue
 
-	max_port = 5000
-	for port in user_container.users:
-		if port != str(5000):
-			if int(port) > max_port:
-				max_port = int(port)
-			if not port in used_ports:
-				if not user_container.users[port].isLoggedIn().get('result'):
-					print(f'[findUnusedPort] {port}', flush=True)
-					return { 'result': port }
+			logger.info('[rebalanceUsers] Handing %s to shard %s', broker_id, owner)
+			user_container.deleteUser(broker_id)
+			shard_router.handoff(owner, broker_id, user.port)
 
-	print(f'[findUnusedPort] {max_port+1}', flush=True)
 
-	return { 'result': max_port+1 }
+def onShardChange():
+	Thread(target=rebalanceUsers).start()
+
+
+def onHandoff(message):
+	# The user arrives with the broker's add_user, which brings its
+	# credentials, once find_user no longer finds it on the old shard
+	logger.info(
+		'[onHandoff] Taking over %s from shard %s (port %s), waiting for add_user',
+		message.get('broker_id'), message.get('shard'), message.get('port')
+	)
+
+
+def getShardInfo():
+	return {
+		'parent': user_container.parent is not None,
+		'users': len(user_container.users)
+	}
+
+
+def findUnusedPort(used_ports):
+	logger.debug('[findUnusedPort] %s', used_ports)
+
+	port = user_container.findUnusedPort(used_ports)
+	logger.debug('[findUnusedPort] %s', port)
+
+	return { 'result': port }
 
 
 # Download Historical Data EPT
@@ -193,7 +505,7 @@ def _download_historical_data_broker(
 	**kwargs
 ):
 	return user._download_historical_data_broker(
-		product, period, tz='Europe/London', 
+		product, period, tz=tz, 
 		start=start, end=end, count=count,
 		**kwargs
 	)
@@ -206,11 +518,21 @@ def _subscribe_chart_updates(user, msg_id, instrument):
 	}
 
 
-def onCommand(data):
-	print(f'COMMAND: {data}', flush=True)
-
+def onCommand(data, received=None):
+	logger.debug('[onCommand] %s %s %s', data.get('cmd'), data.get('broker_id'), data.get('msg_id'))
+
+	start = time.perf_counter()
+	cmd = data.get('cmd')
+	if user_container.command_recorder is not None:
+		user_container.command_recorder.record(data)
+	# Stages of the command in corrected epoch seconds, from the sender's
+	# `ts` if it has one to the reply going out, see `send_loop`
+	clock = user_container.clock
+	timing = None
+	deferred = False
+	if clock is not None:
+		timing = { 'sent': data.get('ts'), 'received': received or clock.now() }
 	try:
-		cmd = data.get('cmd')
 		broker = data.get('broker')
 		broker_id = data.get('broker_id')
 
@@ -219,6 +541,10 @@ def onCommand(data):
 		else:
 			user = getUser(broker_id)
 
+		if timing is not None:
+			timing['dispatched'] = clock.now()
+			clock.begin(timing)
+
 		if broker == 'ib':
 			res = {}
 			if cmd == 'add_user':
@@ -236,6 +562,12 @@ def onCommand(data):
 			elif cmd == 'get_existing_users':
 				res = getExistingUsers(*data.get('args'), **data.get('kwargs'))
 
+			elif cmd == 'get_gateway_stats':
+				res = getGatewayStats(*data.get('args'), **data.get('kwargs'))
+
+			elif cmd == 'get_metrics':
+				res = { 'metrics': metrics.render() }
+
 			elif cmd == 'isLoggedIn':
 				res = user.isLoggedIn()
 
@@ -251,9 +583,27 @@ def onCommand(data):
 			elif cmd == 'getAccountInfo':
 				res = user.getAccountInfo(*data.get('args')[1:], **data.get('kwargs'))
 
+			elif cmd == '_download_historical_data_broker':
+				# Downloads take seconds, so they only hold up their own reply
+				deferred = True
+				user_container.downloads.submit(onDownload, user, data, timing, start)
+				return
+
 			elif cmd == '_subscribe_gui_updates':
 				res = user._subscribe_gui_updates(*data.get('args')[1:], **data.get('kwargs'))
 
+			elif cmd == '_subscribe_pnl_updates':
+				res = user._subscribe_pnl_updates(*data.get('args')[1:], **data.get('kwargs'))
+
+			elif cmd == 'getProfit':
+				res = user.getProfit(*data.get('args')[1:], **data.get('kwargs'))
+
+			elif cmd == '_subscribe_chart_updates':
+				res = _subscribe_chart_updates(user, *data.get('args')[1:], **data.get('kwargs'))
+
+			elif cmd == 'unsubscribe':
+				res = user._unsubscribe(*data.get('args')[1:], **data.get('kwargs'))
+
 			elif cmd == '_get_all_positions':
 				res = user._get_all_positions(*data.get('args')[1:], **data.get('kwargs'))
 
@@ -284,50 +634,258 @@ def onCommand(data):
 			elif cmd == 'deleteOrder':
 				res = user.deleteOrder(*data.get('args')[1:], **data.get('kwargs'))
 
-			sendResponse(data.get('msg_id'), res)
+			sendResponse(data.get('msg_id'), res, timing)
 
 	except Exception as e:
-		print(traceback.format_exc(), flush=True)
+		logger.exception('[onCommand] %s failed', cmd)
+		COMMAND_ERRORS.labels(cmd).inc()
 		sendResponse(data.get('msg_id'), {
 			'error': str(e)
-		})
+		}, timing)
+
+	finally:
+		if clock is not None:
+			clock.end()
+		if not deferred:
+			COMMAND_LATENCY.labels(cmd).observe(time.perf_counter() - start)
+
+
+def onDownload(user, data, timing, start):
+	# A history download on `UserContainer.downloads`, replied to as
+	# `onCommand` would
+	cmd = data.get('cmd')
+	try:
+		res = _download_historical_data_broker(user, *data.get('args')[1:], **data.get('kwargs'))
+		if not isinstance(res, dict):
+			if data.get('stream'):
+				return sendStreamResponse(data.get('msg_id'), res, data.get('stream'), timing)
+			# Columns of bars, timestamps first
+			res = res.reset_index().to_dict('list')
+
+		sendResponse(data.get('msg_id'), res, timing)
+
+	except Exception as e:
+		logger.exception('[onDownload] %s failed', cmd)
+		COMMAND_ERRORS.labels(cmd).inc()
+		sendResponse(data.get('msg_id'), {
+			'error': str(e)
+		}, timing)
+
+	finally:
+		COMMAND_LATENCY.labels(cmd).observe(time.perf_counter() - start)
 
 
 def send_loop():
 	user_container.zmq_req_socket = user_container.zmq_context.socket(zmq.DEALER)
-	user_container.zmq_req_socket.connect("tcp://zmq_broker:5557")
+	user_container.zmq_req_socket.connect(config.get('zmq_send_url', 'tcp://zmq_broker:5557'))
 
 	while True:
 		try:
-			if len(user_container.send_queue):
-				item = user_container.send_queue[0]
-				del user_container.send_queue[0]
-
-				user_container.zmq_req_socket.send_json(item, zmq.NOBLOCK)
+			queued_time, msg_type, msg_id, result, timing = user_container.send_queue.get()
+			replied = None
+			if timing is not None:
+				replied = user_container.clock.now()
+			if isinstance(result, ReplyStream):
+				sendStreamMessage(queued_time, msg_type, result, replied)
+				continue
+
+			if timing is not None:
+				timing['replied'] = replied
+
+			user_container.zmq_req_socket.send_multipart(
+				envelope.encode(msg_type, msg_id, result, timing), zmq.NOBLOCK
+			)
+			SEND_LATENCY.observe(time.perf_counter() - queued_time)
 
 		except Exception:
-			print(traceback.format_exc())
+			logger.exception('[send_loop] Failed to send')
+
 
+def sendStreamMessage(queued_time, msg_type, stream, replied=None):
+	# One message per turn, then back of the queue, so other replies go
+	# out in between and only one chunk is encoded at a time. The stream
+	# stamps `replied` on a copy of its timing for each message
+	try:
+		user_container.zmq_req_socket.send_multipart(stream.next(envelope, replied), zmq.NOBLOCK, copy=False)
+		stream.sent()
+		SEND_LATENCY.observe(time.perf_counter() - queued_time)
+	except zmq.Again:
 		time.sleep(0.001)
 
+	if not stream.finished:
+		user_container.send_queue.put((time.perf_counter(), msg_type, stream.msg_id, stream, stream.timing))
+
+
+def publish_loop():
+	# Streaming updates go out on a PUB socket, topic first, so consumers
+	# can filter by broker_id/msg_id/instrument prefix. Without a PUB
+	# endpoint they fall back to a second DEALER on the reply endpoint.
+	pub_url = config.get('zmq_pub_url')
+	if pub_url:
+		user_container.zmq_pub_socket = user_container.zmq_context.socket(zmq.PUB)
+		if config.get('zmq_pub_bind', False):
+			user_container.zmq_pub_socket.bind(pub_url)
+		else:
+			user_container.zmq_pub_socket.connect(pub_url)
+	else:
+		user_container.zmq_pub_socket = user_container.zmq_context.socket(zmq.DEALER)
+		user_container.zmq_pub_socket.connect(config.get('zmq_send_url', 'tcp://zmq_broker:5557'))
 
-def run():
+	while True:
+		sub = user_container.stream_queue.get()
+		for queued_time, result in sub.drain():
+			try:
+				if isinstance(result, SharedPayload):
+					frames = envelope.encodePayload(sub.msg_type, sub.msg_id, result.encode(envelope.codec))
+				else:
+					frames = envelope.encode(sub.msg_type, sub.msg_id, result)
+				if pub_url:
+					frames = [sub.topic] + frames
+
+				user_container.zmq_pub_socket.send_multipart(frames, zmq.NOBLOCK)
+				PUBLISH_LATENCY.observe(time.perf_counter() - queued_time)
+
+			except zmq.Again:
+				SOCKET_DROPPED.inc()
+
+			except Exception:
+				logger.exception('[publish_loop] Failed to publish')
+
+
+def onMessage(frames, forwarded=False):
+	received = user_container.clock.now() if user_container.clock is not None else None
+	message = envelope.decode(frames)
+	if shard_router is not None:
+		# Only taken from peers, see `ShardRouter.recv`
+		if message.get('cmd') == HANDOFF_CMD:
+			if forwarded:
+				onHandoff(message)
+			return
+
+		# Commands forwarded by another shard are never forwarded again,
+		# even if this shard's view of the ring differs
+		if not forwarded:
+			owner = shard_router.owner(getRoutingKey(message))
+			if owner != shard_router.shard_id and shard_router.forward(owner, frames):
+				return
+
+	if worker_pool is not None:
+		return worker_pool.send(worker_pool.route(message), frames)
+
+	onCommand(message, received)
+
+
+def connectPullSocket(url=None):
+	# Workers bind the endpoint their pool sends to
 	user_container.zmq_pull_socket = user_container.zmq_context.socket(zmq.PULL)
-	user_container.zmq_pull_socket.connect("tcp://zmq_broker:5564")
+	if url is not None:
+		user_container.zmq_pull_socket.bind(url)
+	else:
+		user_container.zmq_pull_socket.connect(config.get('zmq_pull_url', 'tcp://zmq_broker:5564'))
+	user_container.zmq_poller.register(user_container.zmq_pull_socket, zmq.POLLIN)
 
+
+def run(pull_url=None):
 	user_container.zmq_poller = zmq.Poller()
-	user_container.zmq_poller.register(user_container.zmq_pull_socket, zmq.POLLIN)
+	user_container.zmq_pull_socket = None
+	if shard_router is None:
+		connectPullSocket(pull_url)
+	else:
+		shard_router.start()
+		user_container.zmq_poller.register(shard_router.socket, zmq.POLLIN)
+		# Commands are only taken once the other shards have been heard
+		# from, so users aren't added here just to be handed off
+		settled_at = time.time() + shard_router.heartbeat * 2
 
 	while True:
-		socks = dict(user_container.zmq_poller.poll())
+		socks = dict(user_container.zmq_poller.poll(None if shard_router is None and worker_pool is None else 100))
 
 		if user_container.zmq_pull_socket in socks:
-			message = user_container.zmq_pull_socket.recv_json()
-			print(f"[ZMQ_PULL] {message}")
-			onCommand(message)
+			onMessage(user_container.zmq_pull_socket.recv_multipart())
 
+		if worker_pool is not None:
+			worker_pool.tick()
+
+		if shard_router is not None:
+			if shard_router.socket in socks:
+				frames = shard_router.recv()
+				if frames is not None:
+					onMessage(frames, forwarded=True)
+
+			shard_router.tick()
+			if user_container.zmq_pull_socket is None and time.time() >= settled_at:
+				connectPullSocket()
+				# Restored users may belong elsewhere by now
+				onShardChange()
+
+
+'''
+Sharding
+'''
+
+rebalance_lock = Lock()
+if shard_config:
+	shard_router = ShardRouter(
+		user_container.zmq_context, envelope.codec,
+		shard_config.get('id', shard_config['url']), shard_config['url'],
+		peers=shard_config.get('peers', []),
+		heartbeat=shard_config.get('heartbeat', 1),
+		timeout=shard_config.get('timeout', 5),
+		info=getShardInfo, on_change=onShardChange,
+		secret=shard_config.get('secret')
+	)
+
+
+'''
+Workers
+'''
+
+PORTS_PER_WORKER = 1000
+
+def worker_main(index, url):
+	# One of the `workers` processes, see `WorkerPool`. Commands come from
+	# the pool, replies and updates go straight to the broker
+	global worker_pool
+	worker_pool = None
+	user_container.setPortBase(user_container.port_base + index * PORTS_PER_WORKER)
+	if user_container.registry is not None:
+		user_container.registry = UserRegistry(getWorkerPath(user_container.registry.path, index))
+	if user_container.recorder is not None:
+		user_container.recorder = TickRecorder(
+			getWorkerPath(user_container.recorder.path, index), user_container.recorder.max_queue
+		)
+	if user_container.command_recorder is not None:
+		user_container.command_recorder = CommandRecorder(
+			getWorkerPath(user_container.command_recorder.path, index), user_container.command_recorder.max_queue
+		)
+	if config.get('metrics_port'):
+		metrics.startHttpServer(config['metrics_port'] + 1 + index)
 
-if __name__ == '__main__':
-	print("START IB", flush=True)
 	Thread(target=send_loop).start()
+	Thread(target=publish_loop).start()
+	user_container.restore()
+	run(url)
+
+
+worker_pool = None
+if config.get('workers'):
+	if shard_router is not None:
+		raise Exception('`workers` and `shard` can\'t be combined.')
+	worker_pool = WorkerPool(
+		user_container.zmq_context, config['workers'], worker_main,
+		registry=user_container.registry.path if user_container.registry is not None else None
+	)
+
+
+if __name__ == '__main__':
+	logger.info('[run] Start IB')
+	if config.get('metrics_port'):
+		metrics.startHttpServer(config['metrics_port'])
+	if worker_pool is not None:
+		# Users live in the workers, this process only routes commands
+		worker_pool.start()
+	else:
+		Thread(target=send_loop).start()
+		Thread(target=publish_loop).start()
+		user_container.restore()
 	run()